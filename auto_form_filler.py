@@ -1,24 +1,52 @@
+import argparse
+import io
 import json
+import sys
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import jwt
+import numpy as np
+import openpyxl
 import pandas as pd
 import multiprocessing
+from multiprocessing import util as mp_util
+from multiprocessing.connection import Client, Listener
 from multiprocessing.pool import Pool
 import threading
 import time
+import queue
 import re
 import os
 import base64
+import copy
+import hashlib
+import html
+import difflib
+import unicodedata
+import subprocess
+from collections import deque
+from html.parser import HTMLParser
+from itertools import chain, islice
+from urllib.parse import parse_qsl, unquote_to_bytes, urlsplit
+from concurrent.futures import FIRST_COMPLETED, Future, InvalidStateError
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait as wait_futures
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select
-from selenium.common.exceptions import TimeoutException, ElementNotInteractableException
+from selenium.common.exceptions import (
+    ElementNotInteractableException,
+    TimeoutException,
+    WebDriverException,
+)
 from webdriver_manager.chrome import ChromeDriverManager
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import requests  # Thư viện để gọi API
+from requests.adapters import HTTPAdapter
 
 # Các thư viện cần thiết cho AI
 try:
@@ -29,6 +57,23 @@ try:
 except ImportError:
     LANGCHAIN_AVAILABLE = False
 
+# Pillow cho bộ giải CAPTCHA cục bộ (đọc ảnh, sinh bộ CAPTCHA tổng hợp)
+try:
+    from PIL import Image, ImageDraw, ImageFont
+
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+# pyarrow cho file Parquet (đầu vào .parquet và cache dạng cột của file Excel/CSV)
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
 
 class AuthManager:
     """Quản lý việc đăng nhập và xác thực với backend."""
@@ -129,7 +174,7 @@ class LoginWindow(tk.Toplevel):
 
 
 # --- CÁC HÀM TIỆN ÍCH ---
-def get_chrome_options(headless=True):
+def get_chrome_options(headless=True, lean=False, allowed_image_origins=()):
     options = webdriver.ChromeOptions()
     if headless:
         options.add_argument("--headless=new")
@@ -139,61 +184,828 @@ def get_chrome_options(headless=True):
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
     options.add_experimental_option("excludeSwitches", ["enable-logging"])
+    if lean:
+        # Không chờ ảnh/iframe tải xong, chỉ cần DOM sẵn sàng
+        options.page_load_strategy = "eager"
+        # Chặn ảnh mặc định, chỉ cho phép các origin trong allow-list (ảnh CAPTCHA)
+        options.add_experimental_option(
+            "prefs",
+            {
+                "profile.default_content_setting_values.images": 2,
+                "profile.content_settings.exceptions.images": {
+                    f"{origin},*": {"setting": 1} for origin in allowed_image_origins
+                },
+            },
+        )
     return options
 
 
-def format_date_parts(date_input):
-    if pd.isna(date_input):
-        return {"day": "", "month": "", "year": ""}
+# --- CHẾ ĐỘ TẢI TRANG GỌN NHẸ (LEAN MODE) ---
+# Mẫu URL bị chặn qua CDP Network.setBlockedURLs: font, media và analytics
+LEAN_BLOCKED_URL_PATTERNS = [
+    "*.woff",
+    "*.woff2",
+    "*.ttf",
+    "*.otf",
+    "*.eot",
+    "*.mp4",
+    "*.webm",
+    "*.mp3",
+    "*fonts.googleapis.com*",
+    "*fonts.gstatic.com*",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*doubleclick.net*",
+    "*connect.facebook.net*",
+    "*hotjar.com*",
+    "*clarity.ms*",
+]
+
+
+def origin_of(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def lean_blocked_url_patterns(allow_list=()):
+    """Danh sách mẫu URL cần chặn, bỏ những mẫu đụng tới host nằm trong allow-list."""
+    hosts = [urlsplit(a).netloc or a for a in allow_list if a]
+    return [p for p in LEAN_BLOCKED_URL_PATTERNS if not any(h in p for h in hosts)]
+
+
+def apply_network_blocking(driver, blocked_urls):
+    """Chặn các mẫu URL cho tab hiện tại (mỗi tab mới cần gọi lại)."""
     try:
-        date_str = str(date_input).split(" ")[0]
-        for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"):
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(blocked_urls)})
+    except Exception as e:
+        print(f"[Lean] Không bật được chặn URL qua CDP: {e}")
+
+
+# --- XÁC ĐỊNH CHROMEDRIVER MỘT LẦN CHO CẢ LẦN CHẠY ---
+_CHROMEDRIVER_PATH_CACHE = {}
+
+
+def verify_chromedriver(driver_path):
+    """Chạy `chromedriver --version` để chắc chắn file dùng được. Trả về (version, lỗi)."""
+    if not driver_path or not os.path.isfile(driver_path):
+        return None, f"Không tìm thấy chromedriver tại: {driver_path}"
+    try:
+        result = subprocess.run(
+            [driver_path, "--version"], capture_output=True, text=True, timeout=15
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        return None, f"Không chạy được chromedriver: {e}"
+    if result.returncode != 0 or "ChromeDriver" not in result.stdout:
+        return None, f"File không phải chromedriver hợp lệ: {driver_path}"
+    return result.stdout.strip(), None
+
+
+def resolve_chromedriver_path(offline_path=None):
+    """Xác định đường dẫn chromedriver một lần rồi cache lại trong tiến trình.
+
+    Nếu có `offline_path` thì dùng file cố định đó, không gọi webdriver-manager.
+    Trả về (đường dẫn, lỗi).
+    """
+    cache_key = offline_path or "webdriver-manager"
+    if cache_key in _CHROMEDRIVER_PATH_CACHE:
+        return _CHROMEDRIVER_PATH_CACHE[cache_key], None
+
+    if offline_path:
+        driver_path = offline_path
+    else:
+        try:
+            driver_path = ChromeDriverManager().install()
+        except Exception as e:
+            return None, f"webdriver-manager không lấy được chromedriver: {e}"
+
+    version, error = verify_chromedriver(driver_path)
+    if error:
+        return None, error
+    print(f"Sử dụng {version} tại {driver_path}")
+    _CHROMEDRIVER_PATH_CACHE[cache_key] = driver_path
+    return driver_path, None
+
+
+def create_chrome_driver(chrome_options, driver_path=None):
+    """Khởi tạo Chrome với chromedriver đã xác định sẵn (tự xác định nếu chưa có)."""
+    if not driver_path:
+        driver_path, error = resolve_chromedriver_path()
+        if error:
+            raise RuntimeError(error)
+    return webdriver.Chrome(
+        service=webdriver.chrome.service.Service(driver_path), options=chrome_options
+    )
+
+
+# --- POOL TRÌNH DUYỆT DÙNG LẠI TRONG MỖI TIẾN TRÌNH WORKER ---
+DEFAULT_MAX_USES_PER_BROWSER = 20
+
+
+class BrowserPool:
+    """Giữ các phiên Chrome sống lâu trong một tiến trình worker để dùng lại giữa các task."""
+
+    def __init__(self, max_uses=DEFAULT_MAX_USES_PER_BROWSER):
+        self.max_uses = max(1, int(max_uses))
+        self._idle = []
+        self._uses = {}
+        self._detached = []
+        self._prewarmed = set()
+
+    def checkout(self, chrome_options, url, driver_path=None, blocked_urls=None):
+        """Lấy một trình duyệt đã reset và đang ở trang `url` (tạo mới nếu pool trống).
+
+        `blocked_urls` (lean mode) được áp dụng một lần khi tạo trình duyệt mới.
+        """
+        while self._idle:
+            driver = self._idle.pop()
+            if id(driver) in self._prewarmed:
+                # Trình duyệt khởi động trước: trang đã tải sẵn, dùng luôn không reset
+                self._prewarmed.discard(id(driver))
+                return driver
             try:
-                dt_obj = datetime.strptime(date_str, fmt)
-                return {
-                    "day": dt_obj.strftime("%d"),
-                    "month": dt_obj.strftime("%m"),
-                    "year": dt_obj.strftime("%Y"),
-                }
-            except ValueError:
+                self._reset(driver, url)
+                return driver
+            except Exception as e:
+                print(f"[BrowserPool] Browser cũ không dùng lại được, tạo mới: {e}")
+                self._quit(driver)
+
+        driver = create_chrome_driver(chrome_options, driver_path)
+        self._uses[id(driver)] = 0
+        if blocked_urls:
+            apply_network_blocking(driver, blocked_urls)
+        driver.get(url)
+        return driver
+
+    def checkin(self, driver):
+        """Trả trình duyệt về pool; đóng hẳn khi đã dùng đủ `max_uses` lần."""
+        uses = self._uses.get(id(driver), 0) + 1
+        self._uses[id(driver)] = uses
+        if uses >= self.max_uses:
+            self._quit(driver)
+        else:
+            self._idle.append(driver)
+
+    def prewarm(
+        self, chrome_options, url, driver_path=None, blocked_urls=None, keep_page=True
+    ):
+        """Khởi động trước một trình duyệt đã mở `url` và để sẵn trong pool.
+
+        Nếu `keep_page` thì lần checkout đầu tiên dùng luôn trang đã tải.
+        """
+        driver = self.checkout(chrome_options, url, driver_path, blocked_urls)
+        if keep_page:
+            self._prewarmed.add(id(driver))
+        self._idle.append(driver)
+
+    def detach(self, driver):
+        """Bỏ trình duyệt khỏi pool nhưng giữ nguyên cửa sổ (dùng cho tab thất bại)."""
+        self._uses.pop(id(driver), None)
+        self._detached.append(driver)
+
+    def close_all(self):
+        while self._idle:
+            self._quit(self._idle.pop())
+
+    def _reset(self, driver, url):
+        # Gọi window_handles cũng là cách kiểm tra phiên còn sống hay không
+        handles = driver.window_handles
+        for handle in handles[1:]:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(handles[0])
+
+        try:
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        except Exception:
+            driver.delete_all_cookies()
+        try:
+            driver.execute_script(
+                "try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}"
+            )
+        except Exception:
+            pass
+        driver.get(url)
+
+    def _quit(self, driver):
+        self._uses.pop(id(driver), None)
+        self._prewarmed.discard(id(driver))
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+
+_WORKER_BROWSER_POOL = None
+
+
+def init_browser_pool_worker(max_uses_per_browser=DEFAULT_MAX_USES_PER_BROWSER):
+    """Initializer cho `Pool`: mỗi tiến trình worker sở hữu một BrowserPool riêng."""
+    global _WORKER_BROWSER_POOL
+    _WORKER_BROWSER_POOL = BrowserPool(max_uses_per_browser)
+    # Đóng các Chrome đang rảnh khi worker thoát bình thường (pool.close() + join())
+    mp_util.Finalize(
+        _WORKER_BROWSER_POOL, _WORKER_BROWSER_POOL.close_all, exitpriority=10
+    )
+
+
+# Thời gian tối đa (giây) chờ worker thoát êm sau pool.close() trước khi terminate()
+POOL_JOIN_TIMEOUT = 60
+
+
+def shutdown_pool(pool, graceful=True, join_timeout=POOL_JOIN_TIMEOUT):
+    """Đóng pool worker. Trả về True nếu mọi worker thoát êm.
+
+    graceful: close() rồi join() có giới hạn để worker tự đóng Chrome đang giữ; quá
+    join_timeout (worker treo) hoặc graceful=False thì terminate(). Luồng gọi không bao
+    giờ bị kẹt mãi trong join().
+    """
+    if graceful:
+        pool.close()
+        joiner = threading.Thread(target=pool.join, daemon=True)
+        joiner.start()
+        joiner.join(join_timeout)
+        if not joiner.is_alive():
+            return True
+    pool.terminate()
+    pool.join()
+    return False
+
+
+def get_worker_browser_pool():
+    global _WORKER_BROWSER_POOL
+    if _WORKER_BROWSER_POOL is None:
+        init_browser_pool_worker()
+    return _WORKER_BROWSER_POOL
+
+
+# --- HẸN GIỜ MỞ ĐĂNG KÝ: TRÌNH DUYỆT KHỞI ĐỘNG TRƯỚC, NHẢ ĐÚNG GIỜ ---
+SERVER_CLOCK_SAMPLES = 6
+PREWARM_TIMEOUT = 180
+# Ngủ thô tới sát giờ mở rồi chờ bận đoạn cuối để nhả đúng thời điểm
+RELEASE_SPIN_WINDOW = 0.05
+# Múi giờ mặc định của server (giờ Việt Nam); header Date chỉ bù lệch đồng hồ, không
+# cho biết múi giờ nên giờ mở phải được quy đổi theo múi giờ này
+DEFAULT_SERVER_UTC_OFFSET = "+07:00"
+
+
+def parse_utc_offset(text):
+    """'+07:00', 'UTC+7', '-0530' -> timezone. Trả về None nếu không đúng định dạng."""
+    match = re.fullmatch(
+        r"(?:UTC|GMT)?\s*([+-])(\d{1,2})(?::?(\d{2}))?", text.strip(), re.IGNORECASE
+    )
+    if not match:
+        return None
+    sign, hours, minutes = match.groups()
+    delta = timedelta(hours=int(hours), minutes=int(minutes or 0))
+    if delta > timedelta(hours=14) or (minutes and int(minutes) >= 60):
+        return None
+    return timezone(-delta if sign == "-" else delta)
+
+
+def scheduled_timestamp(scheduled_time, now=None):
+    """Epoch của giờ mở hôm nay theo múi giờ gắn trong `scheduled_time` (tzinfo).
+
+    "Hôm nay" tính theo ngày của server, không phải ngày trên máy.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = now.astimezone(scheduled_time.tzinfo).date()
+    return datetime.combine(today, scheduled_time).timestamp()
+
+
+def measure_server_clock_offset(url, samples=SERVER_CLOCK_SAMPLES):
+    """Ước lượng độ lệch (giờ server - giờ máy) từ header HTTP `Date`. Trả về (offset, lỗi).
+
+    Header Date bị làm tròn xuống giây nên mỗi mẫu chỉ cho một khoảng
+    (date - t1, date + 1 - t0); các mẫu được lệch pha nhau để giao các khoảng
+    lại còn hẹp, lấy điểm giữa.
+    """
+    lower, upper = float("-inf"), float("inf")
+    midpoints = []
+    with requests.Session() as session:
+        for i in range(samples):
+            t0 = time.time()
+            try:
+                response = session.get(url, timeout=10, stream=True)
+            except requests.exceptions.RequestException as e:
+                return None, f"Không kết nối được tới server: {e}"
+            t1 = time.time()
+            response.close()
+            date_header = response.headers.get("Date")
+            if not date_header:
+                return None, "Server không trả về header Date."
+            server_second = parsedate_to_datetime(date_header).timestamp()
+            lower = max(lower, server_second - t1)
+            upper = min(upper, server_second + 1 - t0)
+            midpoints.append(server_second + 0.5 - (t0 + t1) / 2)
+            if i < samples - 1:
+                time.sleep(1 / samples + 0.1)
+    if lower <= upper:
+        return (lower + upper) / 2, None
+    # Mạng dao động làm các khoảng không giao nhau: dùng trung vị
+    midpoints.sort()
+    return midpoints[len(midpoints) // 2], None
+
+
+def sleep_until(release_at):
+    """Chờ tới thời điểm `release_at` (epoch máy local) với sai số vài mili giây."""
+    while True:
+        remaining = release_at - time.time()
+        if remaining <= 0:
+            return
+        if remaining > RELEASE_SPIN_WINDOW:
+            time.sleep(remaining - RELEASE_SPIN_WINDOW)
+        else:
+            time.sleep(0.0005)
+
+
+def init_prewarmed_worker(
+    max_uses_per_browser, prewarm_task, ready_counter, keep_page=True
+):
+    """Initializer cho `Pool` ở chế độ hẹn giờ: mở sẵn trình duyệt tại trang form."""
+    init_browser_pool_worker(max_uses_per_browser)
+    try:
+        _WORKER_BROWSER_POOL.prewarm(
+            prewarm_task["options"],
+            prewarm_task["url"],
+            prewarm_task.get("driver_path"),
+            prewarm_task.get("blocked_urls"),
+            keep_page,
+        )
+    except Exception as e:
+        print(f"[Prewarm] Không khởi động trước được trình duyệt: {e}")
+    finally:
+        with ready_counter.get_lock():
+            ready_counter.value += 1
+
+
+# --- CHUẨN HÓA VÀ KIỂM TRA DỮ LIỆU EXCEL THEO CỘT ---
+# Định dạng ngày sinh được chấp nhận, mỗi định dạng là một lệnh to_datetime trên cả cột
+DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y")
+# Số dòng chuẩn hóa mỗi lần: đủ lớn để vector hóa có lợi, đủ nhỏ để task đầu chạy sớm
+NORMALIZE_CHUNK_ROWS = 500
+PHONE_PATTERN = r"0\d{9,10}"
+# CCCD 12 số, CMND cũ 9 số, hộ chiếu 1 chữ cái + 7-8 số
+ID_CARD_PATTERN = r"\d{12}|\d{9}|[A-Z]\d{7,8}"
+EMAIL_PATTERN = r"[^@\s]+@[^@\s]+\.[A-Za-z]{2,}"
+# Cột bắt buộc phải có giá trị; email để trống vẫn gửi form được
+EXCEL_REQUIRED_KEYS = ("full_name", "phone_number", "id_card")
+# Số dòng lỗi được ghi chi tiết vào log, các dòng sau chỉ liệt kê số dòng
+VALIDATION_LOG_LIMIT = 50
+# Các trường lấy từ cột ngày sinh (tách ngày/tháng/năm) chứ không đọc thẳng
+DATE_PART_KEYS = ("day", "month", "year", "date_of_birth")
+
+
+def _text_column(series):
+    return series.fillna("").astype(str).str.strip()
+
+
+def normalize_phone_column(series):
+    """Làm sạch cột SĐT: bỏ '.0' do Excel lưu dạng số, dấu phân cách, đầu số +84/84.
+
+    Số 9 chữ số (Excel làm mất số 0 đầu) được thêm lại số 0.
+    """
+    phone = _text_column(series).str.replace(r"\.0$", "", regex=True)
+    phone = phone.str.replace(r"[\s.\-()]", "", regex=True)
+    phone = phone.str.replace(r"^\+?84(\d{9,10})$", r"0\1", regex=True)
+    return phone.str.replace(r"^([1-9]\d{8})$", r"0\1", regex=True)
+
+
+def normalize_id_card_column(series):
+    """Làm sạch cột CCCD/hộ chiếu: bỏ '.0', khoảng trắng, viết hoa chữ cái.
+
+    CCCD bắt đầu bằng mã tỉnh 0xx (001 là Hà Nội) nên Excel có thể làm mất một
+    hoặc hai số 0 đầu: dãy 10-11 chữ số được đệm lại cho đủ 12. CMND cũ 9 số giữ nguyên.
+    """
+    id_card = _text_column(series).str.replace(r"\.0$", "", regex=True)
+    id_card = id_card.str.replace(r"\s", "", regex=True).str.upper()
+    return id_card.mask(id_card.str.fullmatch(r"\d{10,11}"), id_card.str.zfill(12))
+
+
+def parse_date_column(series):
+    """Tách cột ngày sinh thành DataFrame day/month/year (chuỗi 2-2-4 chữ số).
+
+    Ô không khớp định dạng nào trong DATE_FORMATS có cả ba phần rỗng.
+    """
+    text = _text_column(series).str.split(" ").str[0]
+    parsed = pd.Series(pd.NaT, index=series.index, dtype="datetime64[ns]")
+    for fmt in DATE_FORMATS:
+        missing = parsed.isna() & (text != "")
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(text[missing], format=fmt, errors="coerce")
+    return pd.DataFrame(
+        {
+            "day": parsed.dt.strftime("%d").fillna(""),
+            "month": parsed.dt.strftime("%m").fillna(""),
+            "year": parsed.dt.strftime("%Y").fillna(""),
+        },
+        index=series.index,
+    )
+
+
+def normalize_row_chunk(df, EXCEL_COLUMN_MAPPING):
+    """Chuẩn hóa một khối dòng Excel theo cột. Trả về (DataFrame dữ liệu form, Series lỗi).
+
+    Mọi phép xử lý chạy trên cả cột, không lặp từng dòng. Dòng hợp lệ có mô tả lỗi
+    rỗng; dòng mà mọi cột được map đều trống bị bỏ khỏi kết quả.
+    """
+    mapped_columns = [
+        col for col in set(EXCEL_COLUMN_MAPPING.values()) if col and col in df
+    ]
+    if mapped_columns:
+        filled = df[mapped_columns].apply(_text_column).ne("").any(axis=1)
+        df = df[filled]
+
+    data = pd.DataFrame(index=df.index)
+    issues = []
+    for form_key, excel_col in EXCEL_COLUMN_MAPPING.items():
+        if not excel_col or excel_col not in df or form_key in DATE_PART_KEYS:
+            continue
+        pattern = None
+        if form_key == "phone_number":
+            values, pattern = normalize_phone_column(df[excel_col]), PHONE_PATTERN
+        elif form_key == "id_card":
+            values, pattern = normalize_id_card_column(df[excel_col]), ID_CARD_PATTERN
+        elif form_key == "email":
+            values, pattern = _text_column(df[excel_col]), EMAIL_PATTERN
+        else:
+            values = _text_column(df[excel_col])
+        data[form_key] = values
+        if form_key not in EXCEL_DATA_KEYS:
+            continue
+        empty = values == ""
+        if form_key in EXCEL_REQUIRED_KEYS:
+            issues.append((empty, f"thiếu {form_key}"))
+        if pattern:
+            invalid = ~empty & ~values.str.fullmatch(pattern)
+            issues.append((invalid, f"{form_key} sai định dạng '" + values + "'"))
+
+    dob_col = EXCEL_COLUMN_MAPPING.get("day") or EXCEL_COLUMN_MAPPING.get(
+        "date_of_birth"
+    )
+    if dob_col and dob_col in df:
+        dates = parse_date_column(df[dob_col])
+        data[["day", "month", "year"]] = dates
+        raw = _text_column(df[dob_col])
+        issues.append((raw == "", "thiếu ngày sinh"))
+        invalid = (raw != "") & (dates["day"] == "")
+        issues.append((invalid, "ngày sinh không hợp lệ '" + raw + "'"))
+
+    problems = pd.Series("", index=df.index)
+    for mask, message in issues:
+        problems = problems.mask(mask, problems + message + "; ")
+    return data, problems.str.rstrip("; ")
+
+
+def iter_normalized_rows(chunks, EXCEL_COLUMN_MAPPING, on_rejected):
+    """Chuẩn hóa từng khối dòng (xem open_input_chunks), trả về dần (số dòng, dict dữ liệu form).
+
+    Dòng lỗi không được trả về mà báo qua on_rejected(số dòng, mô tả lỗi),
+    nên không tốn phiên trình duyệt nào cho dòng chắc chắn bị web từ chối.
+    """
+    for df in chunks:
+        data, problems = normalize_row_chunk(df, EXCEL_COLUMN_MAPPING)
+        bad = problems != ""
+        for bad_row, message in problems[bad].items():
+            on_rejected(bad_row, message)
+        yield from data[~bad].to_dict("index").items()
+
+
+# --- PHÁT HIỆN DÒNG TRÙNG LẶP TRƯỚC KHI TẠO TASK ---
+# Trường định danh người đăng ký: web từ chối dòng trùng một trong các trường này
+DUPLICATE_KEY_FIELDS = ("id_card", "phone_number", "email")
+# Trường được so thêm để phân biệt dòng lặp lại y hệt với dòng xung đột (cùng CCCD, khác người)
+DUPLICATE_COMPARE_FIELDS = ("full_name",) + DUPLICATE_KEY_FIELDS
+
+
+def duplicate_key(form_key, value):
+    """Khóa so trùng: email so không phân biệt hoa thường, tên bỏ khoảng trắng thừa."""
+    value = str(value).strip()
+    if form_key == "email":
+        return value.casefold()
+    if form_key == "full_name":
+        return " ".join(value.split()).casefold()
+    # SĐT và CCCD đã được chuẩn hóa ở normalize_row_chunk
+    return value
+
+
+class DuplicateRowIndex:
+    """Chỉ mục băm {trường: {khóa: dòng đầu tiên}} để phát hiện dòng trùng trong một lượt đọc.
+
+    Dòng đầu tiên mang một giá trị được giữ; các dòng sau trùng bất kỳ trường nào trong
+    DUPLICATE_KEY_FIELDS bị đánh dấu và không được thêm vào chỉ mục, nên mọi dòng trùng
+    đều trỏ về dòng gốc.
+    """
+
+    def __init__(self, fields=DUPLICATE_KEY_FIELDS):
+        self.fields = fields
+        self._index = {field: {} for field in fields}
+        self._first_rows = {}
+        self.duplicate_rows = []
+        self.conflict_rows = []
+
+    def check(self, row_number, record):
+        """Trả về mô tả trùng lặp của dòng, hoặc None nếu dòng chưa gặp."""
+        keys = {}
+        matches = {}
+        for field in self.fields:
+            if not record.get(field):
                 continue
-        parts = re.split(r"[-/]", date_str)
-        if len(parts) == 3:
-            return {"day": parts[0], "month": parts[1], "year": parts[2]}
-    except Exception:
-        pass
-    return {"day": "", "month": "", "year": ""}
+            keys[field] = duplicate_key(field, record[field])
+            first_row = self._index[field].get(keys[field])
+            if first_row is not None:
+                matches.setdefault(first_row, []).append(field)
+        if not matches:
+            for field, key in keys.items():
+                self._index[field][key] = row_number
+            self._first_rows[row_number] = {
+                field: duplicate_key(field, record[field])
+                for field in DUPLICATE_COMPARE_FIELDS
+                if record.get(field)
+            }
+            return None
+
+        parts = []
+        conflict = False
+        for first_row, fields in matches.items():
+            first = self._first_rows[first_row]
+            differing = [
+                field
+                for field in DUPLICATE_COMPARE_FIELDS
+                if record.get(field)
+                and field in first
+                and duplicate_key(field, record[field]) != first[field]
+            ]
+            part = f"trùng {', '.join(fields)} với dòng {first_row}"
+            if differing:
+                conflict = True
+                part += f" nhưng khác {', '.join(differing)}"
+            parts.append(part)
+        (self.conflict_rows if conflict else self.duplicate_rows).append(row_number)
+        return ("XUNG ĐỘT: " if conflict else "") + "; ".join(parts)
+
+
+# --- ĐỌC DỮ LIỆU ĐẦU VÀO THEO LUỒNG: TASK ĐẦU CHẠY KHI FILE CÒN ĐANG ĐỌC ---
+# Định dạng openpyxl đọc được ở chế độ read_only; .xls vẫn đọc cả file bằng pandas
+STREAMING_EXCEL_SUFFIXES = (".xlsx", ".xlsm")
+EXCEL_SUFFIXES = STREAMING_EXCEL_SUFFIXES + (".xls",)
+JSONL_SUFFIXES = (".jsonl", ".ndjson")
+INPUT_FILE_TYPES = [
+    ("Dữ liệu đầu vào", "*.xlsx;*.xlsm;*.xls;*.csv;*.jsonl;*.ndjson;*.parquet"),
+    ("Excel files", "*.xlsx;*.xlsm;*.xls"),
+    ("CSV", "*.csv"),
+    ("JSON Lines", "*.jsonl;*.ndjson"),
+    ("Parquet", "*.parquet"),
+]
+# Cache dạng cột nằm cạnh file gốc, ghi kèm mtime + sha256 của file gốc để biết còn dùng được
+TABLE_CACHE_SUFFIX = ".cache.parquet"
+TABLE_CACHE_METADATA_KEY = b"auto_form_filler.source"
+
+
+def excel_cell_to_str(value):
+    """Đổi giá trị ô về chuỗi như pd.read_excel(dtype=str). Ô trống trả về None."""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def excel_header_names(header):
+    """Tên cột giống pandas: ô tiêu đề trống thành 'Unnamed: i', tên trùng thêm '.1', '.2'."""
+    names = []
+    seen = {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def _open_sheet_rows(path):
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    sheet = workbook.active
+    # Kích thước ghi trong file có thể sai (file do công cụ khác xuất), đọc tới dòng cuối thật
+    sheet.reset_dimensions()
+    return workbook, sheet.iter_rows(values_only=True)
+
+
+def read_excel_header(path):
+    workbook, rows = _open_sheet_rows(path)
+    try:
+        header = next(rows, ())
+    finally:
+        workbook.close()
+    while header and header[-1] is None:
+        header = header[:-1]
+    return excel_header_names(header)
+
+
+def iter_excel_rows(path, columns):
+    """Đọc dần từng dòng dữ liệu (bỏ dòng tiêu đề), mỗi dòng là list chuỗi theo thứ tự cột."""
+    workbook, rows = _open_sheet_rows(path)
+    try:
+        next(rows, None)
+        for values in rows:
+            values = [excel_cell_to_str(v) for v in values[: len(columns)]]
+            yield values + [None] * (len(columns) - len(values))
+    finally:
+        workbook.close()
+
+
+def iter_excel_chunks(path, columns):
+    rows = iter_excel_rows(path, columns)
+    while True:
+        chunk = list(islice(rows, NORMALIZE_CHUNK_ROWS))
+        if not chunk:
+            return
+        yield pd.DataFrame(chunk, columns=columns)
+
+
+def iter_csv_chunks(path):
+    # utf-8-sig: bỏ BOM mà Excel ghi vào đầu file CSV
+    with pd.read_csv(
+        path, dtype=str, encoding="utf-8-sig", chunksize=NORMALIZE_CHUNK_ROWS
+    ) as reader:
+        yield from reader
+
+
+def read_jsonl_header(path):
+    """Tên cột của file JSONL lấy theo thứ tự khóa của bản ghi đầu tiên."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                return list(json.loads(line).keys())
+    return []
+
+
+def iter_jsonl_chunks(path, columns):
+    with pd.read_json(
+        path,
+        lines=True,
+        dtype=False,
+        convert_dates=False,
+        encoding="utf-8",
+        chunksize=NORMALIZE_CHUNK_ROWS,
+    ) as reader:
+        for chunk in reader:
+            # Khóa chỉ có ở bản ghi sau bị bỏ, khóa thiếu thành ô trống
+            yield chunk.reindex(columns=columns)
+
+
+def iter_parquet_chunks(path):
+    with pq.ParquetFile(path) as parquet_file:
+        for batch in parquet_file.iter_batches(batch_size=NORMALIZE_CHUNK_ROWS):
+            yield batch.to_pandas()
+
+
+def _numbered_chunks(chunks, first_row):
+    """Đặt index của từng khối là số dòng trong file nguồn (dùng trong báo cáo dòng lỗi)."""
+    row_number = first_row
+    for chunk in chunks:
+        chunk.index = range(row_number, row_number + len(chunk))
+        row_number += len(chunk)
+        yield chunk
+
 
+def _open_source_chunks(path):
+    """Như open_input_chunks nhưng luôn đọc file gốc, không dùng cache.
 
-def normalize_phone(phone_input):
-    if pd.isna(phone_input):
-        return ""
-    phone = str(phone_input).strip().replace(".0", "")
-    if phone.startswith("84"):
-        return "0" + phone[2:]
-    return phone
+    Trả về (danh sách cột, iterator khối, số dòng của bản ghi đầu tiên).
+    """
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix in STREAMING_EXCEL_SUFFIXES:
+        columns = read_excel_header(path)
+        return columns, iter_excel_chunks(path, columns), 2
+    if suffix == ".xls":
+        df = pd.read_excel(path, dtype=str)
+        return list(df.columns), iter([df]), 2
+    if suffix == ".csv":
+        columns = list(pd.read_csv(path, dtype=str, encoding="utf-8-sig", nrows=0))
+        return columns, iter_csv_chunks(path), 2
+    if suffix in JSONL_SUFFIXES:
+        columns = read_jsonl_header(path)
+        return columns, iter_jsonl_chunks(path, columns), 1
+    if suffix == ".parquet":
+        if not PYARROW_AVAILABLE:
+            raise ValueError("Cần cài đặt 'pyarrow' để đọc file Parquet.")
+        return pq.read_schema(path).names, iter_parquet_chunks(path), 1
+    raise ValueError(f"Không hỗ trợ định dạng file '{suffix}'.")
 
 
-def solve_captcha_with_gemini(api_key, image_bytes):
-    """Gửi ảnh CAPTCHA đến Gemini và trả về text giải được."""
+def open_input_chunks(path):
+    """Mở file dữ liệu đầu vào, trả về (danh sách cột, iterator khối DataFrame, file thực đọc).
+
+    Hỗ trợ Excel, CSV, JSONL và Parquet. Tên cột được đọc ngay, dữ liệu được đọc dần
+    từng khối NORMALIZE_CHUNK_ROWS dòng nên task đầu tiên có thể chạy trong lúc phần
+    còn lại của file vẫn đang được đọc. Index của mỗi khối là số dòng trong file gốc.
+    Nếu file có cache dạng cột còn hợp lệ (xem build_table_cache) thì đọc từ cache.
+    """
+    cache_path = valid_table_cache(path)
+    if cache_path:
+        columns = pq.read_schema(cache_path).names
+        first_row = read_table_cache_source(cache_path)["first_row"]
+        chunks = iter_parquet_chunks(cache_path)
+        return columns, _numbered_chunks(chunks, first_row), cache_path
+    columns, chunks, first_row = _open_source_chunks(path)
+    return columns, _numbered_chunks(chunks, first_row), path
+
+
+def table_cache_path(path):
+    return f"{path}{TABLE_CACHE_SUFFIX}"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_table_cache_source(cache_path):
+    """Thông tin file gốc ghi trong metadata của cache: mtime_ns, sha256, first_row."""
+    metadata = pq.read_schema(cache_path).metadata or {}
+    return json.loads(metadata[TABLE_CACHE_METADATA_KEY])
+
+
+def valid_table_cache(path):
+    """Đường dẫn cache của file nếu file gốc chưa đổi (cùng mtime và sha256), ngược lại None."""
+    cache_path = table_cache_path(path)
+    if not PYARROW_AVAILABLE or not os.path.exists(cache_path):
+        return None
+    try:
+        source = read_table_cache_source(cache_path)
+        # So mtime trước: rẻ, chỉ băm lại file gốc khi mtime còn khớp
+        if source["mtime_ns"] != os.stat(path).st_mtime_ns:
+            return None
+        if source["sha256"] != file_sha256(path):
+            return None
+    except (OSError, ValueError, KeyError, pa.ArrowException):
+        return None
+    return cache_path
+
+
+def build_table_cache(path, force=False):
+    """Đọc file gốc một lần và ghi cache Parquet (mọi cột là chuỗi) cạnh file gốc.
+
+    Cache còn hợp lệ thì dùng lại, trừ khi force. Trả về (đường dẫn cache, số dòng, dùng lại?).
+    """
+    if path.lower().endswith(".parquet"):
+        raise ValueError("File đã ở dạng Parquet, không cần tạo cache.")
+    cache_path = valid_table_cache(path)
+    if cache_path and not force:
+        return cache_path, pq.read_metadata(cache_path).num_rows, True
+
+    cache_path = table_cache_path(path)
+    # Lấy mtime + hash trước khi đọc: file bị sửa trong lúc đọc thì cache tự mất hiệu lực
+    source = {"mtime_ns": os.stat(path).st_mtime_ns, "sha256": file_sha256(path)}
+    columns, chunks, source["first_row"] = _open_source_chunks(path)
+    schema = pa.schema(
+        [(column, pa.string()) for column in columns],
+        metadata={TABLE_CACHE_METADATA_KEY: json.dumps(source)},
+    )
+    tmp_path = f"{cache_path}.tmp"
+    row_count = 0
+    with pq.ParquetWriter(tmp_path, schema) as writer:
+        for chunk in chunks:
+            chunk = chunk.astype(object).where(chunk.notna(), None)
+            chunk = chunk.apply(lambda column: column.map(excel_cell_to_str))
+            writer.write_table(
+                pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            )
+            row_count += len(chunk)
+    os.replace(tmp_path, cache_path)
+    return cache_path, row_count, False
+
+
+def create_captcha_llm(api_key):
+    return ChatGoogleGenerativeAI(model="gemini-2.0-flash", google_api_key=api_key)
+
+
+def solve_captcha_with_gemini(api_key, image_bytes, llm=None):
+    """Gửi ảnh CAPTCHA đến Gemini và trả về text giải được.
+
+    Truyền llm đã tạo sẵn để dùng lại client (và kết nối) giữa các lần gọi.
+    """
     if not LANGCHAIN_AVAILABLE:
         return None, "Thư viện 'langchain-google-genai' chưa được cài đặt."
     if not api_key:
         return None, "API Key của Google AI bị thiếu."
     try:
-        llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", google_api_key=api_key)
+        llm = llm or create_captcha_llm(api_key)
         message = HumanMessage(
             content=[
                 {
                     "type": "text",
                     "text": "Read the characters in this image. Return only the characters as a single string, with no other explanation or formatting.",
                 },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{base64.b64encode(image_bytes).decode('utf-8')}"
-                    },
-                },
+                captcha_image_part(image_bytes),
             ]
         )
         response = llm.invoke([message])
@@ -204,260 +1016,3642 @@ def solve_captcha_with_gemini(api_key, image_bytes):
         return None, str(e)
 
 
-# --- TIẾN TRÌNH ĐIỀN FORM (WORKER) - PHIÊN BẢN ĐÃ VIẾT LẠI ---
-# --- TIẾN TRÌNH ĐIỀN FORM (WORKER) - PHIÊN BẢN ĐÃ VIẾT LẠI ---
-def fill_and_submit_process(task_info):
-    url = task_info["url"]
-    chrome_options = task_info["options"]
-    data = task_info["data"]
-    process_id = task_info["process_id"]
-    is_headless = task_info["is_headless"]
-    use_ai_captcha = task_info["use_ai_captcha"]
-    api_keys = task_info["api_keys"]
-    FORM_FIELD_IDS = task_info["FORM_FIELD_IDS"]
-    keep_failed_tab = task_info["keep_failed_tab"]
-    driver = None
-    success = False
-    name_for_log = data.get("full_name", f"Task {process_id}")
+def captcha_image_part(image_bytes):
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/png;base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+        },
+    }
 
-    try:
-        service = webdriver.chrome.service.Service(ChromeDriverManager().install())
-        driver = webdriver.Chrome(service=service, options=chrome_options)
-        driver.get(url)
-        wait = WebDriverWait(driver, 1)  # Tăng thời gian chờ lên 5 giây cho ổn định
 
-        # --- VÒNG LẶP ĐIỀN FORM ĐỘNG ---
-        field_order = ["sales_date", "session"] + [
-            k
-            for k in FORM_FIELD_IDS.keys()
-            if k not in ["sales_date", "session", "submit_button"]
-        ]
+def solve_captcha_batch_with_gemini(api_key, images, llm=None):
+    """Gửi nhiều ảnh CAPTCHA trong một request. Trả về ({chỉ số ảnh: text}, lỗi).
 
-        for key in field_order:
-            element_id = FORM_FIELD_IDS.get(key)
-            if not element_id:
+    Ảnh nào model không trả lời thì không có trong dict.
+    """
+    if not LANGCHAIN_AVAILABLE:
+        return None, "Thư viện 'langchain-google-genai' chưa được cài đặt."
+    try:
+        llm = llm or create_captcha_llm(api_key)
+        content = [
+            {
+                "type": "text",
+                "text": f"You will receive {len(images)} CAPTCHA images numbered 1 to {len(images)}. Read the characters in each image. Reply with exactly one line per image in the form '<number>: <characters>', with no other explanation or formatting.",
+            }
+        ]
+        for i, image_bytes in enumerate(images, 1):
+            content += [{"type": "text", "text": f"Image {i}:"}]
+            content += [captcha_image_part(image_bytes)]
+        response = llm.invoke([HumanMessage(content=content)])
+        answers = {}
+        for line in response.content.splitlines():
+            match = re.match(r"\s*(?:image\s*)?(\d+)\s*[:.)-]\s*(.+)", line, re.I)
+            if not match:
                 continue
+            index = int(match.group(1)) - 1
+            text = re.sub(r"[^A-Za-z0-9]", "", match.group(2))
+            if 0 <= index < len(images) and text:
+                answers[index] = text
+        return answers, (None if answers else "Không đọc được đáp án nào.")
+    except Exception as e:
+        return None, str(e)
 
-            try:
-                element = wait.until(
-                    EC.presence_of_element_located((By.ID, element_id))
-                )
-                tag = element.tag_name.lower()
-                value = data.get(key)
 
-                if tag == "select":
-                    if not value:
-                        continue
+SUCCESS_MARKER = "ĐĂNG KÝ THÀNH CÔNG"
+SUCCESS_XPATH = f"//*[contains(text(), '{SUCCESS_MARKER}')]"
 
-                    select = Select(element)
 
-                    # <<< THAY ĐỔI QUAN TRỌNG BẮT ĐẦU TỪ ĐÂY >>>
-                    # Nếu là dropdown 'session', tìm kiếm thông minh hơn
-                    if key == "session":
-                        print(
-                            f"[{process_id}] Finding smart match for '{key}' with value '{value}'..."
-                        )
-                        found_option = False
-                        for option in select.options:
-                            # Kiểm tra xem option có chứa chuỗi thời gian mong muốn không
-                            if str(value) in option.text:
-                                print(
-                                    f"[{process_id}] Found match: '{option.text}'. Selecting..."
-                                )
-                                select.select_by_visible_text(option.text)
-                                found_option = True
-                                break  # Thoát khỏi vòng lặp khi đã tìm thấy
-                        if not found_option:
+def form_field_order(FORM_FIELD_IDS):
+    """Thứ tự điền: sales_date, session trước vì session phụ thuộc ngày bán."""
+    # captcha_image_selector là CSS selector chứ không phải ID nên không điền
+    return ["sales_date", "session"] + [
+        k
+        for k in FORM_FIELD_IDS.keys()
+        if k not in ["sales_date", "session", "submit_button", "captcha_image_selector"]
+    ]
+
+
+# --- CHỜ THEO SỰ KIỆN THAY CHO SLEEP CỐ ĐỊNH ---
+# Giới hạn trên (giây) khi chờ dropdown phụ thuộc được nạp lại
+DROPDOWN_WAIT_TIMEOUT = 5
+DROPDOWN_POLL_INTERVAL = 0.05
+
+# Đánh dấu các node option hiện có; node mới do AJAX nạp lại sẽ không có dấu này
+MARK_SELECT_OPTIONS_SCRIPT = """
+const el = document.getElementById(arguments[0]);
+if (!el || !el.options) return null;
+return Array.from(el.options).map((o) => {
+    o.__staleOption = true;
+    return o.text;
+});
+"""
+
+SELECT_REFRESHED_SCRIPT = """
+const [id, previous] = arguments;
+const el = document.getElementById(id);
+if (!el || !el.options || !el.options.length) return false;
+const options = Array.from(el.options);
+return !options.some((o) => o.__staleOption)
+    || JSON.stringify(options.map((o) => o.text)) !== JSON.stringify(previous);
+"""
+
+
+def mark_select_options(driver, select_id):
+    """Đánh dấu option hiện tại của select (gọi trước khi đổi dropdown cha).
+
+    Trả về danh sách text option hiện tại để truyền cho wait_for_dropdown_refresh.
+    """
+    return driver.execute_script(MARK_SELECT_OPTIONS_SCRIPT, select_id)
+
+
+def wait_for_dropdown_refresh(
+    driver,
+    select_id,
+    previous_options,
+    timeout=DROPDOWN_WAIT_TIMEOUT,
+):
+    """Chờ dropdown phụ thuộc nạp lại sau mark_select_options.
+
+    Chỉ coi là đã nạp khi các option cũ đã bị thay (hoặc text đổi), kể cả khi danh sách
+    mới giống hệt danh sách cũ (phiên thường giống nhau mỗi ngày): chọn option trong danh
+    sách cũ sẽ bị AJAX ghi đè. Trả về False nếu hết `timeout` mà chưa thấy nạp lại.
+    """
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=DROPDOWN_POLL_INTERVAL).until(
+            lambda d: dropdown_refreshed(d, select_id, previous_options)
+        )
+        return True
+    except TimeoutException:
+        return False
+
+
+def dropdown_refreshed(driver, select_id, previous_options):
+    """Kiểm tra một lần (không chờ) dropdown đã nạp lại sau mark_select_options chưa."""
+    try:
+        return bool(
+            driver.execute_script(
+                SELECT_REFRESHED_SCRIPT, select_id, previous_options or []
+            )
+        )
+    except WebDriverException:
+        return False  # Trang đang chuyển
+
+
+def drive_steps(steps, interval=DROPDOWN_POLL_INTERVAL):
+    """Chạy generator bước tới hết, ngủ `interval` giữa các lần yield.
+
+    Dùng cho chế độ một tab; chế độ nhiều tab tự xen kẽ các generator. Trả về giá trị
+    mà generator return.
+    """
+    while True:
+        try:
+            next(steps)
+        except StopIteration as finished:
+            return finished.value
+        time.sleep(interval)
+
+
+def fill_form_fields(
+    driver,
+    wait,
+    FORM_FIELD_IDS,
+    data,
+    process_id,
+    dropdown_timeout=DROPDOWN_WAIT_TIMEOUT,
+):
+    """Điền lần lượt các trường theo mapping (sales_date, session trước)."""
+    session_id = FORM_FIELD_IDS.get("session")
+    for key in form_field_order(FORM_FIELD_IDS):
+        element_id = FORM_FIELD_IDS.get(key)
+        if not element_id:
+            continue
+
+        try:
+            element = wait.until(EC.presence_of_element_located((By.ID, element_id)))
+            tag = element.tag_name.lower()
+            value = data.get(key)
+
+            if tag == "select":
+                if not value:
+                    continue
+
+                select = Select(element)
+                if key == "sales_date" and session_id:
+                    previous_session_options = mark_select_options(driver, session_id)
+
+                # <<< THAY ĐỔI QUAN TRỌNG BẮT ĐẦU TỪ ĐÂY >>>
+                # Nếu là dropdown 'session', tìm kiếm thông minh hơn
+                if key == "session":
+                    print(
+                        f"[{process_id}] Finding smart match for '{key}' with value '{value}'..."
+                    )
+                    found_option = False
+                    for option in select.options:
+                        # Kiểm tra xem option có chứa chuỗi thời gian mong muốn không
+                        if str(value) in option.text:
                             print(
-                                f"[{process_id}] WARNING: Could not find any option containing '{value}' for '{key}'."
+                                f"[{process_id}] Found match: '{option.text}'. Selecting..."
                             )
-                    else:
-                        # Giữ nguyên logic cũ cho các dropdown khác như 'sales_date'
+                            select.select_by_visible_text(option.text)
+                            found_option = True
+                            break  # Thoát khỏi vòng lặp khi đã tìm thấy
+                    if not found_option:
                         print(
-                            f"[{process_id}] Selecting '{value}' in dropdown '{key}'..."
+                            f"[{process_id}] WARNING: Could not find any option containing '{value}' for '{key}'."
                         )
-                        select.select_by_visible_text(str(value))
-                    # <<< KẾT THÚC THAY ĐỔI >>>
+                else:
+                    # Giữ nguyên logic cũ cho các dropdown khác như 'sales_date'
+                    print(f"[{process_id}] Selecting '{value}' in dropdown '{key}'...")
+                    select.select_by_visible_text(str(value))
+                # <<< KẾT THÚC THAY ĐỔI >>>
 
-                    # Kích hoạt sự kiện 'change' để website nhận diện
-                    driver.execute_script(
-                        "arguments[0].dispatchEvent(new Event('change'));", element
-                    )
-                    if key == "sales_date":
-                        time.sleep(1)
+                # Kích hoạt sự kiện 'change' để website nhận diện
+                driver.execute_script(
+                    "arguments[0].dispatchEvent(new Event('change'));", element
+                )
+                if key == "sales_date" and session_id:
+                    # Chờ 'session' được nạp lại theo ngày vừa chọn thay vì sleep cố định
+                    if not wait_for_dropdown_refresh(
+                        driver,
+                        session_id,
+                        previous_session_options,
+                        dropdown_timeout,
+                    ):
+                        print(
+                            f"[{process_id}] WARNING: 'session' options did not refresh within {dropdown_timeout}s."
+                        )
 
-                elif tag == "input":
-                    input_type = element.get_attribute("type").lower()
-                    if input_type in ("text", "number", "email", "tel", "password"):
-                        if value:
-                            print(
-                                f"[{process_id}] Filling text field '{key}' with '{value}'..."
-                            )
-                            element.clear()
-                            element.send_keys(str(value))
-                    elif input_type in ("checkbox", "radio"):
-                        # Chỉ click nếu là checkbox "đồng ý" hoặc có giá trị trong data
-                        if key == "agree_checkbox" or value:
-                            print(f"[{process_id}] Clicking checkbox/radio '{key}'...")
-                            driver.execute_script("arguments[0].click();", element)
-
-                elif tag == "textarea":
+            elif tag == "input":
+                input_type = element.get_attribute("type").lower()
+                if input_type in ("text", "number", "email", "tel", "password"):
                     if value:
-                        print(f"[{process_id}] Filling textarea '{key}'...")
+                        print(
+                            f"[{process_id}] Filling text field '{key}' with '{value}'..."
+                        )
                         element.clear()
                         element.send_keys(str(value))
+                elif input_type in ("checkbox", "radio"):
+                    # Chỉ click nếu là checkbox "đồng ý" hoặc có giá trị trong data
+                    if key == "agree_checkbox" or value:
+                        print(f"[{process_id}] Clicking checkbox/radio '{key}'...")
+                        driver.execute_script("arguments[0].click();", element)
 
-            except Exception as e:
-                print(
-                    f"[{process_id}] Error processing field '{key}' (ID: {element_id}): {e}"
+            elif tag == "textarea":
+                if value:
+                    print(f"[{process_id}] Filling textarea '{key}'...")
+                    element.clear()
+                    element.send_keys(str(value))
+
+        except Exception as e:
+            print(
+                f"[{process_id}] Error processing field '{key}' (ID: {element_id}): {e}"
+            )
+
+
+# --- ĐIỀN NHANH: MỘT LỆNH JAVASCRIPT CHO CẢ FORM ---
+
+# arguments: [fields, dropdownTimeoutMs, callback]. Trả về {key: trạng thái}.
+FAST_FILL_SCRIPT = """
+const [fields, dropdownTimeoutMs, done] = arguments;
+const report = {};
+
+const setNativeValue = (el, value) => {
+    // Dùng setter gốc để các framework (React, Vue...) nhận được giá trị mới
+    const proto = el instanceof HTMLTextAreaElement ? HTMLTextAreaElement.prototype
+        : el instanceof HTMLSelectElement ? HTMLSelectElement.prototype
+        : HTMLInputElement.prototype;
+    Object.getOwnPropertyDescriptor(proto, "value").set.call(el, value);
+};
+const fire = (el) => {
+    el.dispatchEvent(new Event("input", { bubbles: true }));
+    el.dispatchEvent(new Event("change", { bubbles: true }));
+};
+const findOption = (el, value, partial) => Array.from(el.options).find(
+    (o) => partial ? o.text.includes(value) : o.text.trim() === value.trim()
+);
+// Option hiện có của dropdown phụ thuộc được đánh dấu trước khi điền dropdown cha;
+// chỉ khi chúng bị thay bằng option mới thì danh sách mới là danh sách đã nạp lại
+const markStale = (field) => {
+    const el = document.getElementById(field.id);
+    if (el && el.options) Array.from(el.options).forEach((o) => { o.__staleOption = true; });
+};
+const refreshed = (field) => {
+    const el = document.getElementById(field.id);
+    return Boolean(el && el.options && el.options.length
+        && !Array.from(el.options).some((o) => o.__staleOption));
+};
+// Chờ dropdown nạp lại qua MutationObserver, tối đa timeoutMs, rồi mới tìm option
+const waitForOption = (field, timeoutMs) => new Promise((resolve) => {
+    if (refreshed(field)) return resolve();
+    const observer = new MutationObserver(() => {
+        if (refreshed(field)) finish();
+    });
+    const timer = setTimeout(() => finish(), timeoutMs);
+    const finish = () => {
+        observer.disconnect();
+        clearTimeout(timer);
+        resolve();
+    };
+    observer.observe(document.body, { childList: true, subtree: true });
+});
+
+const fillOne = (field) => {
+    const el = document.getElementById(field.id);
+    if (!el) return "missing";
+    const tag = el.tagName.toLowerCase();
+    if (tag === "select") {
+        if (!field.value) return "skipped";
+        const option = findOption(el, field.value, field.partial);
+        if (!option) return "no-option";
+        setNativeValue(el, option.value);
+        fire(el);
+        return "ok";
+    }
+    if (tag === "textarea") {
+        if (!field.value) return "skipped";
+        setNativeValue(el, field.value);
+        fire(el);
+        return "ok";
+    }
+    if (tag === "input") {
+        const type = (el.type || "text").toLowerCase();
+        if (type === "checkbox" || type === "radio") {
+            if (!(field.force || field.value)) return "skipped";
+            if (!el.checked) el.click();
+            return el.checked ? "ok" : "unchecked";
+        }
+        if (["text", "number", "email", "tel", "password"].includes(type)) {
+            if (!field.value) return "skipped";
+            setNativeValue(el, field.value);
+            fire(el);
+            return "ok";
+        }
+    }
+    return "unsupported";
+};
+
+(async () => {
+    try {
+        fields.filter((f) => f.waitForOptions && f.value).forEach(markStale);
+        for (const field of fields) {
+            if (field.waitForOptions && field.value) {
+                await waitForOption(field, dropdownTimeoutMs);
+            }
+            report[field.key] = fillOne(field);
+        }
+    } catch (e) {
+        report.__error__ = String(e);
+    }
+    done(report);
+})();
+"""
+
+
+def build_fast_fill_fields(FORM_FIELD_IDS, data):
+    """Biên dịch mapping + dữ liệu một dòng thành danh sách trường cho FAST_FILL_SCRIPT."""
+    fields = []
+    for key in form_field_order(FORM_FIELD_IDS):
+        element_id = FORM_FIELD_IDS.get(key)
+        if not element_id:
+            continue
+        value = data.get(key)
+        fields.append(
+            {
+                "key": key,
+                "id": element_id,
+                "value": str(value) if value not in (None, "") else None,
+                # 'session' khớp theo chuỗi con và chờ được nạp lại sau khi chọn ngày
+                "partial": key == "session",
+                "waitForOptions": key == "session"
+                and bool(FORM_FIELD_IDS.get("sales_date")),
+                "force": key == "agree_checkbox",
+            }
+        )
+    return fields
+
+
+def fast_fill_form(
+    driver,
+    FORM_FIELD_IDS,
+    data,
+    process_id,
+    dropdown_timeout=DROPDOWN_WAIT_TIMEOUT,
+):
+    """Điền cả form bằng một lần execute_async_script. Trả về báo cáo {key: trạng thái}."""
+    fields = build_fast_fill_fields(FORM_FIELD_IDS, data)
+    driver.set_script_timeout(dropdown_timeout + 5)
+    report = driver.execute_async_script(
+        FAST_FILL_SCRIPT, fields, int(dropdown_timeout * 1000)
+    )
+    problems = {k: v for k, v in report.items() if v not in ("ok", "skipped")}
+    print(
+        f"[{process_id}] Fast fill: {sum(v == 'ok' for v in report.values())}/{len(fields)} fields OK"
+        + (f", problems: {problems}" if problems else "")
+    )
+    return report
+
+
+def fill_form(
+    driver,
+    wait,
+    FORM_FIELD_IDS,
+    data,
+    process_id,
+    fast_fill=False,
+    dropdown_timeout=DROPDOWN_WAIT_TIMEOUT,
+):
+    """Điền form bằng chế độ nhanh nếu bật, quay về điền từng trường khi script lỗi."""
+    if fast_fill:
+        try:
+            report = fast_fill_form(
+                driver, FORM_FIELD_IDS, data, process_id, dropdown_timeout
+            )
+            if "__error__" not in report:
+                return report
+            print(f"[{process_id}] Fast fill script error: {report['__error__']}")
+        except Exception as e:
+            print(f"[{process_id}] Fast fill failed: {e}")
+        print(f"[{process_id}] Falling back to field-by-field filling...")
+    fill_form_fields(driver, wait, FORM_FIELD_IDS, data, process_id, dropdown_timeout)
+    return None
+
+
+CAPTCHA_IMAGE_LOAD_TIMEOUT = 5
+CAPTCHA_IMAGE_LOADED_SCRIPT = """
+const img = arguments[0];
+return img.tagName !== "IMG" || (img.complete && img.naturalWidth > 0);
+"""
+
+
+# Lấy bytes ảnh ngay trong trang: data URI dùng luôn, ảnh cùng origin vẽ lại
+# qua canvas (không tải lại). Ảnh khác origin làm canvas bị "taint" thì trả null
+# để chụp màn hình phần tử. Chạy nền trong trang nên có thể khởi động ngay khi
+# trang tải xong, song song với điền form.
+CAPTCHA_CAPTURE_START_SCRIPT = """
+window.__captchaCapture = window.__captchaCapture || (async (selector, timeoutMs) => {
+    const deadline = Date.now() + timeoutMs;
+    const sleep = ms => new Promise(resolve => setTimeout(resolve, ms));
+    const ready = el => el && (el.tagName !== 'IMG' || (el.complete && el.naturalWidth > 0));
+    let el = document.querySelector(selector);
+    while (!ready(el) && Date.now() < deadline) {
+        await sleep(25);
+        el = document.querySelector(selector);
+    }
+    if (!ready(el)) return null;
+    if (el.tagName === 'CANVAS') return el.toDataURL('image/png');
+    if (el.tagName !== 'IMG') return null;
+    const src = el.currentSrc || el.src;
+    if (/^data:image\/(png|jpe?g|gif|webp)[;,]/i.test(src)) return src;
+    const canvas = document.createElement('canvas');
+    canvas.width = el.naturalWidth;
+    canvas.height = el.naturalHeight;
+    canvas.getContext('2d').drawImage(el, 0, 0);
+    return canvas.toDataURL('image/png');
+})(arguments[0], arguments[1]).catch(() => null).then(result => {
+    window.__captchaCaptureReady = true;
+    return result;
+});
+"""
+CAPTCHA_CAPTURE_COLLECT_SCRIPT = (
+    CAPTCHA_CAPTURE_START_SCRIPT
+    + "window.__captchaCapture.then(arguments[arguments.length - 1]);"
+)
+
+
+def decode_data_url(data_url):
+    header, _, payload = data_url.partition(",")
+    if ";base64" in header:
+        return base64.b64decode(payload)
+    return unquote_to_bytes(payload)
+
+
+def start_captcha_capture(driver, captcha_image_selector):
+    """Bắt đầu lấy ảnh CAPTCHA trong trang mà không chờ kết quả."""
+    try:
+        driver.execute_script(
+            CAPTCHA_CAPTURE_START_SCRIPT,
+            captcha_image_selector,
+            CAPTCHA_IMAGE_LOAD_TIMEOUT * 1000,
+        )
+    except WebDriverException:
+        pass
+
+
+def capture_captcha_image(driver, wait, captcha_image_selector):
+    """Lấy bytes ảnh CAPTCHA, ưu tiên đọc thẳng nguồn ảnh trong trang.
+
+    Chỉ chụp màn hình phần tử khi không đọc được nguồn (ảnh khác origin...).
+    Với pageLoadStrategy=eager trang trả về trước khi ảnh tải xong nên phải
+    chờ ảnh hoàn tất trước khi chụp.
+    """
+    try:
+        data_url = driver.execute_async_script(
+            CAPTCHA_CAPTURE_COLLECT_SCRIPT,
+            captcha_image_selector,
+            CAPTCHA_IMAGE_LOAD_TIMEOUT * 1000,
+        )
+        if data_url:
+            return decode_data_url(data_url)
+    except WebDriverException:
+        pass
+    element = wait.until(
+        EC.visibility_of_element_located((By.CSS_SELECTOR, captcha_image_selector))
+    )
+    try:
+        WebDriverWait(driver, CAPTCHA_IMAGE_LOAD_TIMEOUT).until(
+            lambda d: d.execute_script(CAPTCHA_IMAGE_LOADED_SCRIPT, element)
+        )
+    except TimeoutException:
+        pass
+    return element.screenshot_as_png
+
+
+# --- ĐIỀU PHỐI API KEY: CHIA TẢI, THEO DÕI LỖI, NGẮT MẠCH ---
+KEY_USAGE_FILE = "api_key_usage.json"
+KEY_STRATEGIES = ("least_loaded", "round_robin")
+# Số lỗi liên tiếp trước khi ngắt mạch một key
+KEY_FAILURE_THRESHOLD = 3
+# Thời gian ngắt mạch trước khi cho một request thử lại (half-open)
+KEY_OPEN_SECONDS = 30
+KEY_RATE_LIMIT_OPEN_SECONDS = 60
+RATE_LIMIT_MARKERS = (
+    "429",
+    "resource_exhausted",
+    "resource has been exhausted",
+    "quota",
+)
+
+
+def is_rate_limit_error(error):
+    return any(marker in str(error or "").lower() for marker in RATE_LIMIT_MARKERS)
+
+
+def api_key_id(api_key):
+    """Định danh key để ghi ra đĩa mà không lưu chính key."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+class ApiKeyScheduler:
+    """Chọn API key cho mỗi lần gọi thay vì luôn thử từ key #1.
+
+    Chia tải theo key ít request đang chạy nhất (hoặc xoay vòng), đếm lỗi và
+    429 theo key, ngắt mạch key lỗi liên tục rồi cho thử lại một request sau
+    thời gian chờ. Số lượt dùng trong ngày được lưu lại giữa các lần chạy.
+    """
+
+    def __init__(self, api_keys, strategy="least_loaded", usage_path=KEY_USAGE_FILE):
+        self.api_keys = list(dict.fromkeys(api_keys))
+        self.strategy = strategy if strategy in KEY_STRATEGIES else KEY_STRATEGIES[0]
+        self.usage_path = usage_path
+        self._lock = threading.Lock()
+        self._next_index = 0
+        self._state = {
+            key: {
+                "in_flight": 0,
+                "successes": 0,
+                "errors": 0,
+                "rate_limited": 0,
+                "consecutive_failures": 0,
+                "open_until": 0.0,
+                "probing": False,
+            }
+            for key in self.api_keys
+        }
+        self._today, self._usage = self._load_usage()
+
+    def _load_usage(self):
+        today = datetime.now().date().isoformat()
+        try:
+            with open(self.usage_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        return today, (data.get("usage", {}) if data.get("date") == today else {})
+
+    def save(self):
+        with self._lock:
+            payload = {"date": self._today, "usage": dict(self._usage)}
+        tmp_path = f"{self.usage_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(payload, f, indent=2)
+        os.replace(tmp_path, self.usage_path)
+
+    def _usable(self, api_key, now):
+        state = self._state[api_key]
+        if not state["open_until"]:
+            return True
+        # Mạch đang mở: chỉ cho đúng một request thử khi đã hết thời gian chờ
+        return now >= state["open_until"] and not state["probing"]
+
+    def acquire(self, exclude=()):
+        """Lấy key tiếp theo nên dùng, None nếu không còn key khả dụng."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                key
+                for key in self.api_keys
+                if key not in exclude and self._usable(key, now)
+            ]
+            if not candidates:
+                return None
+            if self.strategy == "round_robin":
+                ordered = (
+                    self.api_keys[self._next_index :]
+                    + self.api_keys[: self._next_index]
+                )
+                api_key = next(key for key in ordered if key in candidates)
+                self._next_index = (self.api_keys.index(api_key) + 1) % len(
+                    self.api_keys
                 )
+            else:
+                api_key = min(
+                    candidates,
+                    key=lambda k: (
+                        self._state[k]["in_flight"],
+                        self._usage.get(api_key_id(k), 0),
+                    ),
+                )
+            state = self._state[api_key]
+            if state["open_until"]:
+                state["probing"] = True
+            state["in_flight"] += 1
+            key_id = api_key_id(api_key)
+            self._usage[key_id] = self._usage.get(key_id, 0) + 1
+            return api_key
 
-        # --- XỬ LÝ CAPTCHA ĐỘNG ---
-        captcha_input_id = FORM_FIELD_IDS.get("captcha")
-        captcha_image_selector = FORM_FIELD_IDS.get("captcha_image_selector")
+    def release(self, api_key, ok, error=None):
+        with self._lock:
+            state = self._state[api_key]
+            state["in_flight"] -= 1
+            state["probing"] = False
+            if ok:
+                state["successes"] += 1
+                state["consecutive_failures"] = 0
+                state["open_until"] = 0.0
+                return
+            state["errors"] += 1
+            state["consecutive_failures"] += 1
+            now = time.monotonic()
+            if is_rate_limit_error(error):
+                state["rate_limited"] += 1
+                state["open_until"] = now + KEY_RATE_LIMIT_OPEN_SECONDS
+            elif (
+                state["open_until"]
+                or state["consecutive_failures"] >= KEY_FAILURE_THRESHOLD
+            ):
+                state["open_until"] = now + KEY_OPEN_SECONDS
 
-        if use_ai_captcha and captcha_input_id and captcha_image_selector:
-            print(f"[{process_id}] AI solving CAPTCHA for '{name_for_log}'...")
+    def cancel(self, api_key):
+        """Trả lại key đã acquire() nhưng chưa dùng: không tính là lỗi hay lượt dùng."""
+        with self._lock:
+            state = self._state[api_key]
+            state["in_flight"] -= 1
+            state["probing"] = False
+            key_id = api_key_id(api_key)
+            self._usage[key_id] = max(0, self._usage.get(key_id, 0) - 1)
+
+    def run_with_key(self, func, api_key):
+        """Gọi func(api_key) với key đã acquire() rồi trả key lại."""
+        try:
+            result, error = func(api_key)
+        except Exception as e:
+            result, error = None, str(e)
+        self.release(api_key, bool(result), error)
+        return result, error
+
+    def call(self, func, exclude=()):
+        """Gọi func(api_key) -> (kết quả, lỗi), chuyển key khác khi thất bại."""
+        tried = set(exclude)
+        last_error = "Không còn API key khả dụng (đang ngắt mạch)."
+        while True:
+            api_key = self.acquire(exclude=tried)
+            if api_key is None:
+                return None, last_error
+            tried.add(api_key)
+            result, error = self.run_with_key(func, api_key)
+            if result:
+                return result, None
+            last_error = error
+
+    def report(self):
+        lines = []
+        with self._lock:
+            now = time.monotonic()
+            for i, api_key in enumerate(self.api_keys):
+                state = self._state[api_key]
+                if not state["open_until"]:
+                    circuit = "đóng"
+                elif now < state["open_until"]:
+                    circuit = f"mở ({state['open_until'] - now:.0f}s)"
+                else:
+                    circuit = "nửa mở"
+                lines.append(
+                    f"Key #{i+1} (...{api_key[-4:]}): {state['successes']} OK, "
+                    f"{state['errors']} lỗi ({state['rate_limited']} lần 429), "
+                    f"hôm nay {self._usage.get(api_key_id(api_key), 0)} lượt, "
+                    f"mạch {circuit}"
+                )
+        return lines
+
+
+# --- NHẬN DẠNG CAPTCHA CỤC BỘ (NUMPY, KHÔNG CẦN MẠNG) ---
+LOCAL_CAPTCHA_MODEL_FILE = "captcha_model.npz"
+LOCAL_CAPTCHA_GLYPH_SHAPE = (24, 16)
+LOCAL_CAPTCHA_MIN_CONFIDENCE = 0.6
+LOCAL_CAPTCHA_TRAIN_EPOCHS = 40
+# Bỏ các ký tự dễ nhầm (I/1, O/0) khi sinh bộ CAPTCHA tổng hợp
+LOCAL_CAPTCHA_CHARSET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+# Cột có ít điểm mực hơn tỉ lệ này (so với chiều cao ảnh) coi là khoảng trống
+SEGMENT_COLUMN_INK_RATIO = 0.06
+PIL_MISSING_ERROR = "Cần cài đặt 'Pillow' để dùng bộ giải CAPTCHA cục bộ."
+
+
+def decode_captcha_image(image_bytes):
+    """Bytes PNG/JPEG -> mảng xám float32 trong [0, 1]."""
+    if not PIL_AVAILABLE:
+        raise RuntimeError(PIL_MISSING_ERROR)
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return np.asarray(image.convert("L"), dtype=np.float32) / 255.0
+
+
+def binarize_captcha(gray):
+    """Tách chữ khỏi nền bằng ngưỡng Otsu rồi lọc trung vị 3x3 để bỏ nét nhiễu mảnh."""
+    hist = np.histogram(gray, bins=256, range=(0.0, 1.0))[0].astype(np.float64)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    mass_bg = np.cumsum(hist * np.arange(256))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (
+            weight_bg
+            * weight_fg
+            * (mass_bg / weight_bg - (mass_bg[-1] - mass_bg) / weight_fg) ** 2
+        )
+    threshold = (int(np.argmax(np.nan_to_num(between))) + 1) / 256
+    ink = gray < threshold
+    if ink.mean() > 0.5:
+        ink = ~ink
+    padded = np.pad(ink, 1).astype(np.uint8)
+    height, width = ink.shape
+    neighbours = sum(
+        padded[dy : dy + height, dx : dx + width] for dy in range(3) for dx in range(3)
+    )
+    return neighbours >= 5
+
+
+def _normalize_glyph(mask, shape=LOCAL_CAPTCHA_GLYPH_SHAPE, oversample=4):
+    """Đệm ký tự về đúng tỉ lệ khung rồi thu nhỏ theo trung bình vùng."""
+    target_h, target_w = shape
+    height, width = mask.shape
+    if height * target_w > width * target_h:
+        pad = (height * target_w // target_h - width) // 2
+        mask = np.pad(mask, ((0, 0), (pad, pad)))
+    else:
+        pad = (width * target_h // target_w - height) // 2
+        mask = np.pad(mask, ((pad, pad), (0, 0)))
+    rows = (np.arange(target_h * oversample) + 0.5) * mask.shape[0]
+    cols = (np.arange(target_w * oversample) + 0.5) * mask.shape[1]
+    sampled = mask[
+        np.ix_(
+            (rows / (target_h * oversample)).astype(int),
+            (cols / (target_w * oversample)).astype(int),
+        )
+    ].astype(np.float32)
+    return sampled.reshape(target_h, oversample, target_w, oversample).mean(axis=(1, 3))
+
+
+def segment_captcha(ink, expected_length=None):
+    """Cắt ảnh nhị phân thành từng ký tự theo hình chiếu cột.
+
+    Có expected_length thì tách đoạn rộng nhất / gộp đoạn hẹp nhất cho tới khi
+    đủ số ký tự. Trả về danh sách ảnh ký tự đã chuẩn hóa.
+    """
+    column_ink = ink.sum(axis=0)
+    filled = column_ink > max(1, SEGMENT_COLUMN_INK_RATIO * ink.shape[0])
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], filled.astype(int), [0]))))
+    spans = [[s, e] for s, e in zip(edges[::2], edges[1::2]) if e - s >= 2]
+    if expected_length:
+        while spans and len(spans) < expected_length:
+            i = max(range(len(spans)), key=lambda k: spans[k][1] - spans[k][0])
+            start, end = spans[i]
+            if end - start < 4:
+                break
+            # Cắt tại cột ít mực nhất trong nửa giữa của đoạn
+            low, high = start + (end - start) // 4, end - (end - start) // 4
+            cut = low + int(np.argmin(column_ink[low:high]))
+            spans[i : i + 1] = [[start, cut], [cut, end]]
+        while len(spans) > expected_length:
+            i = min(range(len(spans)), key=lambda k: spans[k][1] - spans[k][0])
+            if i == 0:
+                j = 1
+            elif i == len(spans) - 1:
+                j = i - 1
+            else:
+                gap_left = spans[i][0] - spans[i - 1][1]
+                gap_right = spans[i + 1][0] - spans[i][1]
+                j = i - 1 if gap_left <= gap_right else i + 1
+            a, b = sorted((i, j))
+            spans[a : b + 1] = [[spans[a][0], spans[b][1]]]
+    glyphs = []
+    for start, end in spans:
+        block = ink[:, start:end]
+        rows = np.flatnonzero(block.any(axis=1))
+        glyphs.append(_normalize_glyph(block[rows[0] : rows[-1] + 1]))
+    return glyphs
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class LocalCaptchaModel:
+    """Phân loại từng ký tự bằng hồi quy softmax trên ảnh ký tự đã chuẩn hóa."""
+
+    def __init__(self, weights, bias, classes, expected_length):
+        self.weights = weights
+        self.bias = bias
+        self.classes = list(classes)
+        self.expected_length = int(expected_length)
+
+    @staticmethod
+    def glyphs_for(image_bytes, expected_length):
+        ink = binarize_captcha(decode_captcha_image(image_bytes))
+        return segment_captcha(ink, expected_length)
+
+    @classmethod
+    def train(
+        cls,
+        samples,
+        epochs=LOCAL_CAPTCHA_TRAIN_EPOCHS,
+        learning_rate=0.5,
+        batch_size=64,
+        seed=0,
+    ):
+        """Huấn luyện từ [(image_bytes, nhãn)]. Trả về (model, số ảnh bị bỏ qua).
+
+        Ảnh không tách được đúng số ký tự của nhãn bị bỏ qua.
+        """
+        lengths = [len(label) for _, label in samples]
+        expected_length = max(set(lengths), key=lengths.count)
+        features, targets, skipped = [], [], 0
+        for image_bytes, label in samples:
+            glyphs = cls.glyphs_for(image_bytes, len(label))
+            if len(glyphs) != len(label):
+                skipped += 1
+                continue
+            features.extend(glyph.ravel() for glyph in glyphs)
+            targets.extend(label)
+        if not features:
+            raise ValueError("Không tách được ký tự nào từ dữ liệu huấn luyện.")
+
+        classes = sorted(set(targets))
+        x = np.asarray(features, dtype=np.float32)
+        y = np.eye(len(classes), dtype=np.float32)[[classes.index(t) for t in targets]]
+        weights = np.zeros((x.shape[1], len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(x))
+            for i in range(0, len(x), batch_size):
+                batch = order[i : i + batch_size]
+                grad = (_softmax(x[batch] @ weights + bias) - y[batch]) / len(batch)
+                weights -= learning_rate * (x[batch].T @ grad)
+                bias -= learning_rate * grad.sum(axis=0)
+        return cls(weights, bias, classes, expected_length), skipped
+
+    def predict(self, image_bytes):
+        """Trả về (text, độ tin cậy = xác suất thấp nhất trong các ký tự)."""
+        glyphs = self.glyphs_for(image_bytes, self.expected_length)
+        if not glyphs:
+            return "", 0.0
+        probs = _softmax(
+            np.stack([glyph.ravel() for glyph in glyphs]) @ self.weights + self.bias
+        )
+        text = "".join(self.classes[i] for i in probs.argmax(axis=1))
+        return text, float(probs.max(axis=1).min())
+
+    def save(self, path=LOCAL_CAPTCHA_MODEL_FILE):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                weights=self.weights,
+                bias=self.bias,
+                classes=np.array(self.classes),
+                expected_length=self.expected_length,
+            )
+
+    @classmethod
+    def load(cls, path=LOCAL_CAPTCHA_MODEL_FILE):
+        with np.load(path) as data:
+            return cls(
+                data["weights"],
+                data["bias"],
+                [str(c) for c in data["classes"]],
+                data["expected_length"],
+            )
+
+
+def _captcha_font(size=30):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow < 10.1 chỉ có font bitmap cỡ cố định
+        return ImageFont.load_default()
+
+
+def render_captcha(text, rng, size=(170, 50)):
+    """Vẽ một CAPTCHA tổng hợp: ký tự lệch dòng, đường nhiễu và chấm nhiễu."""
+    if not PIL_AVAILABLE:
+        raise RuntimeError(PIL_MISSING_ERROR)
+    image = Image.new("L", size, color=int(rng.integers(200, 256)))
+    draw = ImageDraw.Draw(image)
+    font = _captcha_font()
+    x = int(rng.integers(6, 14))
+    for char in text:
+        draw.text(
+            (x, int(rng.integers(2, 12))),
+            char,
+            fill=int(rng.integers(0, 90)),
+            font=font,
+        )
+        x += int(draw.textlength(char, font=font)) + int(rng.integers(3, 7))
+    for _ in range(2):
+        points = [
+            (0, int(rng.integers(0, size[1]))),
+            (size[0], int(rng.integers(0, size[1]))),
+        ]
+        draw.line(points, fill=int(rng.integers(60, 160)), width=1)
+    for _ in range(size[0] * size[1] // 40):
+        draw.point(
+            (int(rng.integers(0, size[0])), int(rng.integers(0, size[1]))),
+            fill=int(rng.integers(0, 256)),
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def generate_captcha_corpus(
+    output_dir, count, length=5, charset=LOCAL_CAPTCHA_CHARSET, seed=0
+):
+    """Sinh count ảnh CAPTCHA có nhãn, tên file dạng <nhãn>_<số thứ tự>.png."""
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(count):
+        text = "".join(rng.choice(list(charset), length))
+        with open(os.path.join(output_dir, f"{text}_{i:05d}.png"), "wb") as f:
+            f.write(render_captcha(text, rng))
+    return count
+
+
+def load_labelled_captchas(directory):
+    """Đọc [(image_bytes, nhãn)] từ thư mục ảnh; nhãn là phần tên file trước '_'."""
+    samples = []
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() not in (".png", ".jpg", ".jpeg"):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            samples.append((f.read(), stem.split("_")[0]))
+    return samples
+
+
+def benchmark_captcha_backend(backend, samples):
+    """Đo độ chính xác và thời gian giải của một bộ giải trên bộ ảnh có nhãn."""
+    correct, answered, latencies = 0, 0, []
+    for image_bytes, label in samples:
+        started = time.perf_counter()
+        text, _ = backend.solve(image_bytes)
+        latencies.append(time.perf_counter() - started)
+        answered += bool(text)
+        correct += bool(text) and text.upper() == label.upper()
+    latencies.sort()
+    total = len(samples)
+    return {
+        "total": total,
+        "answered": answered,
+        "correct": correct,
+        "accuracy": correct / total if total else 0.0,
+        "mean_ms": 1000 * sum(latencies) / total if total else 0.0,
+        "p95_ms": 1000 * latencies[int(total * 0.95) - 1] if total else 0.0,
+    }
+
+
+# --- BỘ GIẢI CAPTCHA CẮM RÚT ĐƯỢC: GEMINI, CỤC BỘ, ... ---
+CAPTCHA_LATENCY_WINDOW = 500
+# Số luồng gửi request song song khi bật gửi đồng thời (hedge) tới nhiều key
+CAPTCHA_HEDGE_WORKERS = 64
+
+
+def latency_summary(latencies):
+    """'n lần, TB, p95, p99' cho một dãy thời gian (giây)."""
+    latencies = sorted(latencies)
+    p95, p99 = (
+        latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+        for q in (0.95, 0.99)
+    )
+    return (
+        f"{len(latencies)} lần, TB {sum(latencies) / len(latencies):.2f}s, "
+        f"p95 {p95:.2f}s, p99 {p99:.2f}s"
+    )
+
+
+class CaptchaSolverBackend:
+    """Giao diện chung của một bộ giải: solve(image_bytes) -> (text, lỗi)."""
+
+    name = "base"
+
+    def solve(self, image_bytes):
+        raise NotImplementedError
+
+    def report(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class LocalCaptchaBackend(CaptchaSolverBackend):
+    """Giải bằng LocalCaptchaModel, từ chối khi độ tin cậy thấp để bộ sau giải."""
+
+    name = "local"
+
+    def __init__(self, model, min_confidence=LOCAL_CAPTCHA_MIN_CONFIDENCE):
+        self.model = model
+        self.min_confidence = min_confidence
+
+    def solve(self, image_bytes):
+        if not PIL_AVAILABLE:
+            return None, PIL_MISSING_ERROR
+        try:
+            text, confidence = self.model.predict(image_bytes)
+        except Exception as e:
+            return None, str(e)
+        if not text:
+            return None, "Không tách được ký tự."
+        if confidence < self.min_confidence:
+            return None, f"Độ tin cậy thấp ({confidence:.2f}) cho '{text}'."
+        return text, None
+
+
+class GeminiCaptchaBackend(CaptchaSolverBackend):
+    """Giữ client Gemini "nóng" cho từng API key, key do ApiKeyScheduler chọn.
+
+    Không tốn công dựng client và bắt tay TLS lại cho mỗi CAPTCHA. Với hedge > 1
+    cùng một ảnh được gửi tới nhiều key một lúc.
+    """
+
+    name = "gemini"
+
+    def __init__(self, key_scheduler, hedge=1):
+        self.key_scheduler = key_scheduler
+        self.api_keys = key_scheduler.api_keys
+        self.hedge = max(1, hedge)
+        self._hedge_executor = (
+            ThreadPoolExecutor(max_workers=CAPTCHA_HEDGE_WORKERS)
+            if self.hedge > 1
+            else None
+        )
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._stats = {
+            key: {"errors": 0, "latencies": deque(maxlen=CAPTCHA_LATENCY_WINDOW)}
+            for key in self.api_keys
+        }
+        self._stats_lock = threading.Lock()
+
+    def close(self):
+        if self._hedge_executor:
+            self._hedge_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _client(self, api_key):
+        with self._clients_lock:
+            if api_key not in self._clients:
+                self._clients[api_key] = create_captcha_llm(api_key)
+            return self._clients[api_key]
+
+    def solve(self, image_bytes):
+        solve_func = lambda api_key: self._solve_with_key(api_key, image_bytes)
+        if self.hedge > 1:
+            return self._solve_hedged(solve_func)
+        return self.key_scheduler.call(solve_func)
+
+    def _solve_hedged(self, solve_func):
+        """Gửi cùng ảnh tới nhiều key một lúc, lấy đáp án hợp lệ về đầu tiên.
+
+        Request về sau vẫn chạy nốt trong nền (không hủy được lệnh HTTP đang
+        gửi) nhưng kết quả bị bỏ qua; key của nó được trả lại khi xong.
+        """
+        api_keys = []
+        while len(api_keys) < self.hedge:
+            api_key = self.key_scheduler.acquire(exclude=api_keys)
+            if api_key is None:
+                break
+            api_keys.append(api_key)
+        keys_by_future = {
+            self._hedge_executor.submit(
+                self.key_scheduler.run_with_key, solve_func, api_key
+            ): api_key
+            for api_key in api_keys
+        }
+        pending = set(keys_by_future)
+        while pending:
+            done, pending = wait_futures(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                text, err = future.result()
+                if text:
+                    for loser in pending:
+                        # Request còn nằm trong hàng đợi thì không bao giờ chạy
+                        # run_with_key: phải tự trả key, nếu không key bị giữ mãi
+                        if loser.cancel():
+                            self.key_scheduler.cancel(keys_by_future[loser])
+                    return text, None
+        # Mọi request song song đều hỏng: thử tuần tự các key còn lại
+        return self.key_scheduler.call(solve_func, exclude=api_keys)
+
+    def _solve_with_key(self, api_key, image_bytes):
+        started = time.perf_counter()
+        try:
+            llm = self._client(api_key)
+        except Exception as e:
+            text, err = None, str(e)
+        else:
+            text, err = solve_captcha_with_gemini(api_key, image_bytes, llm)
+        self._record(api_key, bool(text), started)
+        return text, err
+
+    def _record(self, api_key, ok, started):
+        """Ghi thời gian của một request thành công, hoặc một lỗi, cho key."""
+        with self._stats_lock:
+            if ok:
+                self._stats[api_key]["latencies"].append(time.perf_counter() - started)
+            else:
+                self._stats[api_key]["errors"] += 1
+
+    def report(self):
+        """Mỗi key một dòng: số lần giải, thời gian trung bình / p95, số lỗi."""
+        lines = []
+        with self._stats_lock:
+            for i, api_key in enumerate(self.api_keys):
+                stats = self._stats[api_key]
+                timing = (
+                    latency_summary(stats["latencies"])
+                    if stats["latencies"]
+                    else "chưa giải lần nào"
+                )
+                lines.append(
+                    f"Key #{i+1} (...{api_key[-4:]}): {timing}, {stats['errors']} lỗi"
+                )
+        return lines
+
+
+# --- GỘP CAPTCHA THÀNH LÔ: MỘT REQUEST NHIỀU ẢNH ---
+CAPTCHA_BATCH_MIN_WINDOW = 0.05
+CAPTCHA_BATCH_MAX_WINDOW = 0.15
+CAPTCHA_BATCH_MAX_SIZE = 8
+# Thời gian tối đa một worker chờ đáp án từ lô (gồm cả lần gửi riêng dự phòng)
+CAPTCHA_BATCH_SOLVE_TIMEOUT = 60
+
+
+class BatchingGeminiCaptchaBackend(GeminiCaptchaBackend):
+    """Gom các ảnh tới trong một cửa sổ ngắn và gửi chung một request Gemini.
+
+    Nhiều worker cùng tới bước CAPTCHA thì số request giảm mạnh, đỡ chạm giới
+    hạn request/phút của mỗi key. Cửa sổ tự co giãn trong khoảng 50-150 ms:
+    lô lưng chừng thì chờ lâu hơn để gom thêm, lô chỉ một ảnh hoặc đầy ngay
+    thì rút ngắn. Ảnh không có đáp án trong lô được gửi riêng như thường.
+    """
+
+    name = "gemini-batch"
+
+    def __init__(self, key_scheduler, hedge=1, max_batch=CAPTCHA_BATCH_MAX_SIZE):
+        super().__init__(key_scheduler, hedge)
+        self.max_batch = max_batch
+        self.window = CAPTCHA_BATCH_MIN_WINDOW
+        self._queue = queue.Queue()
+        self._batch_executor = ThreadPoolExecutor(max_workers=CAPTCHA_HEDGE_WORKERS)
+        self._batch_sizes = deque(maxlen=CAPTCHA_LATENCY_WINDOW)
+        self._single_fallbacks = 0
+        self._pending = set()
+        self._closed = False
+        self._collector = threading.Thread(target=self._collect_loop, daemon=True)
+        self._collector.start()
+
+    def solve(self, image_bytes, timeout=CAPTCHA_BATCH_SOLVE_TIMEOUT):
+        future = Future()
+        with self._stats_lock:
+            if self._closed:
+                return None, "Bộ giải CAPTCHA đã đóng"
+            self._pending.add(future)
+        future.add_done_callback(self._forget)
+        self._queue.put((image_bytes, future))
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            self._resolve(future, (None, f"Quá {timeout}s chưa có đáp án CAPTCHA"))
+            return future.result()
+
+    def close(self):
+        """Dừng bộ gom, rồi trả lỗi cho mọi ảnh còn chờ để không worker nào bị treo."""
+        with self._stats_lock:
+            self._closed = True
+        self._queue.put(None)
+        self._collector.join(timeout=CAPTCHA_BATCH_MAX_WINDOW * 2)
+        self._batch_executor.shutdown(wait=False, cancel_futures=True)
+        while True:
             try:
-                captcha_img_element = wait.until(
-                    EC.visibility_of_element_located(
-                        (By.CSS_SELECTOR, captcha_image_selector)
-                    )
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._resolve(item[1], (None, "Bộ giải CAPTCHA đã đóng"))
+        with self._stats_lock:
+            pending = list(self._pending)
+        for future in pending:
+            self._resolve(future, (None, "Bộ giải CAPTCHA đã đóng"))
+        super().close()
+
+    def _forget(self, future):
+        with self._stats_lock:
+            self._pending.discard(future)
+
+    @staticmethod
+    def _resolve(future, result):
+        """Đặt kết quả nếu future chưa có (đáp án về muộn sau timeout thì bỏ qua)."""
+        try:
+            future.set_result(result)
+        except InvalidStateError:
+            pass
+
+    def _submit(self, func, *args, futures):
+        try:
+            self._batch_executor.submit(func, *args)
+        except RuntimeError:  # Executor đã shutdown khi đang đóng
+            for future in futures:
+                self._resolve(future, (None, "Bộ giải CAPTCHA đã đóng"))
+
+    def _collect_loop(self):
+        closing = False
+        while not closing:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            self._adapt_window(len(batch))
+            self._submit(
+                self._solve_batch, batch, futures=[future for _, future in batch]
+            )
+
+    def _adapt_window(self, batch_size):
+        if batch_size == 1 or batch_size >= self.max_batch:
+            self.window = max(CAPTCHA_BATCH_MIN_WINDOW, self.window * 0.8)
+        else:
+            self.window = min(CAPTCHA_BATCH_MAX_WINDOW, self.window * 1.25)
+
+    def _solve_batch(self, batch):
+        with self._stats_lock:
+            self._batch_sizes.append(len(batch))
+        answers = {}
+        if len(batch) > 1:
+            images = [image_bytes for image_bytes, _ in batch]
+            try:
+                answers, _ = self.key_scheduler.call(
+                    lambda api_key: self._solve_batch_with_key(api_key, images)
                 )
-                image_bytes = captcha_img_element.screenshot_as_png
+            except Exception:
+                answers = {}  # Gửi riêng từng ảnh bên dưới
+        for i, (image_bytes, future) in enumerate(batch):
+            if future.done():
+                continue  # Đã hết thời gian chờ hoặc bộ giải đã đóng
+            if answers and answers.get(i):
+                self._resolve(future, (answers[i], None))
+                continue
+            if len(batch) > 1:
+                with self._stats_lock:
+                    self._single_fallbacks += 1
+            self._submit(self._solve_single, image_bytes, future, futures=[future])
 
-                captcha_text, last_error = None, "No API keys provided."
-                for i, api_key in enumerate(api_keys):
-                    print(f"[{process_id}] Attempting with key #{i+1}...")
-                    text, err = solve_captcha_with_gemini(api_key, image_bytes)
-                    if text:
-                        captcha_text, last_error = text, None
-                        break
-                    last_error = err
-                    print(f"[{process_id}] Key #{i+1} failed: {err}")
+    def _solve_batch_with_key(self, api_key, images):
+        # Một request cả lô tính là một lần giải của key, như _solve_with_key
+        started = time.perf_counter()
+        try:
+            llm = self._client(api_key)
+        except Exception as e:
+            answers, err = {}, str(e)
+        else:
+            answers, err = solve_captcha_batch_with_gemini(api_key, images, llm)
+        self._record(api_key, bool(answers), started)
+        return answers, err
 
-                if captcha_text:
-                    print(f"[{process_id}] AI result: '{captcha_text}'. Filling...")
-                    driver.find_element(By.ID, captcha_input_id).send_keys(captcha_text)
-                else:
-                    print(
-                        f"[{process_id}] All API keys failed. Last error: {last_error}. Manual input required."
-                    )
-                    if not is_headless:
-                        input(
-                            f"\n---> [{process_id}] AI FAILED. Enter CAPTCHA for '{name_for_log}' and press ENTER..."
-                        )
+    def _solve_single(self, image_bytes, future):
+        try:
+            self._resolve(future, super().solve(image_bytes))
+        except Exception as e:
+            self._resolve(future, (None, str(e)))
 
-            except Exception as e:
-                print(
-                    f"[{process_id}] CAPTCHA image not found: {e}. Manual input required."
+    def report(self):
+        lines = super().report()
+        with self._stats_lock:
+            if self._batch_sizes:
+                lines.insert(
+                    0,
+                    f"Lô CAPTCHA: {len(self._batch_sizes)} lô, TB "
+                    f"{sum(self._batch_sizes) / len(self._batch_sizes):.1f} ảnh/lô, "
+                    f"cửa sổ {self.window * 1000:.0f}ms, "
+                    f"{self._single_fallbacks} ảnh phải gửi riêng",
                 )
-                if not is_headless:
-                    input(
-                        f"\n---> [{process_id}] Enter CAPTCHA for '{name_for_log}' and press ENTER..."
+        return lines
+
+
+# --- BỘ DỮ LIỆU CAPTCHA: ẢNH THEO NỘI DUNG + MỘT FILE CHỈ MỤC ---
+CAPTCHA_DATASET_DIR = "captcha_dataset"
+CAPTCHA_DATASET_INDEX = "index.jsonl"
+
+
+class CaptchaDataset:
+    """Lưu ảnh CAPTCHA theo sha256 (trùng ảnh chỉ lưu một lần) và ghi mỗi lần giải
+    thành một dòng trong index.jsonl: đáp án, bộ giải, thời gian, kết quả submit.
+    """
+
+    def __init__(self, root=CAPTCHA_DATASET_DIR):
+        self.root = root
+        self.index_path = os.path.join(root, CAPTCHA_DATASET_INDEX)
+        self._lock = threading.Lock()
+
+    def image_path(self, digest):
+        return os.path.join(self.root, "images", digest[:2], f"{digest}.png")
+
+    def add(self, image_bytes, **record):
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        path = self.image_path(digest)
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(image_bytes)
+                os.replace(tmp_path, path)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(
+                    json.dumps({"sha256": digest, **record}, ensure_ascii=False) + "\n"
+                )
+        return digest
+
+    def records(self):
+        """Một bản ghi cho mỗi ảnh; ảnh từng được chấp nhận giữ đáp án đúng đó."""
+        merged = {}
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except OSError:
+            return []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            previous = merged.get(record["sha256"])
+            if previous and previous.get("success") and not record.get("success"):
+                continue
+            merged[record["sha256"]] = record
+        return list(merged.values())
+
+    def export(self, output_dir, only_success=True):
+        """Chép ảnh ra output_dir dạng <đáp án>_<hash>.png (đọc được bằng
+        load_labelled_captchas) kèm labels.csv. Trả về số ảnh đã xuất.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        rows = []
+        for record in self.records():
+            if only_success and not record.get("success"):
+                continue
+            answer = re.sub(r"[^A-Za-z0-9]", "", record.get("answer") or "")
+            if not answer:
+                continue
+            file_name = f"{answer}_{record['sha256'][:12]}.png"
+            with open(self.image_path(record["sha256"]), "rb") as src:
+                image_bytes = src.read()
+            with open(os.path.join(output_dir, file_name), "wb") as dst:
+                dst.write(image_bytes)
+            rows.append({"file": file_name, **record})
+        pd.DataFrame(rows).to_csv(os.path.join(output_dir, "labels.csv"), index=False)
+        return len(rows)
+
+
+# --- DỊCH VỤ GIẢI CAPTCHA DÙNG CHUNG (CHẠY TRONG TIẾN TRÌNH CHA) ---
+class CaptchaSolverService:
+    """Phục vụ mọi worker bằng các bộ giải đã khởi tạo sẵn trong tiến trình cha.
+
+    Worker mở một kết nối (multiprocessing.connection) tới service và gửi ảnh.
+    Các bộ giải được thử theo thứ tự (vd. cục bộ trước, Gemini sau), bộ sau chỉ
+    được gọi khi bộ trước không trả lời được. Có dataset thì mỗi đáp án được
+    lưu lại cùng kết quả submit mà worker báo về sau đó.
+    """
+
+    def __init__(self, backends, dataset=None):
+        self.backends = list(backends)
+        self.dataset = dataset
+        # Đáp án chờ worker báo kết quả submit: sha256 -> (ảnh, bản ghi)
+        self._pending = {}
+        self._solve_latencies = deque(maxlen=CAPTCHA_LATENCY_WINDOW)
+        self._backend_stats = {
+            backend.name: {"solved": 0, "failed": 0} for backend in self.backends
+        }
+        self._stats_lock = threading.Lock()
+        self._listener = None
+        self._authkey = os.urandom(16)
+        self._closed = threading.Event()
+
+    @property
+    def address_info(self):
+        """Thông tin kết nối gửi kèm task cho worker (picklable)."""
+        return self._listener.address, self._authkey
+
+    def start(self):
+        self._listener = Listener(("127.0.0.1", 0), authkey=self._authkey)
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._closed.set()
+        if self._listener:
+            self._listener.close()
+        for backend in self.backends:
+            backend.close()
+        # Đáp án không có kết quả submit (task lỗi giữa chừng) vẫn được lưu
+        with self._stats_lock:
+            pending, self._pending = self._pending, {}
+        for image_bytes, record in pending.values():
+            self.dataset.add(image_bytes, **record, success=None)
+
+    def _accept_loop(self):
+        while not self._closed.is_set():
+            try:
+                conn = self._listener.accept()
+            except (OSError, EOFError):
+                if self._closed.is_set():
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while not self._closed.is_set():
+                try:
+                    message = conn.recv()
+                except (OSError, EOFError):
+                    return
+                if message[0] == "outcome":
+                    self.record_outcome(*message[1:])
+                else:
+                    _, process_id, image_bytes = message
+                    conn.send(self.solve(image_bytes, process_id))
+
+    def solve(self, image_bytes, process_id=None):
+        """Thử lần lượt các bộ giải. Trả về (text, lỗi cuối)."""
+        started = time.perf_counter()
+        last_error = "Không có bộ giải CAPTCHA nào."
+        for backend in self.backends:
+            text, err = backend.solve(image_bytes)
+            latency = time.perf_counter() - started
+            with self._stats_lock:
+                self._backend_stats[backend.name]["solved" if text else "failed"] += 1
+                if text:
+                    self._solve_latencies.append(latency)
+                if text and self.dataset:
+                    self._pending[hashlib.sha256(image_bytes).hexdigest()] = (
+                        image_bytes,
+                        {
+                            "answer": text,
+                            "solver": backend.name,
+                            "latency_ms": round(latency * 1000, 1),
+                            "process_id": process_id,
+                            "time": datetime.now().isoformat(timespec="seconds"),
+                        },
                     )
-        else:
-            if not is_headless:
-                input(
-                    f"\n---> [{process_id}] Please enter CAPTCHA for '{name_for_log}' and press ENTER..."
+            if text:
+                return text, None
+            last_error = f"{backend.name}: {err}"
+        return None, last_error
+
+    def record_outcome(self, digest, success):
+        """Worker báo đáp án của ảnh digest có được trang chấp nhận hay không."""
+        with self._stats_lock:
+            pending = self._pending.pop(digest, None)
+        if pending:
+            image_bytes, record = pending
+            self.dataset.add(image_bytes, **record, success=success)
+
+    def latency_report(self):
+        lines = []
+        with self._stats_lock:
+            if self._solve_latencies:
+                lines.append(f"Tổng: {latency_summary(self._solve_latencies)}")
+            for backend in self.backends:
+                stats = self._backend_stats[backend.name]
+                lines.append(
+                    f"Bộ giải {backend.name}: {stats['solved']} giải được, "
+                    f"{stats['failed']} chuyển tiếp/lỗi"
                 )
+        for backend in self.backends:
+            lines.extend(backend.report())
+        return lines
 
-        # --- SUBMIT ĐỘNG ---
-        submit_button_id = FORM_FIELD_IDS.get("submit_button")
-        if submit_button_id:
-            print(f"[{process_id}] Clicking submit button...")
-            wait.until(EC.element_to_be_clickable((By.ID, submit_button_id))).click()
 
-            try:
-                wait.until(
-                    EC.presence_of_element_located(
-                        (By.XPATH, "//*[contains(text(), 'ĐĂNG KÝ THÀNH CÔNG')]")
-                    )
-                )
-                success = True
-            except TimeoutException:
-                success = False
-        else:
-            print(f"[{process_id}] Submit button ID not found in mapping.")
+_CAPTCHA_SERVICE_CONNECTIONS = threading.local()
+
+
+def solve_captcha_via_service(service_info, image_bytes, process_id):
+    """Gửi ảnh tới CaptchaSolverService, mỗi luồng giữ một kết nối riêng.
+
+    Ném OSError/EOFError nếu không kết nối được để bên gọi tự giải tại chỗ.
+    """
+    address, authkey = service_info
+    conn = getattr(_CAPTCHA_SERVICE_CONNECTIONS, "conn", None)
+    try:
+        if conn is None:
+            conn = Client(address, authkey=authkey)
+            _CAPTCHA_SERVICE_CONNECTIONS.conn = conn
+        conn.send(("solve", process_id, image_bytes))
+        return conn.recv()
+    except (OSError, EOFError):
+        _CAPTCHA_SERVICE_CONNECTIONS.conn = None
+        raise
+
+
+def report_captcha_outcome(service_info, image_bytes, success):
+    """Báo service đáp án CAPTCHA có được chấp nhận (để lưu bộ dữ liệu)."""
+    if not service_info or not image_bytes:
+        return
+    address, authkey = service_info
+    try:
+        conn = getattr(_CAPTCHA_SERVICE_CONNECTIONS, "conn", None)
+        if conn is None:
+            conn = Client(address, authkey=authkey)
+            _CAPTCHA_SERVICE_CONNECTIONS.conn = conn
+        conn.send(("outcome", hashlib.sha256(image_bytes).hexdigest(), success))
+    except (OSError, EOFError):
+        _CAPTCHA_SERVICE_CONNECTIONS.conn = None
+
+
+def solve_captcha_with_keys(api_keys, image_bytes, process_id, captcha_service=None):
+    """Thử lần lượt các API key cho tới khi giải được. Trả về (text, lỗi cuối).
+
+    Có captcha_service thì nhờ service ở tiến trình cha giải bằng client nóng.
+    """
+    if captcha_service:
+        try:
+            return solve_captcha_via_service(captcha_service, image_bytes, process_id)
+        except (OSError, EOFError) as e:
+            print(f"[{process_id}] Captcha service unavailable ({e}), solving locally.")
+    captcha_text, last_error = None, "No API keys provided."
+    for i, api_key in enumerate(api_keys):
+        print(f"[{process_id}] Attempting with key #{i+1}...")
+        text, err = solve_captcha_with_gemini(api_key, image_bytes)
+        if text:
+            captcha_text, last_error = text, None
+            break
+        last_error = err
+        print(f"[{process_id}] Key #{i+1} failed: {err}")
+    return captcha_text, last_error
+
+
+# --- THỬ LẠI CAPTCHA NGAY TRÊN TRANG KHI BỊ TỪ CHỐI ---
+CAPTCHA_RETRY_ATTEMPTS = 3
+SUBMIT_RESULT_TIMEOUT = 3
+# Một dòng thông báo chỉ tính là "CAPTCHA sai" khi vừa nhắc tới CAPTCHA vừa báo
+# lỗi; lỗi khác của server (trùng CCCD, hết suất...) không được giải lại CAPTCHA
+CAPTCHA_MESSAGE_WORDS = (
+    "mã xác nhận",
+    "mã captcha",
+    "captcha",
+    "mã bảo vệ",
+    "mã kiểm tra",
+    "verification code",
+    "security code",
+)
+CAPTCHA_ERROR_WORDS = (
+    "không đúng",
+    "không chính xác",
+    "không hợp lệ",
+    "sai",
+    "hết hạn",
+    "incorrect",
+    "invalid",
+    "wrong",
+    "expired",
+)
+
+# Dấu hiệu CAPTCHA bị từ chối: thêm dòng báo lỗi CAPTCHA, hoặc chính ô CAPTCHA
+# ở trạng thái lỗi (aria-invalid, class lỗi, thông báo validation gắn với ô)
+SUBMIT_STATE_SCRIPT = """
+const [captchaInputId, captchaSelector, captchaWords, errorWords] = arguments;
+const lines = (document.body ? document.body.innerText : '').toLowerCase().split('\\n');
+const img = document.querySelector(captchaSelector);
+const input = document.getElementById(captchaInputId);
+let fieldError = false;
+if (input) {
+    const message = input.name
+        && document.querySelector(`[data-valmsg-for="${CSS.escape(input.name)}"]`);
+    fieldError = input.getAttribute('aria-invalid') === 'true'
+        || /(^|[\\s_-])(error|invalid|is-invalid|has-error)([\\s_-]|$)/i.test(input.className)
+        || Boolean(message && message.textContent.trim());
+}
+return {
+    markers: lines.filter(line => captchaWords.some(w => line.includes(w))
+        && errorWords.some(w => line.includes(w))).length,
+    captcha_error: fieldError,
+    captcha_src: img ? (img.currentSrc || img.src || '') : null,
+    captcha_value: input ? input.value : null,
+};
+"""
+
+# Bấm nút làm mới CAPTCHA cạnh ảnh, không có thì tải lại ảnh với tham số chống cache
+CAPTCHA_REFRESH_SCRIPT = """
+const img = document.querySelector(arguments[0]);
+if (!img) return false;
+const scope = img.closest('form') || document;
+const refresh = Array.from(scope.querySelectorAll('a, button, img, span, i')).find(el =>
+    el !== img && /refresh|reload|lam-?moi|doi-?ma|làm mới|đổi mã/i.test([
+        el.id, el.getAttribute('class'), el.title, el.getAttribute('alt'),
+        (el.textContent || '').slice(0, 40),
+    ].join(' ')));
+if (refresh) {
+    refresh.click();
+    return true;
+}
+if (img.tagName === 'IMG' && img.src && !img.src.startsWith('data:')) {
+    const url = new URL(img.src, location.href);
+    url.searchParams.set('_', Date.now());
+    img.src = url.toString();
+    return true;
+}
+return false;
+"""
+
+FIELD_STATE_SCRIPT = """
+const state = {};
+for (const [key, id] of Object.entries(arguments[0])) {
+    const el = document.getElementById(id);
+    if (!el) continue;
+    state[key] = (el.type === 'checkbox' || el.type === 'radio')
+        ? (el.checked ? 'on' : '') : (el.value || '');
+}
+return state;
+"""
+
+
+def read_submit_state(driver, FORM_FIELD_IDS):
+    try:
+        return driver.execute_script(
+            SUBMIT_STATE_SCRIPT,
+            FORM_FIELD_IDS.get("captcha"),
+            FORM_FIELD_IDS.get("captcha_image_selector"),
+            list(CAPTCHA_MESSAGE_WORDS),
+            list(CAPTCHA_ERROR_WORDS),
+        )
+    except WebDriverException:
+        return None
+
+
+def wait_for_submit_outcome(
+    driver, FORM_FIELD_IDS, before_state, timeout=SUBMIT_RESULT_TIMEOUT
+):
+    """Chờ kết quả sau khi bấm submit: 'success', 'rejected' hoặc 'failed'."""
+    return drive_steps(
+        submit_outcome_steps(driver, FORM_FIELD_IDS, before_state, timeout)
+    )
+
+
+def submit_outcome_steps(
+    driver, FORM_FIELD_IDS, before_state, timeout=SUBMIT_RESULT_TIMEOUT
+):
+    """Generator chờ kết quả submit, return 'success', 'rejected' hoặc 'failed'.
+
+    'rejected' nghĩa là vẫn ở form và trang báo lỗi riêng cho CAPTCHA (thông báo
+    nhắc tới mã xác nhận, hoặc ô CAPTCHA chuyển sang trạng thái lỗi), có thể thử
+    lại ngay trên trang. Ảnh đổi hay ô mã bị xóa thôi chưa đủ: server cũng làm
+    vậy với các lỗi khác, nên không rõ nguyên nhân thì trả về 'failed'.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if driver.find_elements(By.XPATH, SUCCESS_XPATH):
+                return "success"
+        except WebDriverException:
+            pass  # Trang đang chuyển
+        state = read_submit_state(driver, FORM_FIELD_IDS)
+        if before_state and state and state["captcha_value"] is not None:
+            # Lỗi ở ô CAPTCHA còn sót từ lần trước chỉ tính khi ảnh đã được thay
+            new_field_error = state["captcha_error"] and (
+                not before_state["captcha_error"]
+                or state["captcha_src"] != before_state["captcha_src"]
+            )
+            if state["markers"] > before_state["markers"] or new_field_error:
+                return "rejected"
+        if time.monotonic() > deadline:
+            return "failed"
+        yield
+
+
+def captcha_capture_steps(driver, wait, captcha_image_selector):
+    """Generator lấy ảnh CAPTCHA: chạy script lấy ảnh nền trong trang, yield tới khi
+    xong (hoặc hết thời gian) rồi return bytes ảnh.
+    """
+    start_captcha_capture(driver, captcha_image_selector)
+    deadline = time.monotonic() + CAPTCHA_IMAGE_LOAD_TIMEOUT + 1
+    while not driver.execute_script("return !!window.__captchaCaptureReady;"):
+        if time.monotonic() > deadline:
+            break
+        yield
+    return capture_captcha_image(driver, wait, captcha_image_selector)
+
+
+def refresh_captcha_in_page(driver, wait, captcha_image_selector, previous_bytes):
+    """Lấy ảnh CAPTCHA mới trên cùng trang; trang chưa tự đổi ảnh thì bấm làm mới."""
+    return drive_steps(
+        refresh_captcha_steps(driver, wait, captcha_image_selector, previous_bytes)
+    )
+
+
+def refresh_captcha_steps(driver, wait, captcha_image_selector, previous_bytes):
+    """Generator của refresh_captcha_in_page, return bytes ảnh mới."""
+    refreshed = False
+    deadline = time.monotonic() + CAPTCHA_IMAGE_LOAD_TIMEOUT
+    while True:
+        driver.execute_script(
+            "window.__captchaCapture = null; window.__captchaCaptureReady = false;"
+        )
+        image_bytes = yield from captcha_capture_steps(
+            driver, wait, captcha_image_selector
+        )
+        if image_bytes != previous_bytes:
+            return image_bytes
+        if not refreshed:
+            driver.execute_script(CAPTCHA_REFRESH_SCRIPT, captcha_image_selector)
+            refreshed = True
+        elif time.monotonic() > deadline:
+            return image_bytes
+        yield
+
+
+def cleared_fields(driver, FORM_FIELD_IDS, data):
+    """Các trường đã bị xóa trắng sau lần submit lỗi, cần điền lại: {key: id}."""
+    fields = {
+        key: FORM_FIELD_IDS[key]
+        for key in form_field_order(FORM_FIELD_IDS)
+        if FORM_FIELD_IDS.get(key)
+        and key != "captcha"
+        and (data.get(key) or key == "agree_checkbox")
+    }
+    state = driver.execute_script(FIELD_STATE_SCRIPT, fields)
+    return {key: fields[key] for key in fields if key in state and not state[key]}
+
+
+_WORKER_CAPTCHA_EXECUTOR = None
+
+
+def get_worker_captcha_executor():
+    """Luồng giải CAPTCHA của worker, chạy song song với việc điền form."""
+    global _WORKER_CAPTCHA_EXECUTOR
+    if _WORKER_CAPTCHA_EXECUTOR is None:
+        _WORKER_CAPTCHA_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+    return _WORKER_CAPTCHA_EXECUTOR
+
+
+# --- TIẾN TRÌNH ĐIỀN FORM (WORKER) - PHIÊN BẢN ĐÃ VIẾT LẠI ---
+# --- TIẾN TRÌNH ĐIỀN FORM (WORKER) - PHIÊN BẢN ĐÃ VIẾT LẠI ---
+def fill_and_submit_process(task_info):
+    url = task_info["url"]
+    chrome_options = task_info["options"]
+    data = task_info["data"]
+    process_id = task_info["process_id"]
+    is_headless = task_info["is_headless"]
+    use_ai_captcha = task_info["use_ai_captcha"]
+    api_keys = task_info["api_keys"]
+    FORM_FIELD_IDS = task_info["FORM_FIELD_IDS"]
+    keep_failed_tab = task_info["keep_failed_tab"]
+    driver_path = task_info.get("driver_path")
+    capture_submission = task_info.get("capture_submission", False)
+    driver = None
+    success = False
+    image_bytes, captcha_text = None, None
+    name_for_log = data.get("full_name", f"Task {process_id}")
+    browser_pool = get_worker_browser_pool()
+
+    try:
+        driver = browser_pool.checkout(
+            chrome_options, url, driver_path, task_info.get("blocked_urls")
+        )
+        wait = WebDriverWait(driver, 1)  # Tăng thời gian chờ lên 5 giây cho ổn định
+        captcha_input_id = FORM_FIELD_IDS.get("captcha")
+        captcha_image_selector = FORM_FIELD_IDS.get("captcha_image_selector")
+        solve_with_ai = use_ai_captcha and captcha_input_id and captcha_image_selector
+        captcha_future, capture_error = None, None
+        if solve_with_ai:
+            # Trang vừa tải xong: lấy ảnh và gửi giải ngay, điền form trong lúc chờ
+            print(f"[{process_id}] AI solving CAPTCHA for '{name_for_log}'...")
+            try:
+                image_bytes = capture_captcha_image(
+                    driver, wait, captcha_image_selector
+                )
+                captcha_future = get_worker_captcha_executor().submit(
+                    solve_captcha_with_keys,
+                    api_keys,
+                    image_bytes,
+                    process_id,
+                    task_info.get("captcha_service"),
+                )
+            except Exception as e:
+                capture_error = e
+
+        # --- VÒNG LẶP ĐIỀN FORM ĐỘNG ---
+        fill_form(
+            driver,
+            wait,
+            FORM_FIELD_IDS,
+            data,
+            process_id,
+            fast_fill=task_info.get("fast_fill", False),
+            dropdown_timeout=task_info.get(
+                "dropdown_wait_timeout", DROPDOWN_WAIT_TIMEOUT
+            ),
+        )
+
+        # --- XỬ LÝ CAPTCHA ĐỘNG ---
+        if solve_with_ai:
+            try:
+                if capture_error:
+                    raise capture_error
+                # Form đã điền xong, chờ đáp án đang giải song song
+                captcha_text, last_error = captcha_future.result()
+
+                if captcha_text:
+                    print(f"[{process_id}] AI result: '{captcha_text}'. Filling...")
+                    driver.find_element(By.ID, captcha_input_id).send_keys(captcha_text)
+                else:
+                    print(
+                        f"[{process_id}] All API keys failed. Last error: {last_error}. Manual input required."
+                    )
+                    if not is_headless:
+                        input(
+                            f"\n---> [{process_id}] AI FAILED. Enter CAPTCHA for '{name_for_log}' and press ENTER..."
+                        )
+
+            except Exception as e:
+                print(
+                    f"[{process_id}] CAPTCHA image not found: {e}. Manual input required."
+                )
+                if not is_headless:
+                    input(
+                        f"\n---> [{process_id}] Enter CAPTCHA for '{name_for_log}' and press ENTER..."
+                    )
+        else:
+            if not is_headless:
+                input(
+                    f"\n---> [{process_id}] Please enter CAPTCHA for '{name_for_log}' and press ENTER..."
+                )
+
+        # --- SUBMIT ĐỘNG ---
+        submit_button_id = FORM_FIELD_IDS.get("submit_button")
+        if submit_button_id:
+            # CAPTCHA do AI giải mà bị từ chối thì giải lại ngay trên trang này
+            max_attempts = (
+                task_info.get("captcha_max_attempts", 1) if captcha_text else 1
+            )
+            for attempt in range(1, max_attempts + 1):
+                if capture_submission:
+                    # Ghi lại token ẩn, mã CAPTCHA đã nhập và xả log mạng cũ trước khi bấm
+                    hidden_fields = driver.execute_script(HIDDEN_INPUTS_SCRIPT)
+                    form_elements = read_form_elements(driver, FORM_FIELD_IDS, data)
+                    captcha_value = (
+                        driver.find_element(By.ID, captcha_input_id).get_attribute(
+                            "value"
+                        )
+                        if captcha_input_id
+                        else None
+                    )
+                    driver.get_log("performance")
+
+                before_state = read_submit_state(driver, FORM_FIELD_IDS)
+                print(f"[{process_id}] Clicking submit button...")
+                wait.until(
+                    EC.element_to_be_clickable((By.ID, submit_button_id))
+                ).click()
+
+                outcome = wait_for_submit_outcome(driver, FORM_FIELD_IDS, before_state)
+                success = outcome == "success"
+                if captcha_text and outcome != "failed":
+                    # 'failed' không rõ do CAPTCHA hay lỗi khác: không gắn nhãn ảnh
+                    report_captcha_outcome(
+                        task_info.get("captcha_service"), image_bytes, success
+                    )
+                if success or outcome != "rejected" or attempt == max_attempts:
+                    break
+
+                print(
+                    f"[{process_id}] CAPTCHA rejected (attempt {attempt}/{max_attempts}). Re-solving on the same page..."
+                )
+                image_bytes = refresh_captcha_in_page(
+                    driver, wait, captcha_image_selector, image_bytes
+                )
+                captcha_text, last_error = solve_captcha_with_keys(
+                    api_keys,
+                    image_bytes,
+                    process_id,
+                    task_info.get("captcha_service"),
+                )
+                if not captcha_text:
+                    print(f"[{process_id}] Re-solve failed: {last_error}.")
+                    break
+                lost_fields = cleared_fields(driver, FORM_FIELD_IDS, data)
+                if lost_fields:
+                    print(
+                        f"[{process_id}] Re-filling cleared fields: {list(lost_fields)}"
+                    )
+                    fill_form(
+                        driver,
+                        wait,
+                        lost_fields,
+                        data,
+                        process_id,
+                        fast_fill=task_info.get("fast_fill", False),
+                        dropdown_timeout=task_info.get(
+                            "dropdown_wait_timeout", DROPDOWN_WAIT_TIMEOUT
+                        ),
+                    )
+                captcha_input = driver.find_element(By.ID, captcha_input_id)
+                captcha_input.clear()
+                captcha_input.send_keys(captcha_text)
+
+            if capture_submission and success:
+                template, error = capture_submission_template(
+                    driver, url, data, hidden_fields, captcha_value, form_elements
+                )
+                task_info["captured_template"] = template
+                task_info["capture_error"] = error
+        else:
+            print(f"[{process_id}] Submit button ID not found in mapping.")
+
+        return success, name_for_log
+
+    except Exception as e:
+        print(f"[{process_id}] CRITICAL ERROR in process for '{name_for_log}': {e}")
+        return False, name_for_log
+
+    finally:
+        # <<< LOGIC QUYẾT ĐỊNH ĐÓNG TAB >>>
+        if driver:
+            # Chỉ đóng tab nếu: 1. Thành công, HOẶC 2. Người dùng không muốn giữ lại tab lỗi
+            if success or not keep_failed_tab:
+                browser_pool.checkin(driver)
+            else:
+                # Nếu thất bại và người dùng muốn giữ lại tab
+                print(
+                    f"[{process_id}] THẤT BẠI. Giữ lại tab của '{name_for_log}' để kiểm tra."
+                )
+                # Tách khỏi pool để tab không bị reset hay dùng lại
+                browser_pool.detach(driver)
+
+
+# --- CHẾ ĐỘ NHIỀU TAB: MỘT CHROME CHẠY XEN KẼ NHIỀU FORM ---
+MULTITAB_PAGE_LOAD_TIMEOUT = 30
+MULTITAB_POLL_INTERVAL = 0.05
+# Mỗi lô giao cho worker gồm (số tab x hệ số này) task để các tab luôn có việc
+MULTITAB_BATCH_ROUNDS = 4
+
+
+def multitab_chrome_options(chrome_options):
+    """Bản sao options cho chế độ nhiều tab với pageLoadStrategy=none.
+
+    Với normal/eager, chromedriver chờ lần điều hướng đang dở xong trước các lệnh như
+    execute_script hay switch_to.window, nên một tab đang tải sẽ chặn cả vòng xen kẽ.
+    Với none các lệnh trả về ngay; vòng lặp tự kiểm tra document.readyState của từng tab.
+    """
+    options = copy.deepcopy(chrome_options)
+    options.page_load_strategy = "none"
+    return options
+
+
+def _multitab_page_ready(driver, ready_state_check):
+    # pageLoadStrategy=none: script có thể chạy đúng lúc trang đang chuyển, coi là chưa xong
+    try:
+        return driver.execute_script(
+            f"return !window.__multitabPending && {ready_state_check};"
+        )
+    except WebDriverException:
+        return False
+
+
+def _multitab_fill_steps(driver, wait, FORM_FIELD_IDS, data, process_id, task_info):
+    """Generator điền form trong một tab.
+
+    Chờ dropdown 'session' nạp lại theo ngày bán bằng `yield` thay vì chặn tại chỗ
+    như fill_form, để các tab khác vẫn chạy trong lúc chờ AJAX.
+    """
+    dropdown_timeout = task_info.get("dropdown_wait_timeout", DROPDOWN_WAIT_TIMEOUT)
+    fast_fill = task_info.get("fast_fill", False)
+    sales_date_id = FORM_FIELD_IDS.get("sales_date")
+    session_id = FORM_FIELD_IDS.get("session")
+    if not (sales_date_id and session_id and data.get("sales_date")):
+        fill_form(
+            driver, wait, FORM_FIELD_IDS, data, process_id, fast_fill, dropdown_timeout
+        )
+        return
+
+    # Mapping chỉ có sales_date: fill_form không tự chờ 'session'
+    previous_options = mark_select_options(driver, session_id)
+    fill_form(
+        driver,
+        wait,
+        {"sales_date": sales_date_id},
+        data,
+        process_id,
+        fast_fill,
+        dropdown_timeout,
+    )
+    deadline = time.monotonic() + dropdown_timeout
+    while not dropdown_refreshed(driver, session_id, previous_options):
+        if time.monotonic() > deadline:
+            print(
+                f"[{process_id}] WARNING: 'session' options did not refresh within {dropdown_timeout}s."
+            )
+            break
+        yield
+    other_fields = {k: v for k, v in FORM_FIELD_IDS.items() if k != "sales_date"}
+    fill_form(driver, wait, other_fields, data, process_id, fast_fill, dropdown_timeout)
+
+
+def _multitab_task_steps(driver, task_info, captcha_executor):
+    """Generator thực hiện một task trong tab hiện tại.
+
+    Mỗi lần `yield` là lúc tab đang chờ (tải trang, giải CAPTCHA, chờ kết quả);
+    bộ điều phối sẽ chuyển sang tab khác và quay lại sau. Giá trị trả về giống
+    `fill_and_submit_process`: (success, name_for_log).
+    """
+    url = task_info["url"]
+    data = task_info["data"]
+    process_id = task_info["process_id"]
+    is_headless = task_info["is_headless"]
+    use_ai_captcha = task_info["use_ai_captcha"]
+    api_keys = task_info["api_keys"]
+    FORM_FIELD_IDS = task_info["FORM_FIELD_IDS"]
+    name_for_log = data.get("full_name", f"Task {process_id}")
+    image_bytes, captcha_text = None, None
+
+    try:
+        # Điều hướng không chặn: đánh dấu trang cũ, trang mới sẽ không còn dấu này
+        driver.execute_script(
+            "window.__multitabPending = true; window.location.href = arguments[0];",
+            url,
+        )
+        deadline = time.monotonic() + MULTITAB_PAGE_LOAD_TIMEOUT
+        # Lean mode (eager) chỉ cần DOM sẵn sàng, không chờ ảnh/font
+        ready_state_check = (
+            "document.readyState !== 'loading'"
+            if task_info.get("lean_mode")
+            else "document.readyState === 'complete'"
+        )
+        while not _multitab_page_ready(driver, ready_state_check):
+            if time.monotonic() > deadline:
+                raise TimeoutException(
+                    f"Page load timed out after {MULTITAB_PAGE_LOAD_TIMEOUT}s"
+                )
+            yield
+
+        wait = WebDriverWait(driver, 1)
+        captcha_input_id = FORM_FIELD_IDS.get("captcha")
+        captcha_image_selector = FORM_FIELD_IDS.get("captcha_image_selector")
+        solve_with_ai = use_ai_captcha and captcha_input_id and captcha_image_selector
+        if solve_with_ai:
+            # Lấy ảnh chạy nền trong trang, nhường tab khác tới khi có ảnh
+            image_bytes = yield from captcha_capture_steps(
+                driver, wait, captcha_image_selector
+            )
+            print(f"[{process_id}] AI solving CAPTCHA for '{name_for_log}'...")
+            future = captcha_executor.submit(
+                solve_captcha_with_keys,
+                api_keys,
+                image_bytes,
+                process_id,
+                task_info.get("captcha_service"),
+            )
+        yield from _multitab_fill_steps(
+            driver, wait, FORM_FIELD_IDS, data, process_id, task_info
+        )
+
+        if solve_with_ai:
+            while not future.done():
+                yield
+            captcha_text, last_error = future.result()
+            if captcha_text:
+                print(f"[{process_id}] AI result: '{captcha_text}'. Filling...")
+                driver.find_element(By.ID, captcha_input_id).send_keys(captcha_text)
+            else:
+                print(f"[{process_id}] All API keys failed. Last error: {last_error}.")
+                if not is_headless:
+                    input(
+                        f"\n---> [{process_id}] AI FAILED. Enter CAPTCHA for '{name_for_log}' and press ENTER..."
+                    )
+        elif not is_headless:
+            input(
+                f"\n---> [{process_id}] Please enter CAPTCHA for '{name_for_log}' and press ENTER..."
+            )
+
+        submit_button_id = FORM_FIELD_IDS.get("submit_button")
+        if not submit_button_id:
+            print(f"[{process_id}] Submit button ID not found in mapping.")
+            return False, name_for_log
+
+        # Giống fill_and_submit_process: CAPTCHA do AI giải bị từ chối thì giải lại
+        max_attempts = task_info.get("captcha_max_attempts", 1) if captcha_text else 1
+        for attempt in range(1, max_attempts + 1):
+            before_state = read_submit_state(driver, FORM_FIELD_IDS)
+            print(f"[{process_id}] Clicking submit button...")
+            wait.until(EC.element_to_be_clickable((By.ID, submit_button_id))).click()
+            outcome = yield from submit_outcome_steps(
+                driver, FORM_FIELD_IDS, before_state
+            )
+            success = outcome == "success"
+            if captcha_text and outcome != "failed":
+                # 'failed' không rõ do CAPTCHA hay lỗi khác: không gắn nhãn ảnh
+                report_captcha_outcome(
+                    task_info.get("captcha_service"), image_bytes, success
+                )
+            if success or outcome != "rejected" or attempt == max_attempts:
+                break
+
+            print(
+                f"[{process_id}] CAPTCHA rejected (attempt {attempt}/{max_attempts}). Re-solving on the same page..."
+            )
+            image_bytes = yield from refresh_captcha_steps(
+                driver, wait, captcha_image_selector, image_bytes
+            )
+            future = captcha_executor.submit(
+                solve_captcha_with_keys,
+                api_keys,
+                image_bytes,
+                process_id,
+                task_info.get("captcha_service"),
+            )
+            while not future.done():
+                yield
+            captcha_text, last_error = future.result()
+            if not captcha_text:
+                print(f"[{process_id}] Re-solve failed: {last_error}.")
+                break
+            lost_fields = cleared_fields(driver, FORM_FIELD_IDS, data)
+            if lost_fields:
+                print(f"[{process_id}] Re-filling cleared fields: {list(lost_fields)}")
+                yield from _multitab_fill_steps(
+                    driver, wait, lost_fields, data, process_id, task_info
+                )
+            captcha_input = driver.find_element(By.ID, captcha_input_id)
+            captcha_input.clear()
+            captcha_input.send_keys(captcha_text)
+        return success, name_for_log
+
+    except Exception as e:
+        print(f"[{process_id}] CRITICAL ERROR in process for '{name_for_log}': {e}")
+        return False, name_for_log
+
+
+def fill_and_submit_multitab_process(batch_info):
+    """Chạy một lô task trong một Chrome, mỗi task một tab, xen kẽ giữa các tab.
+
+    Trả về danh sách (success, name_for_log) theo đúng thứ tự task trong lô.
+    """
+    tasks = batch_info["tasks"]
+    tabs_per_browser = max(1, int(batch_info["tabs_per_browser"]))
+    first_task = tasks[0]
+    keep_failed_tab = first_task["keep_failed_tab"]
+    browser_pool = get_worker_browser_pool()
+    results = [
+        (False, t["data"].get("full_name", f"Task {t['process_id']}")) for t in tasks
+    ]
+    driver = None
+    kept_failed_tab = False
+
+    try:
+        driver = browser_pool.checkout(
+            multitab_chrome_options(first_task["options"]),
+            first_task["url"],
+            first_task.get("driver_path"),
+            first_task.get("blocked_urls"),
+        )
+        free_handles = [driver.current_window_handle]
+        open_tabs = 1
+        pending = list(enumerate(tasks))
+        active = {}
+
+        with ThreadPoolExecutor(max_workers=tabs_per_browser) as captcha_executor:
+            while pending or active:
+                # Giao task mới cho tab rảnh, mở thêm tab nếu chưa đủ số lượng
+                while pending and (free_handles or open_tabs < tabs_per_browser):
+                    if free_handles:
+                        handle = free_handles.pop()
+                        driver.switch_to.window(handle)
+                    else:
+                        driver.switch_to.new_window("tab")
+                        handle = driver.current_window_handle
+                        open_tabs += 1
+                        if first_task.get("blocked_urls"):
+                            apply_network_blocking(driver, first_task["blocked_urls"])
+                    index, task_info = pending.pop(0)
+                    active[handle] = (
+                        index,
+                        _multitab_task_steps(driver, task_info, captcha_executor),
+                    )
+
+                for handle in list(active):
+                    index, steps = active[handle]
+                    driver.switch_to.window(handle)
+                    try:
+                        next(steps)
+                    except StopIteration as finished:
+                        results[index] = finished.value
+                        del active[handle]
+                        if finished.value[0] or not keep_failed_tab:
+                            free_handles.append(handle)
+                        else:
+                            # Giữ tab lỗi lại để kiểm tra, task sau sẽ dùng tab mới
+                            print(
+                                f"[{tasks[index]['process_id']}] THẤT BẠI. Giữ lại tab của '{finished.value[1]}' để kiểm tra."
+                            )
+                            kept_failed_tab = True
+                            open_tabs -= 1
+                time.sleep(MULTITAB_POLL_INTERVAL)
+
+        return results
+
+    except Exception as e:
+        print(f"[Multitab] CRITICAL ERROR in batch: {e}")
+        return results
+
+    finally:
+        if driver:
+            if kept_failed_tab:
+                browser_pool.detach(driver)
+            else:
+                browser_pool.checkin(driver)
+
+
+# --- ENGINE GỬI TRỰC TIẾP QUA HTTP (HỌC MỘT LẦN, PHÁT LẠI) ---
+HTTP_REPLAY_POOL_SIZE = 16
+# Header của request gốc được giữ lại khi phát lại (cookie lấy từ phiên riêng)
+REPLAY_HEADER_WHITELIST = ("origin", "referer", "x-requested-with", "accept")
+# Các khóa JSON dùng để nhận biết phản hồi thành công của API
+RESPONSE_SIGNATURE_KEYS = ("success", "status", "ok", "code", "result")
+
+HIDDEN_INPUTS_SCRIPT = """
+const fields = {};
+document.querySelectorAll("input[type=hidden][name]").forEach((el) => {
+    fields[el.name] = el.value;
+});
+return fields;
+"""
+
+
+# name/id, giá trị hiện tại và danh sách option (select) của các phần tử trong mapping
+FORM_ELEMENTS_SCRIPT = """
+const result = {};
+for (const [key, id] of Object.entries(arguments[0])) {
+    const el = document.getElementById(id);
+    if (!el) continue;
+    result[key] = {
+        id: el.id,
+        name: el.getAttribute("name") || "",
+        tag: el.tagName.toLowerCase(),
+        value: el.value,
+        options: el.options
+            ? Array.from(el.options).map((o) => ({ text: o.text.trim(), value: o.value }))
+            : null,
+    };
+}
+return result;
+"""
+
+
+def read_form_elements(driver, FORM_FIELD_IDS, keys):
+    """Đọc name/id, giá trị và option của các phần tử ứng với `keys` trong một lần gọi."""
+    element_ids = {key: FORM_FIELD_IDS[key] for key in keys if FORM_FIELD_IDS.get(key)}
+    return driver.execute_script(FORM_ELEMENTS_SCRIPT, element_ids) or {}
+
+
+def resolve_option_value(options, key, wanted):
+    """option.value của lựa chọn mà fill_form sẽ chọn cho text `wanted`, hoặc None.
+
+    Giống fill_form: 'session' lấy option đầu tiên chứa chuỗi, các select khác khớp nguyên văn.
+    """
+    wanted = str(wanted).strip()
+    if key == "session":
+        for option in options:
+            if wanted in option["text"]:
+                return option["value"]
+    for option in options:
+        if option["text"] == wanted:
+            return option["value"]
+    return None
+
+
+def map_submission_fields(pairs, data, form_elements, hidden_fields, captcha_text=None):
+    """Gắn nguồn cho từng tham số của request đã bắt được. Trả về (fields, lỗi).
+
+    Tham số trùng name (hoặc id) của phần tử trong mapping lấy từ cột dữ liệu của phần
+    tử đó; select gửi option.value nên template giữ danh sách option để đổi text của từng
+    dòng ra value. Request dựng bằng JS có thể đổi tên tham số: khi đó chỉ nhận theo giá
+    trị nếu giá trị là duy nhất, còn không thì từ chối học - phát lại một trường cố định
+    sai (ví dụ ngày bán của dòng học) còn tệ hơn không dùng engine HTTP.
+    """
+    keys_by_name = {}
+    keys_by_value = {}
+    for key, element in form_elements.items():
+        for attr in ("name", "id"):
+            if element.get(attr):
+                keys_by_name.setdefault(element[attr], key)
+        if str(element.get("value") or ""):
+            keys_by_value.setdefault(str(element["value"]), []).append(key)
+    value_counts = {}
+    for _, value in pairs:
+        value_counts[str(value)] = value_counts.get(str(value), 0) + 1
+
+    def data_spec(key):
+        spec = {"source": "data", "key": key}
+        options = form_elements[key].get("options")
+        if options is not None:
+            spec["options"] = options
+            if key == "session":
+                # Danh sách phiên nạp theo ngày bán: chỉ đúng cho ngày của dòng học
+                spec["options_for"] = data.get("sales_date")
+        return spec
+
+    fields = []
+    mapped = set()
+    for name, value in pairs:
+        value_str = str(value)
+        key = keys_by_name.get(name)
+        if captcha_text and value_str == captcha_text and key in (None, "captcha"):
+            spec = {"source": "captcha"}
+        elif key in data:
+            spec = data_spec(key)
+        elif name in hidden_fields:
+            spec = {"source": "token", "value": value}
+        elif value_str in keys_by_value:
+            keys = keys_by_value[value_str]
+            if len(keys) > 1 or value_counts[value_str] > 1:
+                return None, (
+                    f"Tham số '{name}'='{value_str}' có thể là {', '.join(keys)}:"
+                    " không xác định được trường, bỏ học template."
+                )
+            spec = data_spec(keys[0])
+        else:
+            spec = {"source": "const", "value": value}
+        if spec["source"] == "data":
+            mapped.add(spec["key"])
+        fields.append([name, spec])
+
+    missing = [
+        key
+        for key in form_elements
+        if key in data and data[key] not in (None, "") and key not in mapped
+    ]
+    if missing:
+        return None, f"Không tìm thấy {', '.join(missing)} trong request gửi form."
+    return fields, None
+
+
+class _HiddenInputParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.fields = {}
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "input" and (attrs.get("type") or "").lower() == "hidden":
+            if attrs.get("name"):
+                self.fields[attrs["name"]] = attrs.get("value") or ""
+
+
+def parse_hidden_inputs(html_content):
+    """Lấy các input ẩn (token chống giả mạo...) từ HTML: {name: value}."""
+    parser = _HiddenInputParser()
+    parser.feed(html_content)
+    return parser.fields
+
+
+def enable_network_capture(chrome_options):
+    """Bật performance log để đọc được request mạng mà form gửi đi."""
+    chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    return chrome_options
+
+
+def _decode_request_body(body, content_type):
+    """Tách body request thành danh sách (tên, giá trị) theo content-type."""
+    content_type = (content_type or "").lower()
+    if "json" in content_type:
+        payload = json.loads(body)
+        return list(payload.items()) if isinstance(payload, dict) else []
+    if "multipart/form-data" in content_type:
+        return re.findall(r'name="([^"]+)"\r\n\r\n(.*?)\r\n--', body, flags=re.S)
+    return parse_qsl(body, keep_blank_values=True)
+
+
+def _response_signature(body):
+    """Dấu hiệu nhận biết phản hồi thành công, học từ lần submit đầu tiên."""
+    if SUCCESS_MARKER in body:
+        return {"marker": SUCCESS_MARKER}
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return {}
+    if not isinstance(payload, dict):
+        return {}
+    return {
+        "json": {
+            k: v
+            for k, v in payload.items()
+            if k in RESPONSE_SIGNATURE_KEYS and isinstance(v, (bool, int, float, str))
+        }
+    }
+
+
+def capture_submission_template(
+    driver, page_url, data, hidden_fields, captcha_text=None, form_elements=None
+):
+    """Đọc log mạng sau khi submit thành công và dựng template để phát lại.
+
+    form_elements là kết quả read_form_elements đọc ngay trước khi bấm submit. Request
+    được chọn là request POST/PUT khớp nhiều phần tử của form nhất (theo name hoặc giá
+    trị). Trả về (template, lỗi); xem map_submission_fields về cách gắn nguồn tham số.
+    """
+    form_elements = form_elements or {}
+    events = [
+        json.loads(entry["message"])["message"]
+        for entry in driver.get_log("performance")
+    ]
+    element_names = {
+        element[attr]
+        for element in form_elements.values()
+        for attr in ("name", "id")
+        if element.get(attr)
+    }
+    element_values = {
+        str(element["value"])
+        for element in form_elements.values()
+        if str(element.get("value") or "")
+    }
+
+    best, best_score = None, 0
+    for event in events:
+        if event.get("method") != "Network.requestWillBeSent":
+            continue
+        params = event["params"]
+        request = params["request"]
+        if request.get("method") not in ("POST", "PUT"):
+            continue
+        body = request.get("postData")
+        if body is None and request.get("hasPostData"):
+            try:
+                body = driver.execute_cdp_cmd(
+                    "Network.getRequestPostData", {"requestId": params["requestId"]}
+                )["postData"]
+            except Exception:
+                continue
+        if not body:
+            continue
+        headers = {k.lower(): v for k, v in request.get("headers", {}).items()}
+        try:
+            pairs = _decode_request_body(body, headers.get("content-type"))
+        except ValueError:
+            continue
+        score = sum(
+            1
+            for name, value in pairs
+            if name in element_names or str(value) in element_values
+        )
+        if score > best_score:
+            best, best_score = (params["requestId"], request, headers, pairs), score
+
+    if not best:
+        return None, "Không thấy request POST/PUT nào chứa dữ liệu của form."
+    request_id, request, headers, pairs = best
+
+    fields, error = map_submission_fields(
+        pairs, data, form_elements, hidden_fields, captcha_text
+    )
+    if error:
+        return None, error
+
+    expected_status, signature = None, {}
+    for event in events:
+        if (
+            event.get("method") == "Network.responseReceived"
+            and event["params"].get("requestId") == request_id
+        ):
+            expected_status = event["params"]["response"].get("status")
+    try:
+        response_body = driver.execute_cdp_cmd(
+            "Network.getResponseBody", {"requestId": request_id}
+        )
+        signature = _response_signature(response_body.get("body", ""))
+    except Exception:
+        pass
+
+    template = {
+        "page_url": page_url,
+        "endpoint": request["url"],
+        "method": request["method"],
+        "content_type": headers.get("content-type", ""),
+        "headers": {k: v for k, v in headers.items() if k in REPLAY_HEADER_WHITELIST},
+        "fields": fields,
+        "cookie_names": [c["name"] for c in driver.get_cookies()],
+        "expected_status": expected_status,
+        "success_signature": signature,
+    }
+    return template, None
+
+
+def learn_submission_template(task_info):
+    """Chạy task đầu tiên bằng trình duyệt có ghi log mạng ngay trong tiến trình hiện tại.
+
+    Trả về (success, name_for_log, template, lỗi); template là None nếu không học được.
+    """
+    learn_task = dict(
+        task_info,
+        options=enable_network_capture(task_info["options"]),
+        keep_failed_tab=False,
+        capture_submission=True,
+    )
+    try:
+        success, name_for_log = fill_and_submit_process(learn_task)
+    finally:
+        get_worker_browser_pool().close_all()
+    return (
+        success,
+        name_for_log,
+        learn_task.get("captured_template"),
+        learn_task.get("capture_error"),
+    )
+
+
+class HttpReplayEngine:
+    """Gửi form bằng một requests.Session dùng chung (giữ kết nối) theo template đã học."""
+
+    def __init__(self, template, pool_size=HTTP_REPLAY_POOL_SIZE):
+        self.template = template
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.needs_captcha = any(
+            spec["source"] == "captcha" for _, spec in template["fields"]
+        )
+
+    def needs_browser(self, data):
+        """Cần trình duyệt cho dòng này: để lấy CAPTCHA, hoặc đọc lại danh sách phiên
+        khi ngày bán khác ngày của dòng đã học (value của phiên đổi theo ngày)."""
+        return self.needs_captcha or any(
+            "options_for" in spec and spec["options_for"] != data.get("sales_date")
+            for _, spec in self.template["fields"]
+        )
+
+    def fetch_tokens(self):
+        """Lấy token ẩn và cookie mới bằng một GET trang form (không cần trình duyệt)."""
+        self.session.cookies.clear()
+        response = self.session.get(self.template["page_url"], timeout=15)
+        response.raise_for_status()
+        return parse_hidden_inputs(response.text)
+
+    def load_browser_cookies(self, cookies):
+        """Dùng cookie của trình duyệt đã lấy CAPTCHA để CAPTCHA khớp phiên."""
+        self.session.cookies.clear()
+        for cookie in cookies:
+            self.session.cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie.get("domain"),
+                path=cookie.get("path", "/"),
+            )
+
+    def select_value(self, spec, data, select_values=None):
+        """option.value gửi đi cho select: đọc từ trang nếu có, không thì tra option đã học."""
+        key = spec["key"]
+        if select_values and key in select_values:
+            return select_values[key]
+        if "options_for" in spec and spec["options_for"] != data.get("sales_date"):
+            raise ValueError(
+                f"Lựa chọn '{key}' phụ thuộc ngày bán, cần đọc lại từ trang."
+            )
+        value = resolve_option_value(spec["options"], key, data.get(key, ""))
+        if value is None:
+            raise ValueError(f"Không có lựa chọn '{data.get(key)}' cho '{key}'.")
+        return value
+
+    def build_payload(self, data, tokens, captcha_text=None, select_values=None):
+        payload = []
+        for name, spec in self.template["fields"]:
+            source = spec["source"]
+            if source == "data" and "options" in spec:
+                value = self.select_value(spec, data, select_values)
+            elif source == "data":
+                value = data.get(spec["key"], "")
+            elif source == "captcha":
+                value = captcha_text or ""
+            elif source == "token":
+                value = tokens.get(name, spec.get("value", ""))
+            else:
+                value = spec.get("value", "")
+            payload.append((name, value))
+        return payload
+
+    def submit(self, data, tokens, captcha_text=None, select_values=None):
+        """Gửi một dòng dữ liệu. Trả về (success, status_code)."""
+        payload = self.build_payload(data, tokens, captcha_text, select_values)
+        content_type = self.template["content_type"].lower()
+        # requests tự đặt content-type (kể cả boundary của multipart)
+        if "json" in content_type:
+            body = {"json": dict(payload)}
+        elif "multipart/form-data" in content_type:
+            body = {"files": {name: (None, str(value)) for name, value in payload}}
+        else:
+            body = {"data": payload}
+        response = self.session.request(
+            self.template["method"],
+            self.template["endpoint"],
+            headers=self.template["headers"],
+            timeout=30,
+            **body,
+        )
+        return self.is_success(response), response.status_code
+
+    def is_success(self, response):
+        expected_status = self.template.get("expected_status")
+        if expected_status and response.status_code != expected_status:
+            return False
+        if response.status_code >= 400:
+            return False
+        signature = self.template.get("success_signature") or {}
+        if "marker" in signature:
+            return signature["marker"] in response.text
+        if "json" in signature:
+            try:
+                payload = response.json()
+            except ValueError:
+                return False
+            return isinstance(payload, dict) and all(
+                payload.get(k) == v for k, v in signature["json"].items()
+            )
+        return True
+
+
+_WORKER_HTTP_ENGINE = None
+
+
+def read_select_values_in_page(driver, template, data, FORM_FIELD_IDS, timeout):
+    """Chọn ngày bán của dòng trên trang rồi đọc option.value của mọi select trong template."""
+    keys = [spec["key"] for _, spec in template["fields"] if "options" in spec]
+    sales_date_id = FORM_FIELD_IDS.get("sales_date")
+    session_id = FORM_FIELD_IDS.get("session")
+    if "session" in keys and sales_date_id and session_id and data.get("sales_date"):
+        # Danh sách phiên được nạp lại theo ngày bán vừa chọn
+        previous_options = mark_select_options(driver, session_id)
+        element = driver.find_element(By.ID, sales_date_id)
+        Select(element).select_by_visible_text(str(data["sales_date"]))
+        driver.execute_script(
+            "arguments[0].dispatchEvent(new Event('change'));", element
+        )
+        wait_for_dropdown_refresh(driver, session_id, previous_options, timeout)
+    select_values = {}
+    for key, element in read_form_elements(driver, FORM_FIELD_IDS, keys).items():
+        value = resolve_option_value(element["options"] or [], key, data.get(key, ""))
+        if value is not None:
+            select_values[key] = value
+    return select_values
+
+
+def submit_via_http_process(task_info):
+    """Worker engine HTTP: trình duyệt chỉ dùng để lấy CAPTCHA, token và cookie."""
+    global _WORKER_HTTP_ENGINE
+    template = task_info["submission_template"]
+    data = task_info["data"]
+    process_id = task_info["process_id"]
+    FORM_FIELD_IDS = task_info["FORM_FIELD_IDS"]
+    name_for_log = data.get("full_name", f"Task {process_id}")
+
+    if _WORKER_HTTP_ENGINE is None or _WORKER_HTTP_ENGINE.template != template:
+        _WORKER_HTTP_ENGINE = HttpReplayEngine(template)
+    engine = _WORKER_HTTP_ENGINE
+
+    try:
+        captcha_text, select_values = None, None
+        if engine.needs_browser(data):
+            browser_pool = get_worker_browser_pool()
+            driver = browser_pool.checkout(
+                task_info["options"],
+                task_info["url"],
+                task_info.get("driver_path"),
+                task_info.get("blocked_urls"),
+            )
+            try:
+                tokens = driver.execute_script(HIDDEN_INPUTS_SCRIPT)
+                if engine.needs_captcha:
+                    image_bytes = capture_captcha_image(
+                        driver,
+                        WebDriverWait(driver, 5),
+                        FORM_FIELD_IDS["captcha_image_selector"],
+                    )
+                select_values = read_select_values_in_page(
+                    driver,
+                    template,
+                    data,
+                    FORM_FIELD_IDS,
+                    task_info.get("dropdown_wait_timeout", DROPDOWN_WAIT_TIMEOUT),
+                )
+                engine.load_browser_cookies(driver.get_cookies())
+            finally:
+                browser_pool.checkin(driver)
+
+            if engine.needs_captcha:
+                captcha_text, last_error = solve_captcha_with_keys(
+                    task_info["api_keys"],
+                    image_bytes,
+                    process_id,
+                    task_info.get("captcha_service"),
+                )
+                if not captcha_text:
+                    print(
+                        f"[{process_id}] All API keys failed. Last error: {last_error}."
+                    )
+                    return False, name_for_log
+        else:
+            tokens = engine.fetch_tokens()
+
+        success, status_code = engine.submit(data, tokens, captcha_text, select_values)
+        print(
+            f"[{process_id}] HTTP replay -> {status_code} ({'OK' if success else 'FAILED'})"
+        )
+        if captcha_text and success:
+            report_captcha_outcome(
+                task_info.get("captcha_service"), image_bytes, success
+            )
+        return success, name_for_log
+
+    except Exception as e:
+        print(f"[{process_id}] CRITICAL ERROR in HTTP replay for '{name_for_log}': {e}")
+        return False, name_for_log
+
+
+def analyze_form_with_gemini(api_key, html_content, excel_columns):
+    if not LANGCHAIN_AVAILABLE:
+        return None, "Thư viện 'langchain-google-genai' chưa được cài đặt."
+    if not api_key:
+        return None, "API Key của Google AI bị thiếu."
+
+    try:
+        llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", google_api_key=api_key)
+
+        prompt_text = f"""
+        Bạn là một công cụ lập trình hỗ trợ điền form web. Nhiệm vụ của bạn là phân tích một đoạn mã HTML của form đăng ký và các tiêu đề cột từ một file Excel, sau đó tạo ra một đối tượng JSON với hai trường: "FORM_FIELD_IDS" và "EXCEL_COLUMN_MAPPING".
+
+        **ĐỊNH DẠNG ĐẦU RA BẮT BUỘC PHẢI LÀ MỘT CHUỖI JSON ĐÚNG CÚ PHÁP, KHÔNG CÓ BẤT KỲ VĂN BẢN NÀO KHÁC TRƯỚC HAY SAU NÓ.**
+
+        **Mô tả các trường:**
+        1.  **FORM_FIELD_IDS**: Một đối tượng JSON, ánh xạ tên trường chung sang 'id' HTML tương ứng của nó. Dựa vào nhãn (label) và thuộc tính của các phần tử để xác định ID đúng. Nếu không tìm thấy, hãy gán giá trị rỗng hoặc `null`.
+            -   `"full_name"`: Trường Tên đầy đủ.
+            -   `"day"`, `"month"`, `"year"`: Các trường cho Ngày, Tháng, Năm sinh.
+            -   `"phone_number"`: Số điện thoại.
+            -   `"email"`: Địa chỉ Email.
+            -   `"id_card"`: Số CCCD/CMND.
+            -   `"sales_date"`: Trường dropdown cho Ngày bán hàng.
+            -   `"session"`: Trường dropdown cho Phiên.
+            -   `"agree_checkbox"`: Checkbox đồng ý điều khoản.
+            -   `"captcha"`: Trường nhập mã CAPTCHA.
+            -   `"captcha_image_selector"`: **(QUAN TRỌNG)** Một CSS selector để tìm thẻ `<img>` của CAPTCHA. Ví dụ: "#dvCaptcha img" hoặc ".captcha-image-class".
+            -   `"submit_button"`: Nút gửi form.
+
+        2.  **EXCEL_COLUMN_MAPPING**: Một đối tượng JSON, ánh xạ tên trường chung sang tên tiêu đề cột Excel tương ứng từ danh sách được cung cấp. Nếu không tìm thấy cột phù hợp, hãy gán giá trị `null`.
+
+        **Đầu vào của bạn:**
+        -   **HTML Form:**
+        ```html
+        {html_content}
+        ```
+
+        -   **Excel Columns:**
+        ```json
+        {excel_columns}
+        ```
+        """
+
+        message = HumanMessage(content=prompt_text)
+        response = llm.invoke([message])
+
+        json_content = (
+            response.content.strip().replace("```json", "").replace("```", "")
+        )
+        mapping_data = json.loads(json_content)
+
+        if "FORM_FIELD_IDS" in mapping_data and "EXCEL_COLUMN_MAPPING" in mapping_data:
+            return mapping_data, None
+        else:
+            return None, "Cấu trúc JSON trả về không đúng."
+
+    except Exception as e:
+        return None, str(e)
+
+
+# --- PHÂN TÍCH FORM BẰNG LUẬT (LLM CHỈ LÀ DỰ PHÒNG) ---
+HEURISTIC_CONFIDENCE_THRESHOLD = 0.6
+# Các trường bắt buộc: không tìm thấy bằng luật thì mới cần hỏi LLM
+HEURISTIC_REQUIRED_KEYS = (
+    "full_name",
+    "phone_number",
+    "id_card",
+    "sales_date",
+    "session",
+    "captcha",
+    "captcha_image_selector",
+    "submit_button",
+)
+# Các trường lấy dữ liệu từ Excel (day = cột ngày sinh, được tách ra ngày/tháng/năm)
+EXCEL_DATA_KEYS = ("full_name", "day", "phone_number", "email", "id_card")
+
+# Từ khóa (đã bỏ dấu, viết thường) cho từng trường chuẩn
+FIELD_KEYWORDS = {
+    "full_name": ["ho ten", "ho va ten", "hoten", "full name", "fullname", "ten"],
+    "day": ["ngay sinh", "birth day", "dob day", "day", "ngay"],
+    "month": ["thang sinh", "birth month", "dob month", "month", "thang"],
+    "year": ["nam sinh", "birth year", "dob year", "year", "nam"],
+    "phone_number": [
+        "so dien thoai",
+        "dien thoai",
+        "sdt",
+        "phone",
+        "mobile",
+        "tel",
+    ],
+    "email": ["email", "e mail", "thu dien tu"],
+    "id_card": [
+        "cccd",
+        "cmnd",
+        "can cuoc",
+        "ho chieu",
+        "passport",
+        "id card",
+        "idcard",
+        "identity",
+    ],
+    "sales_date": ["ngay ban hang", "ngay ban", "ngay mua", "sales date", "sale date"],
+    "session": ["phien", "session", "khung gio", "ca mua", "time slot"],
+    "agree_checkbox": ["dong y", "dieu khoan", "chap nhan", "agree", "terms"],
+    "captcha": ["captcha", "ma xac nhan", "ma bao ve", "ma kiem tra", "verify code"],
+    "submit_button": ["dang ky", "gui", "submit", "register", "xac nhan"],
+}
+# Cụm từ loại trừ: "Ngày bán hàng" chứa "ngay" nhưng không phải ngày sinh
+FIELD_NEGATIVE_KEYWORDS = {
+    "day": ["ngay ban", "ngay mua", "ban hang", "mua hang", "ngay cap", "het han"],
+    "month": ["thang ban", "thang mua", "ban hang", "mua hang", "thang cap"],
+    "year": ["nam ban", "nam mua", "ban hang", "mua hang", "nam cap"],
+}
+TEXT_KINDS = ("text", "email", "tel", "number", "textarea", "search")
+FIELD_KINDS = {
+    "full_name": TEXT_KINDS,
+    "day": TEXT_KINDS + ("select",),
+    "month": TEXT_KINDS + ("select",),
+    "year": TEXT_KINDS + ("select",),
+    "phone_number": TEXT_KINDS,
+    "email": TEXT_KINDS,
+    "id_card": TEXT_KINDS,
+    "sales_date": ("select",),
+    "session": ("select",),
+    "agree_checkbox": ("checkbox",),
+    "captcha": TEXT_KINDS,
+    "submit_button": ("submit", "button"),
+}
+KIND_BONUS = {
+    ("email", "email"): 0.4,
+    ("phone_number", "tel"): 0.3,
+    ("submit_button", "submit"): 0.3,
+}
+EXCEL_HEADER_KEYWORDS = {
+    "full_name": ["ho ten", "ho va ten", "ten", "full name", "name"],
+    "day": ["ngay sinh", "ngay thang nam sinh", "dob", "date of birth", "birthday"],
+    "phone_number": ["so dien thoai", "dien thoai", "sdt", "phone", "mobile"],
+    "email": ["email", "e mail", "mail"],
+    "id_card": ["cccd ho chieu", "cccd", "cmnd", "ho chieu", "can cuoc", "passport"],
+}
+VOID_TAGS = ("input", "img", "br", "hr", "meta", "link", "source", "area", "wbr")
+
+
+def normalize_text(text):
+    """Bỏ dấu tiếng Việt, tách camelCase, chỉ giữ chữ và số: 'Số điện thoại' -> 'so dien thoai'."""
+    text = str(text or "").replace("đ", "d").replace("Đ", "D")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn")
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", text)
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+class _FormElementParser(HTMLParser):
+    """Thu thập phần tử form, nhãn liên quan và ảnh CAPTCHA ứng viên."""
+
+    def __init__(self):
+        super().__init__()
+        self.elements = []
+        self.images = []
+        self.labels_for = {}
+        self._stack = []
+        self._open_label = None
+        self._open_button = None
+        self._last_text = ""
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {k: v or "" for k, v in attrs}
+        if tag in ("script", "style"):
+            self._skip_depth += 1
+            return
+        if tag == "label":
+            self._open_label = {"for": attrs.get("for"), "text": [], "children": []}
+        elif tag in ("input", "select", "textarea", "button"):
+            self._add_element(tag, attrs)
+        elif tag == "img":
+            container = " ".join(f"{i} {c}" for _, i, c in self._stack)
+            self.images.append(
+                {
+                    "id": attrs.get("id", ""),
+                    "class": attrs.get("class", ""),
+                    "src": attrs.get("src", ""),
+                    "alt": attrs.get("alt", ""),
+                    "container": container,
+                    "container_id": next(
+                        (i for _, i, _ in reversed(self._stack) if i), ""
+                    ),
+                }
+            )
+        if tag not in VOID_TAGS:
+            self._stack.append((tag, attrs.get("id", ""), attrs.get("class", "")))
+
+    def _add_element(self, tag, attrs):
+        input_type = (attrs.get("type") or "").lower()
+        if tag == "input":
+            kind = input_type or "text"
+        elif tag == "button":
+            kind = "button" if input_type in ("button", "reset") else "submit"
+        else:
+            kind = tag
+        element = {
+            "tag": tag,
+            "kind": kind,
+            "id": attrs.get("id", ""),
+            "name": attrs.get("name", ""),
+            "placeholder": attrs.get("placeholder", ""),
+            "aria": attrs.get("aria-label", "") + " " + attrs.get("title", ""),
+            "text": attrs.get("value", "") if kind in ("submit", "button") else "",
+            "label": "",
+            "context": self._last_text,
+        }
+        self._last_text = ""
+        self.elements.append(element)
+        if self._open_label is not None:
+            self._open_label["children"].append(element)
+        if tag == "button":
+            self._open_button = element
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self._skip_depth = max(0, self._skip_depth - 1)
+            return
+        if tag == "label" and self._open_label is not None:
+            text = " ".join(self._open_label["text"])
+            if self._open_label["for"]:
+                self.labels_for[self._open_label["for"]] = text
+            for child in self._open_label["children"]:
+                child["label"] = child["label"] or text
+            self._open_label = None
+        elif tag == "button":
+            self._open_button = None
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i][0] == tag:
+                del self._stack[i:]
+                break
+
+    def handle_data(self, data):
+        text = " ".join(data.split())
+        if self._skip_depth or not text:
+            return
+        if self._open_label is not None:
+            self._open_label["text"].append(text)
+        if self._open_button is not None:
+            self._open_button["text"] += " " + text
+        self._last_text = text[-200:]
+
+
+def _score_element(key, element):
+    """Điểm tin cậy (0..1) rằng phần tử là trường chuẩn `key`."""
+    if element["kind"] not in FIELD_KINDS[key]:
+        return 0.0
+    sources = [
+        (normalize_text(element["label"]), 0.7),
+        (normalize_text(f"{element['id']} {element['name']}"), 0.6),
+        (normalize_text(element["text"]), 0.6),
+        (normalize_text(f"{element['placeholder']} {element['aria']}"), 0.55),
+        (normalize_text(element["context"]), 0.45),
+    ]
+    negatives = FIELD_NEGATIVE_KEYWORDS.get(key, [])
+    sources = [
+        (text, weight)
+        for text, weight in sources
+        if not any(
+            f" {negative} " in f" {text} "
+            or negative.replace(" ", "") in text.replace(" ", "")
+            for negative in negatives
+        )
+    ]
+    best = 0.0
+    for keyword in FIELD_KEYWORDS[key]:
+        compact_keyword = keyword.replace(" ", "")
+        for text, weight in sources:
+            if not text:
+                continue
+            if f" {keyword} " in f" {text} ":
+                best = max(best, weight)
+            elif len(compact_keyword) >= 4 and compact_keyword in text.replace(" ", ""):
+                best = max(best, weight - 0.1)
+    if not best:
+        return 0.0
+    return min(1.0, best + KIND_BONUS.get((key, element["kind"]), 0.0))
+
+
+def _assign_jointly(candidates):
+    """Ghép trường với phần tử sao cho tổng điểm lớn nhất (thuật toán Hungary).
+
+    `candidates` là danh sách (điểm, trường, id phần tử). Trả về {trường: (id, điểm)}.
+    Mỗi trường có thêm một cột "không gán" điểm 0 nên trường không có ứng viên tốt
+    sẽ để trống thay vì lấy mất phần tử của trường khác.
+    """
+    keys = sorted({key for _, key, _ in candidates})
+    ids = sorted({element_id for _, _, element_id in candidates})
+    scores = {(key, element_id): score for score, key, element_id in candidates}
+    n, m = len(keys), len(ids) + len(keys)
+
+    def cost(row, column):
+        if column > len(ids):
+            return 0.0
+        return -scores.get((keys[row - 1], ids[column - 1]), 0.0)
+
+    # Chỉ số từ 1; cột 0 là cột giả của thuật toán
+    u, v = [0.0] * (n + 1), [0.0] * (m + 1)
+    owner, way = [0] * (m + 1), [0] * (m + 1)
+    for row in range(1, n + 1):
+        owner[0], column = row, 0
+        min_slack, used = [float("inf")] * (m + 1), [False] * (m + 1)
+        while owner[column]:
+            used[column] = True
+            current, delta, next_column = owner[column], float("inf"), 0
+            for j in range(1, m + 1):
+                if used[j]:
+                    continue
+                slack = cost(current, j) - u[current] - v[j]
+                if slack < min_slack[j]:
+                    min_slack[j], way[j] = slack, column
+                if min_slack[j] < delta:
+                    delta, next_column = min_slack[j], j
+            for j in range(m + 1):
+                if used[j]:
+                    u[owner[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_slack[j] -= delta
+            column = next_column
+        while column:
+            owner[column] = owner[way[column]]
+            column = way[column]
+
+    assignment = {}
+    for column in range(1, len(ids) + 1):
+        if owner[column]:
+            key, element_id = keys[owner[column] - 1], ids[column - 1]
+            if scores.get((key, element_id)):
+                assignment[key] = (element_id, scores[(key, element_id)])
+    return assignment
+
+
+def _find_captcha_image_selector(images):
+    """Tạo CSS selector cho ảnh CAPTCHA. Trả về (selector, độ tin cậy)."""
+    best, best_score = None, 0.0
+    for img in images:
+        own = normalize_text(
+            " ".join([img["id"], img["class"], img["src"], img["alt"]])
+        )
+        container = normalize_text(img["container"])
+        if "captcha" in own.replace(" ", ""):
+            score = 0.9
+        elif "captcha" in container.replace(" ", ""):
+            score = 0.75
+        else:
+            continue
+        if img["id"]:
+            selector = f"#{img['id']}"
+        elif img["container_id"]:
+            selector = f"#{img['container_id']} img"
+        elif img["class"].split():
+            selector = f"img.{img['class'].split()[0]}"
+        else:
+            selector = "img[src*='aptcha']"
+        if score > best_score:
+            best, best_score = selector, score
+    return best, best_score
+
+
+def match_excel_columns(excel_columns):
+    """Khớp mờ tiêu đề cột Excel với các trường dữ liệu. Trả về (mapping, độ tin cậy)."""
+    candidates = []
+    for key, keywords in EXCEL_HEADER_KEYWORDS.items():
+        for column in excel_columns:
+            header = normalize_text(column)
+            if not header:
+                continue
+            score = 0.0
+            for keyword in keywords:
+                if header == keyword:
+                    score = max(score, 1.0)
+                elif f" {keyword} " in f" {header} ":
+                    score = max(score, 0.85)
+                else:
+                    score = max(
+                        score, difflib.SequenceMatcher(None, header, keyword).ratio()
+                    )
+            candidates.append((score, key, column))
+
+    mapping = {key: None for key in EXCEL_HEADER_KEYWORDS}
+    confidences = {key: 0.0 for key in EXCEL_HEADER_KEYWORDS}
+    used_columns = set()
+    for score, key, column in sorted(candidates, key=lambda c: -c[0]):
+        if score < HEURISTIC_CONFIDENCE_THRESHOLD:
+            break
+        if mapping[key] is None and column not in used_columns:
+            mapping[key] = column
+            confidences[key] = round(score, 2)
+            used_columns.add(column)
+    return mapping, confidences
+
+
+def analyze_form_heuristically(html_content, excel_columns):
+    """Phân tích form bằng luật, không gọi mạng. Trả về (mapping_data, confidences).
+
+    mapping_data có cùng cấu trúc với kết quả của `analyze_form_with_gemini`.
+    """
+    parser = _FormElementParser()
+    parser.feed(html_content)
+    for element in parser.elements:
+        if element["id"] in parser.labels_for:
+            element["label"] = parser.labels_for[element["id"]]
+
+    candidates = []
+    for element in parser.elements:
+        if not element["id"]:
+            continue  # Worker tìm phần tử theo ID
+        for key in FIELD_KEYWORDS:
+            score = _score_element(key, element)
+            if score:
+                candidates.append((score, key, element["id"]))
+
+    form_ids = {key: None for key in FIELD_KEYWORDS}
+    form_confidences = {key: 0.0 for key in FIELD_KEYWORDS}
+    for key, (element_id, score) in _assign_jointly(candidates).items():
+        form_ids[key] = element_id
+        form_confidences[key] = round(score, 2)
+
+    selector, selector_score = _find_captcha_image_selector(parser.images)
+    form_ids["captcha_image_selector"] = selector
+    form_confidences["captcha_image_selector"] = selector_score
+
+    excel_mapping, excel_confidences = match_excel_columns(excel_columns)
+    return (
+        {"FORM_FIELD_IDS": form_ids, "EXCEL_COLUMN_MAPPING": excel_mapping},
+        {"FORM_FIELD_IDS": form_confidences, "EXCEL_COLUMN_MAPPING": excel_confidences},
+    )
+
+
+def low_confidence_keys(confidences, threshold=HEURISTIC_CONFIDENCE_THRESHOLD):
+    """Các trường cần hỏi LLM: trường tìm được nhưng điểm thấp, hoặc trường bắt buộc bị thiếu."""
+    form_keys = [
+        key
+        for key, score in confidences["FORM_FIELD_IDS"].items()
+        if score < threshold and (score > 0 or key in HEURISTIC_REQUIRED_KEYS)
+    ]
+    excel_keys = [
+        key
+        for key, score in confidences["EXCEL_COLUMN_MAPPING"].items()
+        if score < threshold and confidences["FORM_FIELD_IDS"].get(key, 0) >= threshold
+    ]
+    return form_keys, excel_keys
+
+
+def merge_llm_mapping(mapping_data, llm_mapping, form_keys, excel_keys):
+    """Chỉ lấy kết quả LLM cho các trường mà luật chưa chắc chắn."""
+    for section, keys in (
+        ("FORM_FIELD_IDS", form_keys),
+        ("EXCEL_COLUMN_MAPPING", excel_keys),
+    ):
+        for key in keys:
+            value = (llm_mapping.get(section) or {}).get(key)
+            if value:
+                mapping_data[section][key] = value
+    return mapping_data
+
+
+# --- RÚT GỌN HTML TRƯỚC KHI GỬI GEMINI ---
+# Các thẻ bị bỏ hoàn toàn cùng nội dung bên trong
+MINIFY_DROP_TAGS = (
+    "script",
+    "style",
+    "svg",
+    "noscript",
+    "iframe",
+    "head",
+    "link",
+    "meta",
+    "template",
+)
+# Thẻ bao ngoài không có thuộc tính cần giữ thì chỉ giữ nội dung bên trong
+MINIFY_UNWRAP_TAGS = (
+    "div",
+    "span",
+    "p",
+    "section",
+    "article",
+    "main",
+    "header",
+    "footer",
+    "nav",
+    "font",
+    "b",
+    "strong",
+    "i",
+    "em",
+    "small",
+    "ul",
+    "ol",
+    "li",
+    "table",
+    "thead",
+    "tbody",
+    "tr",
+    "td",
+    "th",
+    "center",
+    "html",
+    "body",
+)
+MINIFY_KEPT_ATTRS = ("id", "name", "type", "for", "placeholder")
+MINIFY_MAX_OPTIONS = 8
+MINIFY_MAX_SRC_LENGTH = 80
+
+
+class _FormHtmlMinifier(HTMLParser):
+    """Xuất lại HTML chỉ gồm cây <form> với các thuộc tính cần cho việc ánh xạ trường."""
+
+    def __init__(self, forms_only):
+        super().__init__()
+        self.forms_only = forms_only
+        self.out = []
+        self._form_depth = 0
+        self._drop_depth = 0
+        self._emitted_stack = []
+        self._option_count = 0
+        self._skipping_option = False
+
+    def _emitting(self):
+        return not self._drop_depth and (not self.forms_only or self._form_depth)
+
+    def _kept_attrs(self, tag, attrs):
+        kept = [(k, v) for k, v in attrs.items() if k in MINIFY_KEPT_ATTRS and v]
+        identity = f"{attrs.get('id', '')} {attrs.get('class', '')}".lower()
+        if "captcha" in identity and attrs.get("class"):
+            kept.append(("class", attrs["class"]))
+        input_type = (attrs.get("type") or "").lower()
+        if attrs.get("value") and (
+            tag in ("option", "button")
+            or input_type in ("submit", "button", "checkbox", "radio")
+        ):
+            kept.append(("value", attrs["value"]))
+        if tag == "img":
+            src = attrs.get("src") or ""
+            if src.startswith("data:"):
+                src = src.split(",", 1)[0] + ",..."
+            kept += [("src", src[:MINIFY_MAX_SRC_LENGTH]), ("alt", attrs.get("alt"))]
+        return [(k, v) for k, v in kept if v]
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag in MINIFY_DROP_TAGS:
+            if tag not in VOID_TAGS:
+                self._drop_depth += 1
+            return
+        if tag == "form":
+            self._form_depth += 1
+        if tag == "select":
+            self._option_count = 0
+        if tag == "option":
+            self._option_count += 1
+            if self._option_count > MINIFY_MAX_OPTIONS:
+                self._skipping_option = True
+                return
+
+        kept = self._kept_attrs(tag, attrs)
+        emit = self._emitting() and not (tag in MINIFY_UNWRAP_TAGS and not kept)
+        if emit:
+            attr_text = "".join(
+                f' {k}="{html.escape(str(v), quote=True)}"' for k, v in kept
+            )
+            self.out.append(f"<{tag}{attr_text}>")
+        if tag not in VOID_TAGS:
+            self._emitted_stack.append((tag, emit))
+
+    def handle_endtag(self, tag):
+        if tag in MINIFY_DROP_TAGS:
+            if tag not in VOID_TAGS:
+                self._drop_depth = max(0, self._drop_depth - 1)
+            return
+        if tag == "option" and self._skipping_option:
+            self._skipping_option = False
+            return
+        if tag == "select" and self._option_count > MINIFY_MAX_OPTIONS:
+            if self._emitting():
+                hidden = self._option_count - MINIFY_MAX_OPTIONS
+                self.out.append(f"<option>...(+{hidden})</option>")
+        for i in range(len(self._emitted_stack) - 1, -1, -1):
+            if self._emitted_stack[i][0] == tag:
+                emitted = self._emitted_stack[i][1]
+                del self._emitted_stack[i:]
+                if emitted:
+                    self.out.append(f"</{tag}>")
+                break
+        if tag == "form":
+            self._form_depth = max(0, self._form_depth - 1)
+
+    def handle_data(self, data):
+        text = " ".join(data.split())
+        if text and self._emitting() and not self._skipping_option:
+            self.out.append(html.escape(text, quote=False))
+
+
+def minify_form_html(html_content):
+    """Tách cây <form> (cả trang nếu không có form) và bỏ phần thừa.
+
+    Trả về (html_rút_gọn, số ký tự trước, số ký tự sau).
+    """
+    forms_only = re.search(r"<form[\s>]", html_content, flags=re.I) is not None
+    minifier = _FormHtmlMinifier(forms_only)
+    minifier.feed(html_content)
+    minifier.close()
+    minified = "".join(minifier.out)
+    return minified, len(html_content), len(minified)
+
+
+# --- PROBE MỘT LẦN: ẢNH CHỤP TRANG (HTML + DROPDOWN + CAPTCHA) ---
+PROBE_SELECT_TIMEOUT = 10
+
+# Trả về HTML, các bộ option của mọi <select> và vị trí các ảnh giống CAPTCHA
+PAGE_SNAPSHOT_SCRIPT = """
+const selects = {};
+document.querySelectorAll('select').forEach((s, i) => {
+    selects[s.id || s.name || ('select#' + i)] = Array.from(s.options).map(
+        o => ({text: o.text.trim(), value: o.value}));
+});
+const captcha = [];
+document.querySelectorAll('img, canvas').forEach(el => {
+    const ident = [el.id, el.className, el.getAttribute('src'), el.getAttribute('alt')]
+        .join(' ').toLowerCase();
+    if (!ident.includes('captcha')) return;
+    const r = el.getBoundingClientRect();
+    const cls = typeof el.className === 'string' ? el.className.trim() : '';
+    captcha.push({
+        selector: el.id ? '#' + el.id
+            : el.tagName.toLowerCase() + (cls ? '.' + cls.split(/\\s+/).join('.') : ''),
+        tag: el.tagName.toLowerCase(),
+        x: r.left + window.scrollX, y: r.top + window.scrollY,
+        width: r.width, height: r.height,
+    });
+});
+return {html: document.documentElement.outerHTML, selects: selects, captcha: captcha};
+"""
+
+
+def take_page_snapshot(driver, url, select_timeout=PROBE_SELECT_TIMEOUT):
+    """Tải trang một lần và trả về ảnh chụp trang dạng dict.
+
+    Gồm 'html', 'selects' ({id: [{text, value}]}) và 'captcha' (vị trí các ảnh
+    có dấu hiệu CAPTCHA), dùng chung cho phân tích form và tạo task.
+    """
+    driver.get(url)
+    try:
+        # Dropdown thường được điền bằng JS sau khi trang tải xong
+        WebDriverWait(driver, select_timeout).until(
+            lambda d: d.execute_script(
+                "return Array.from(document.querySelectorAll('select'))"
+                ".some(s => s.options.length > 1);"
+            )
+        )
+    except TimeoutException:
+        pass
+    return driver.execute_script(PAGE_SNAPSHOT_SCRIPT)
+
+
+def snapshot_sales_dates(snapshot, sales_date_id):
+    """Các ngày bán hợp lệ trong dropdown sales_date của ảnh chụp trang."""
+    return [
+        option["text"]
+        for option in snapshot["selects"].get(sales_date_id, [])
+        if "--" not in option["text"] and option["value"]
+    ]
+
+
+def snapshot_captcha_geometry(snapshot, captcha_image_selector):
+    """Vị trí ảnh CAPTCHA theo selector của mapping (hoặc ứng viên đầu tiên)."""
+    candidates = snapshot.get("captcha") or []
+    for candidate in candidates:
+        if candidate["selector"] == captcha_image_selector:
+            return candidate
+    return candidates[0] if candidates else None
+
+
+# --- CACHE MAPPING THEO VÂN TAY CẤU TRÚC FORM ---
+MAPPING_CACHE_FILE = "form_mapping_cache.json"
+MAPPING_CACHE_MAX_ENTRIES = 20
+FINGERPRINT_TAGS = ("form", "input", "select", "textarea", "button", "label", "img")
+# Chuỗi hex/base64 dài trong id/name thường là token sinh ngẫu nhiên mỗi lần tải
+VOLATILE_TOKEN_RE = re.compile(r"[0-9a-fA-F]{12,}|[A-Za-z0-9+/_-]{32,}")
+
+
+class _FormStructureParser(HTMLParser):
+    """Thu thập cấu trúc form: tag, id, name, type, for và text của label."""
+
+    def __init__(self):
+        super().__init__()
+        self.tokens = []
+        self._label_text = None
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self._skip_depth += 1
+            return
+        if tag not in FINGERPRINT_TAGS:
+            return
+        attrs = dict(attrs)
+        parts = [tag] + [
+            VOLATILE_TOKEN_RE.sub("*", attrs.get(name) or "")
+            for name in ("id", "name", "type", "for")
+        ]
+        self.tokens.append("|".join(parts))
+        if tag == "label":
+            self._label_text = []
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag == "label" and self._label_text is not None:
+            self.tokens.append("label-text|" + " ".join(self._label_text))
+            self._label_text = None
+
+    def handle_data(self, data):
+        if self._label_text is not None and not self._skip_depth and data.strip():
+            self._label_text.append(" ".join(data.split()))
+
+
+def compute_form_fingerprint(html_content):
+    """Băm cấu trúc form (bỏ qua giá trị input và token ngẫu nhiên)."""
+    parser = _FormStructureParser()
+    parser.feed(html_content)
+    return hashlib.sha256("\n".join(parser.tokens).encode("utf-8")).hexdigest()
+
 
-        return success, name_for_log
+def mapping_cache_key(html_content, excel_columns):
+    """Khóa cache = vân tay form + tập tiêu đề cột Excel (không phụ thuộc thứ tự)."""
+    headers = json.dumps(sorted(str(c) for c in excel_columns), ensure_ascii=False)
+    return hashlib.sha256(
+        f"{compute_form_fingerprint(html_content)}|{headers}".encode("utf-8")
+    ).hexdigest()
 
-    except Exception as e:
-        print(f"[{process_id}] CRITICAL ERROR in process for '{name_for_log}': {e}")
-        return False, name_for_log
 
-    finally:
-        # <<< LOGIC QUYẾT ĐỊNH ĐÓNG TAB >>>
-        if driver:
-            # Chỉ đóng tab nếu: 1. Thành công, HOẶC 2. Người dùng không muốn giữ lại tab lỗi
-            if success or not keep_failed_tab:
-                time.sleep(1)  # Chờ 1 giây trước khi đóng
-                driver.quit()
-            else:
-                # Nếu thất bại và người dùng muốn giữ lại tab
-                print(
-                    f"[{process_id}] THẤT BẠI. Giữ lại tab của '{name_for_log}' để kiểm tra."
-                )
-                # Để tab lại và không làm gì cả
+class FormMappingCache:
+    """Cache mapping bền vững trên đĩa, loại bỏ mục lâu không dùng nhất (LRU)."""
 
+    def __init__(self, path=MAPPING_CACHE_FILE, max_entries=MAPPING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = self._load()
 
-def analyze_form_with_gemini(api_key, html_content, excel_columns):
-    if not LANGCHAIN_AVAILABLE:
-        return None, "Thư viện 'langchain-google-genai' chưa được cài đặt."
-    if not api_key:
-        return None, "API Key của Google AI bị thiếu."
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f).get("entries", {})
+        except (OSError, ValueError):
+            return {}
 
-    try:
-        llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash", google_api_key=api_key)
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
 
-        prompt_text = f"""
-        Bạn là một công cụ lập trình hỗ trợ điền form web. Nhiệm vụ của bạn là phân tích một đoạn mã HTML của form đăng ký và các tiêu đề cột từ một file Excel, sau đó tạo ra một đối tượng JSON với hai trường: "FORM_FIELD_IDS" và "EXCEL_COLUMN_MAPPING".
+    def get(self, key):
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+        entry["last_used"] = time.time()
+        self._save()
+        return entry["mapping"]
 
-        **ĐỊNH DẠNG ĐẦU RA BẮT BUỘC PHẢI LÀ MỘT CHUỖI JSON ĐÚNG CÚ PHÁP, KHÔNG CÓ BẤT KỲ VĂN BẢN NÀO KHÁC TRƯỚC HAY SAU NÓ.**
+    def put(self, key, mapping, url=None):
+        now = time.time()
+        self.entries[key] = {
+            "mapping": mapping,
+            "url": url,
+            "created": now,
+            "last_used": now,
+        }
+        while len(self.entries) > self.max_entries:
+            oldest = min(self.entries, key=lambda k: self.entries[k]["last_used"])
+            del self.entries[oldest]
+        self._save()
 
-        **Mô tả các trường:**
-        1.  **FORM_FIELD_IDS**: Một đối tượng JSON, ánh xạ tên trường chung sang 'id' HTML tương ứng của nó. Dựa vào nhãn (label) và thuộc tính của các phần tử để xác định ID đúng. Nếu không tìm thấy, hãy gán giá trị rỗng hoặc `null`.
-            -   `"full_name"`: Trường Tên đầy đủ.
-            -   `"day"`, `"month"`, `"year"`: Các trường cho Ngày, Tháng, Năm sinh.
-            -   `"phone_number"`: Số điện thoại.
-            -   `"email"`: Địa chỉ Email.
-            -   `"id_card"`: Số CCCD/CMND.
-            -   `"sales_date"`: Trường dropdown cho Ngày bán hàng.
-            -   `"session"`: Trường dropdown cho Phiên.
-            -   `"agree_checkbox"`: Checkbox đồng ý điều khoản.
-            -   `"captcha"`: Trường nhập mã CAPTCHA.
-            -   `"captcha_image_selector"`: **(QUAN TRỌNG)** Một CSS selector để tìm thẻ `<img>` của CAPTCHA. Ví dụ: "#dvCaptcha img" hoặc ".captcha-image-class".
-            -   `"submit_button"`: Nút gửi form.
 
-        2.  **EXCEL_COLUMN_MAPPING**: Một đối tượng JSON, ánh xạ tên trường chung sang tên tiêu đề cột Excel tương ứng từ danh sách được cung cấp. Nếu không tìm thấy cột phù hợp, hãy gán giá trị `null`.
+# --- DÒNG LỆNH: CÔNG CỤ BỘ GIẢI CAPTCHA ---
+def run_captcha_cli(argv):
+    """python auto_form_filler.py captcha <generate|train|benchmark|export> ..."""
+    parser = argparse.ArgumentParser(
+        prog="auto_form_filler.py captcha",
+        description="Sinh dữ liệu, huấn luyện và đo bộ giải CAPTCHA cục bộ.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
 
-        **Đầu vào của bạn:**
-        -   **HTML Form:**
-        ```html
-        {html_content}
-        ```
+    generate = commands.add_parser("generate", help="Sinh bộ CAPTCHA tổng hợp có nhãn")
+    generate.add_argument("output_dir")
+    generate.add_argument("--count", type=int, default=2000)
+    generate.add_argument("--length", type=int, default=5)
+    generate.add_argument("--seed", type=int, default=0)
 
-        -   **Excel Columns:**
-        ```json
-        {excel_columns}
-        ```
-        """
+    train = commands.add_parser("train", help="Huấn luyện model từ thư mục ảnh có nhãn")
+    train.add_argument("data_dir")
+    train.add_argument("--model", default=LOCAL_CAPTCHA_MODEL_FILE)
+    train.add_argument("--epochs", type=int, default=LOCAL_CAPTCHA_TRAIN_EPOCHS)
 
-        message = HumanMessage(content=prompt_text)
-        response = llm.invoke([message])
+    benchmark = commands.add_parser(
+        "benchmark", help="Đo độ chính xác / thời gian trên thư mục ảnh có nhãn"
+    )
+    benchmark.add_argument("data_dir")
+    benchmark.add_argument("--model", default=LOCAL_CAPTCHA_MODEL_FILE)
+    benchmark.add_argument(
+        "--min-confidence", type=float, default=LOCAL_CAPTCHA_MIN_CONFIDENCE
+    )
+    benchmark.add_argument(
+        "--api-keys", default="", help="Thêm Gemini làm bộ dự phòng (dấu phẩy)"
+    )
 
-        json_content = (
-            response.content.strip().replace("```json", "").replace("```", "")
+    export = commands.add_parser(
+        "export", help="Xuất bộ dữ liệu đã thu thập thành thư mục ảnh có nhãn"
+    )
+    export.add_argument("output_dir")
+    export.add_argument("--dataset", default=CAPTCHA_DATASET_DIR)
+    export.add_argument(
+        "--all",
+        action="store_true",
+        help="Xuất cả đáp án chưa được trang xác nhận là đúng",
+    )
+
+    args = parser.parse_args(argv)
+    if args.command == "export":
+        dataset = CaptchaDataset(args.dataset)
+        count = dataset.export(args.output_dir, only_success=not args.all)
+        print(f"Đã xuất {count}/{len(dataset.records())} ảnh vào {args.output_dir}")
+        return 0
+    if not PIL_AVAILABLE:
+        print(PIL_MISSING_ERROR)
+        return 1
+
+    if args.command == "generate":
+        count = generate_captcha_corpus(
+            args.output_dir, args.count, args.length, seed=args.seed
         )
-        mapping_data = json.loads(json_content)
+        print(f"Đã sinh {count} ảnh vào {args.output_dir}")
+    elif args.command == "train":
+        samples = load_labelled_captchas(args.data_dir)
+        started = time.perf_counter()
+        model, skipped = LocalCaptchaModel.train(samples, epochs=args.epochs)
+        model.save(args.model)
+        print(
+            f"Đã huấn luyện trên {len(samples) - skipped}/{len(samples)} ảnh "
+            f"({len(model.classes)} ký tự) sau {time.perf_counter() - started:.1f}s"
+            f" -> {args.model}"
+        )
+    elif args.command == "benchmark":
+        samples = load_labelled_captchas(args.data_dir)
+        backends = [
+            LocalCaptchaBackend(LocalCaptchaModel.load(args.model), args.min_confidence)
+        ]
+        api_keys = [key.strip() for key in args.api_keys.split(",") if key.strip()]
+        if api_keys:
+            backends.append(GeminiCaptchaBackend(ApiKeyScheduler(api_keys)))
+        service = CaptchaSolverService(backends)
+        for name, backend in [(b.name, b) for b in backends] + [("tổng", service)]:
+            result = benchmark_captcha_backend(backend, samples)
+            print(
+                f"{name}: đúng {result['correct']}/{result['total']} "
+                f"({result['accuracy']:.1%}), trả lời {result['answered']}, "
+                f"TB {result['mean_ms']:.1f}ms, p95 {result['p95_ms']:.1f}ms"
+            )
+        service.stop()
+    return 0
 
-        if "FORM_FIELD_IDS" in mapping_data and "EXCEL_COLUMN_MAPPING" in mapping_data:
-            return mapping_data, None
-        else:
-            return None, "Cấu trúc JSON trả về không đúng."
 
-    except Exception as e:
-        return None, str(e)
+# --- DÒNG LỆNH: CHUYỂN FILE ĐẦU VÀO LỚN SANG CACHE DẠNG CỘT ---
+def run_convert_cli(argv):
+    """python auto_form_filler.py convert <file> [<file> ...] [--force]"""
+    parser = argparse.ArgumentParser(
+        prog="auto_form_filler.py convert",
+        description="Đọc file Excel/CSV/JSONL lớn một lần và ghi cache Parquet cạnh file"
+        " gốc; các lần chạy sau đọc cache khi file gốc chưa đổi (mtime + sha256).",
+    )
+    parser.add_argument("files", nargs="+")
+    parser.add_argument(
+        "--force", action="store_true", help="Ghi lại cache kể cả khi còn hợp lệ"
+    )
+    args = parser.parse_args(argv)
+    if not PYARROW_AVAILABLE:
+        print("Cần cài đặt 'pyarrow' để tạo cache Parquet.")
+        return 1
+
+    status = 0
+    for path in args.files:
+        started = time.perf_counter()
+        try:
+            cache_path, row_count, reused = build_table_cache(path, args.force)
+        except (OSError, ValueError) as e:
+            print(f"{path}: lỗi - {e}")
+            status = 1
+            continue
+        action = "cache còn hợp lệ" if reused else "đã ghi cache"
+        print(
+            f"{path}: {action}, {row_count} dòng -> {cache_path}"
+            f" ({time.perf_counter() - started:.1f}s)"
+        )
+    return status
 
 
 # --- LỚP GIAO DIỆN (GUI) ---
@@ -467,7 +4661,7 @@ class AutoFillerApp(tk.Tk):
         self.auth_manager = auth_manager  # lưu auth_manager để dùng sau
 
         self.title("Công cụ điền Form tự động (v4.0 - Hoàn toàn động)")
-        self.geometry("850x700")
+        self.geometry("850x860")
         style = ttk.Style(self)
         style.configure(".", font=("Segoe UI", 10))
         self.session_choice_var = tk.StringVar(value="10:00 - 12:00")
@@ -540,6 +4734,29 @@ class AutoFillerApp(tk.Tk):
             value="13:30 - 15:30",
         ).pack(side=tk.LEFT, padx=10)
 
+        # --- Frame Hẹn giờ ---
+        schedule_frame = ttk.LabelFrame(
+            main_frame, text="Hẹn giờ mở đăng ký (Tùy chọn)", padding="10"
+        )
+        schedule_frame.pack(fill=tk.X, pady=5)
+        ttk.Label(schedule_frame, text="Giờ mở (HH:MM:SS, giờ server):").pack(
+            side=tk.LEFT, padx=5
+        )
+        self.scheduled_time_entry = ttk.Entry(schedule_frame, width=12)
+        self.scheduled_time_entry.pack(side=tk.LEFT, padx=5)
+        ttk.Label(schedule_frame, text="Múi giờ server (UTC):").pack(
+            side=tk.LEFT, padx=5
+        )
+        self.server_utc_offset_entry = ttk.Entry(schedule_frame, width=8)
+        self.server_utc_offset_entry.insert(0, DEFAULT_SERVER_UTC_OFFSET)
+        self.server_utc_offset_entry.pack(side=tk.LEFT, padx=5)
+        self.reload_on_release_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            schedule_frame,
+            text="Tải lại trang khi tới giờ",
+            variable=self.reload_on_release_var,
+        ).pack(side=tk.LEFT, padx=10)
+
         # --- Frame Cấu hình nâng cao ---
         adv_frame = ttk.LabelFrame(main_frame, text="Cấu hình nâng cao", padding="10")
         adv_frame.pack(fill=tk.X, pady=5)
@@ -565,6 +4782,75 @@ class AutoFillerApp(tk.Tk):
         ttk.Spinbox(
             adv_frame, from_=1, to=50, textvariable=self.max_workers_var, width=10
         ).grid(row=2, column=1, sticky="w", padx=5, pady=3)
+        ttk.Label(adv_frame, text="Số tab trong mỗi trình duyệt:").grid(
+            row=2, column=2, sticky="w", padx=5, pady=3
+        )
+        self.tabs_per_browser_var = tk.StringVar(value="1")
+        ttk.Spinbox(
+            adv_frame, from_=1, to=20, textvariable=self.tabs_per_browser_var, width=10
+        ).grid(row=2, column=3, sticky="w", padx=5, pady=3)
+        ttk.Label(adv_frame, text="Số lần dùng lại mỗi trình duyệt:").grid(
+            row=3, column=0, sticky="w", padx=5, pady=3
+        )
+        self.max_uses_per_browser_var = tk.StringVar(
+            value=str(DEFAULT_MAX_USES_PER_BROWSER)
+        )
+        ttk.Spinbox(
+            adv_frame,
+            from_=1,
+            to=500,
+            textvariable=self.max_uses_per_browser_var,
+            width=10,
+        ).grid(row=3, column=1, sticky="w", padx=5, pady=3)
+        ttk.Label(adv_frame, text="Chromedriver offline (tùy chọn):").grid(
+            row=4, column=0, sticky="w", padx=5, pady=3
+        )
+        self.chromedriver_path_entry = ttk.Entry(adv_frame)
+        self.chromedriver_path_entry.grid(row=4, column=1, sticky="ew", padx=5, pady=3)
+        ttk.Button(
+            adv_frame, text="Chọn File...", command=self.browse_chromedriver
+        ).grid(row=4, column=2, padx=5)
+        self.http_replay_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            adv_frame,
+            text="Gửi trực tiếp qua HTTP sau lần submit đầu tiên (replay)",
+            variable=self.http_replay_var,
+        ).grid(row=5, column=0, columnspan=3, sticky="w", padx=5, pady=5)
+        self.fast_fill_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            adv_frame,
+            text="Điền nhanh bằng một lệnh JavaScript",
+            variable=self.fast_fill_var,
+        ).grid(row=6, column=0, columnspan=3, sticky="w", padx=5, pady=5)
+        ttk.Label(adv_frame, text="Chờ dropdown tối đa (giây):").grid(
+            row=7, column=0, sticky="w", padx=5, pady=3
+        )
+        self.dropdown_timeout_var = tk.StringVar(value=str(DROPDOWN_WAIT_TIMEOUT))
+        ttk.Spinbox(
+            adv_frame,
+            from_=0.5,
+            to=60,
+            increment=0.5,
+            textvariable=self.dropdown_timeout_var,
+            width=10,
+        ).grid(row=7, column=1, sticky="w", padx=5, pady=3)
+        self.lean_mode_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            adv_frame,
+            text="Tải trang gọn (eager, chặn ảnh/font/analytics)",
+            variable=self.lean_mode_var,
+        ).grid(row=8, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        ttk.Label(adv_frame, text="Cho phép tải từ (origin, dấu phẩy):").grid(
+            row=9, column=0, sticky="w", padx=5, pady=3
+        )
+        self.lean_allow_entry = ttk.Entry(adv_frame)
+        self.lean_allow_entry.grid(row=9, column=1, sticky="ew", padx=5, pady=3)
+        self.drop_duplicates_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(
+            adv_frame,
+            text="Bỏ dòng trùng CCCD/SĐT/Email (chỉ giữ dòng đầu)",
+            variable=self.drop_duplicates_var,
+        ).grid(row=10, column=0, columnspan=2, sticky="w", padx=5, pady=5)
 
         # --- Frame Cấu hình AI ---
         ai_frame = ttk.LabelFrame(
@@ -583,6 +4869,58 @@ class AutoFillerApp(tk.Tk):
         )
         self.api_key_entry = ttk.Entry(ai_frame, show="*")
         self.api_key_entry.grid(row=1, column=1, sticky="ew", padx=5, pady=3)
+        ttk.Label(ai_frame, text="Cách chia API key:").grid(
+            row=3, column=0, sticky="w", padx=5, pady=3
+        )
+        key_strategy_frame = ttk.Frame(ai_frame)
+        key_strategy_frame.grid(row=3, column=1, sticky="w", padx=5, pady=3)
+        self.key_strategy_var = tk.StringVar(value="least_loaded")
+        ttk.Radiobutton(
+            key_strategy_frame,
+            text="Key ít tải nhất",
+            variable=self.key_strategy_var,
+            value="least_loaded",
+        ).pack(side=tk.LEFT, padx=5)
+        ttk.Radiobutton(
+            key_strategy_frame,
+            text="Xoay vòng",
+            variable=self.key_strategy_var,
+            value="round_robin",
+        ).pack(side=tk.LEFT, padx=5)
+        ttk.Label(ai_frame, text="Gửi song song mỗi CAPTCHA tới (số key):").grid(
+            row=4, column=0, sticky="w", padx=5, pady=3
+        )
+        self.captcha_hedge_var = tk.StringVar(value="1")
+        ttk.Spinbox(
+            ai_frame, from_=1, to=5, textvariable=self.captcha_hedge_var, width=10
+        ).grid(row=4, column=1, sticky="w", padx=5, pady=3)
+        ttk.Label(ai_frame, text="Model CAPTCHA cục bộ (.npz, tùy chọn):").grid(
+            row=5, column=0, sticky="w", padx=5, pady=3
+        )
+        self.captcha_model_entry = ttk.Entry(ai_frame)
+        self.captcha_model_entry.grid(row=5, column=1, sticky="ew", padx=5, pady=3)
+        ttk.Button(
+            ai_frame, text="Chọn File...", command=self.browse_captcha_model
+        ).grid(row=5, column=2, padx=5, pady=3)
+        self.captcha_dataset_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            ai_frame,
+            text=f"Lưu ảnh CAPTCHA + đáp án + kết quả vào '{CAPTCHA_DATASET_DIR}'",
+            variable=self.captcha_dataset_var,
+        ).grid(row=6, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        self.captcha_batch_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(
+            ai_frame,
+            text="Gộp CAPTCHA của nhiều worker thành một request (lô 50-150 ms)",
+            variable=self.captcha_batch_var,
+        ).grid(row=7, column=0, columnspan=2, sticky="w", padx=5, pady=5)
+        ttk.Label(ai_frame, text="Số lần thử CAPTCHA trên cùng trang:").grid(
+            row=8, column=0, sticky="w", padx=5, pady=3
+        )
+        self.captcha_attempts_var = tk.StringVar(value=str(CAPTCHA_RETRY_ATTEMPTS))
+        ttk.Spinbox(
+            ai_frame, from_=1, to=10, textvariable=self.captcha_attempts_var, width=10
+        ).grid(row=8, column=1, sticky="w", padx=5, pady=3)
         if not LANGCHAIN_AVAILABLE:
             ttk.Label(
                 ai_frame,
@@ -597,6 +4935,11 @@ class AutoFillerApp(tk.Tk):
             action_frame, text="Bắt đầu điền Form", command=self.start_automation
         )
         self.start_button.pack(side=tk.LEFT, padx=5, fill=tk.X, expand=True)
+        ttk.Button(
+            action_frame,
+            text="Phân tích lại Form & chạy",
+            command=self.reanalyze_and_start,
+        ).pack(side=tk.LEFT, padx=5)
         log_frame = ttk.LabelFrame(main_frame, text="Nhật ký hoạt động", padding="10")
         log_frame.pack(fill=tk.BOTH, expand=True, pady=5)
         self.log_text = scrolledtext.ScrolledText(
@@ -613,20 +4956,45 @@ class AutoFillerApp(tk.Tk):
         self.update_idletasks()
 
     def browse_excel(self):
-        file_path = filedialog.askopenfilename(
-            filetypes=[("Excel files", "*.xlsx;*.xls")]
-        )
+        file_path = filedialog.askopenfilename(filetypes=INPUT_FILE_TYPES)
         if file_path:
             self.excel_path_entry.config(state="normal")
             self.excel_path_entry.delete(0, tk.END)
             self.excel_path_entry.insert(0, file_path)
             self.excel_path_entry.config(state="readonly")
-            self.log_message(f"Đã chọn file Excel: {os.path.basename(file_path)}")
+            self.log_message(f"Đã chọn file dữ liệu: {os.path.basename(file_path)}")
+            if valid_table_cache(file_path):
+                self.log_message("Có cache dạng cột còn hợp lệ, sẽ đọc từ cache.")
+
+    def browse_chromedriver(self):
+        file_path = filedialog.askopenfilename(
+            filetypes=[("chromedriver", "chromedriver*"), ("All files", "*.*")]
+        )
+        if file_path:
+            self.chromedriver_path_entry.delete(0, tk.END)
+            self.chromedriver_path_entry.insert(0, file_path)
+            self.log_message(f"Dùng chromedriver offline: {file_path}")
+
+    def browse_captcha_model(self):
+        file_path = filedialog.askopenfilename(
+            filetypes=[("Model CAPTCHA", "*.npz"), ("All files", "*.*")]
+        )
+        if file_path:
+            self.captcha_model_entry.delete(0, tk.END)
+            self.captcha_model_entry.insert(0, file_path)
+            self.log_message(f"Dùng model CAPTCHA cục bộ: {file_path}")
 
-    def start_automation(self):
+    def start_automation(self, force_reanalyze=False):
         self.start_button.config(state="disabled")
+        self.force_reanalyze = force_reanalyze
         threading.Thread(target=self.run_automation_logic, daemon=True).start()
 
+    def reanalyze_and_start(self):
+        # Nút phụ: chạy như bình thường nhưng bỏ qua cache mapping
+        if str(self.start_button["state"]) == "disabled":
+            return
+        self.start_automation(force_reanalyze=True)
+
     def run_automation_logic(self):
         url = self.url_entry.get()
         excel_file = self.excel_path_entry.get()
@@ -635,78 +5003,144 @@ class AutoFillerApp(tk.Tk):
         api_keys_str = self.api_key_entry.get()
         api_keys_list = [key.strip() for key in api_keys_str.split(",") if key.strip()]
         max_workers = int(self.max_workers_var.get())
+        max_uses_per_browser = int(self.max_uses_per_browser_var.get())
+        tabs_per_browser = int(self.tabs_per_browser_var.get())
+        use_http_replay = self.http_replay_var.get()
+        fast_fill = self.fast_fill_var.get()
+        dropdown_wait_timeout = float(self.dropdown_timeout_var.get())
+        lean_mode = self.lean_mode_var.get()
+        lean_allow_list = [
+            origin.strip()
+            for origin in self.lean_allow_entry.get().split(",")
+            if origin.strip()
+        ]
         session_choice = self.session_choice_var.get()
         keep_failed_tab = self.keep_failed_tab_var.get()
+        offline_driver_path = self.chromedriver_path_entry.get().strip() or None
+        scheduled_time_str = self.scheduled_time_entry.get().strip()
+        reload_on_release = self.reload_on_release_var.get()
+        force_reanalyze = getattr(self, "force_reanalyze", False)
+        key_strategy = self.key_strategy_var.get()
+        captcha_hedge = int(self.captcha_hedge_var.get())
+        captcha_model_path = self.captcha_model_entry.get().strip()
+        save_captcha_dataset = self.captcha_dataset_var.get()
+        batch_captchas = self.captcha_batch_var.get()
+        captcha_max_attempts = int(self.captcha_attempts_var.get())
+        drop_duplicates = self.drop_duplicates_var.get()
         if not url or not excel_file:
             messagebox.showerror("Lỗi", "Vui lòng nhập URL và chọn file Excel.")
             self.start_button.config(state="normal")
             return
-        if use_ai and not api_keys_list:
+        if use_ai and not api_keys_list and not captcha_model_path:
             messagebox.showerror("Lỗi", "Vui lòng nhập API Key để dùng chức năng AI.")
             self.start_button.config(state="normal")
             return
-        if use_ai and not LANGCHAIN_AVAILABLE:
+        if use_ai and not LANGCHAIN_AVAILABLE and not captcha_model_path:
             messagebox.showerror("Lỗi", "Cần cài đặt 'langchain-google-genai'.")
             self.start_button.config(state="normal")
             return
+        if use_ai and captcha_model_path and not PIL_AVAILABLE:
+            messagebox.showerror("Lỗi", "Cần cài đặt 'Pillow' để dùng model cục bộ.")
+            self.start_button.config(state="normal")
+            return
+        scheduled_time = None
+        if scheduled_time_str:
+            server_tz = parse_utc_offset(self.server_utc_offset_entry.get())
+            if server_tz is None:
+                messagebox.showerror(
+                    "Lỗi", "Múi giờ server phải có dạng +HH:MM, ví dụ +07:00."
+                )
+                self.start_button.config(state="normal")
+                return
+            try:
+                # Giờ mở mang múi giờ server, quy đổi sang giờ máy khi hẹn giờ
+                scheduled_time = (
+                    datetime.strptime(scheduled_time_str, "%H:%M:%S")
+                    .time()
+                    .replace(tzinfo=server_tz)
+                )
+            except ValueError:
+                messagebox.showerror("Lỗi", "Giờ mở phải có dạng HH:MM:SS.")
+                self.start_button.config(state="normal")
+                return
 
+        key_scheduler = None
+        captcha_service = None
         try:
             self.log_message("--- BẮT ĐẦU QUÁ TRÌNH ---")
 
-            # Đọc file Excel
-            df = pd.read_excel(excel_file, dtype=str)
-            excel_columns = list(df.columns)
+            # Xác định chromedriver một lần, mọi worker dùng chung đường dẫn này
+            driver_path, driver_error = resolve_chromedriver_path(offline_driver_path)
+            if driver_error:
+                self.log_message(f"Lỗi chromedriver: {driver_error}")
+                messagebox.showerror("Lỗi chromedriver", driver_error)
+                return
+            self.log_message(f"Chromedriver: {driver_path}")
+
+            # Mọi lệnh gọi Gemini (phân tích form, giải CAPTCHA) chọn key qua đây
+            if api_keys_list:
+                key_scheduler = ApiKeyScheduler(api_keys_list, key_strategy)
+
+            # Đọc file dữ liệu: lấy tiêu đề ngay, các dòng được đọc dần khi sinh task
+            excel_columns, excel_chunks, read_from = open_input_chunks(excel_file)
+            if read_from != excel_file:
+                self.log_message(
+                    f"File gốc chưa đổi, đọc từ cache {os.path.basename(read_from)}."
+                )
+            self.log_message(f"Đã mở file dữ liệu. Các cột: {excel_columns}")
+
+            # Một phiên probe duy nhất: HTML, mọi dropdown và vị trí CAPTCHA
+            self.log_message("Đang tải trang để lấy HTML và các dropdown...")
+            probe_started = time.perf_counter()
+            with create_chrome_driver(
+                get_chrome_options(headless=True), driver_path
+            ) as temp_driver:
+                snapshot = take_page_snapshot(temp_driver, url)
             self.log_message(
-                f"Đã đọc {len(df)} dòng từ Excel. Các cột: {excel_columns}"
+                f"Probe trang xong sau {time.perf_counter() - probe_started:.1f}s: "
+                f"{len(snapshot['selects'])} dropdown, "
+                f"{len(snapshot['captcha'])} ảnh CAPTCHA."
             )
 
             # Lấy nội dung HTML
             html_content_input = self.html_text.get("1.0", tk.END).strip()
             if not html_content_input:
-                self.log_message("Đang tải nội dung HTML từ URL...")
-                with webdriver.Chrome(
-                    service=webdriver.chrome.service.Service(
-                        ChromeDriverManager().install()
-                    ),
-                    options=get_chrome_options(headless=True),
-                ) as temp_driver:
-                    temp_driver.get(url)
-                    html_content = temp_driver.page_source
+                html_content = snapshot["html"]
             else:
                 html_content = html_content_input
                 self.log_message("Sử dụng nội dung HTML từ ô nhập liệu.")
 
-            # Phân tích Form bằng AI
-            self.log_message("Đang gửi yêu cầu đến Gemini để phân tích form...")
-            # mapping_data, error_message = analyze_form_with_gemini(
-            #     api_keys_list[0], html_content, excel_columns
-            # )
-            mapping_data, error_message = None, "No API keys succeeded."
-            for i, api_key in enumerate(api_keys_list):
-                self.log_message(f"Đang thử phân tích HTML với key #{i+1}...")
-                mapping_data, error_message = analyze_form_with_gemini(
-                    api_key, html_content, excel_columns
-                )
-                if mapping_data:
-                    self.log_message(f"Phân tích HTML thành công với key #{i+1}.")
-                    break
-                self.log_message(f"Key #{i+1} thất bại: {error_message}")
-            if not mapping_data:
-                messagebox.showerror(
-                    "Lỗi Gemini", f"Không thể phân tích form: {error_message}"
+            # Tra cache mapping theo vân tay cấu trúc form + bộ cột Excel
+            mapping_cache = FormMappingCache()
+            cache_key = mapping_cache_key(html_content, excel_columns)
+            mapping_data = None if force_reanalyze else mapping_cache.get(cache_key)
+            if mapping_data:
+                self.log_message(
+                    f"Dùng mapping trong cache ({cache_key[:12]}), bỏ qua Gemini."
                 )
-                self.start_button.config(state="normal")
-                return
-            if error_message:
-                messagebox.showerror(
-                    "Lỗi Gemini", f"Không thể phân tích form: {error_message}"
+            else:
+                if force_reanalyze:
+                    self.log_message("Bỏ qua cache, phân tích lại form theo yêu cầu.")
+                mapping_data, error_message, confident = self.build_form_mapping(
+                    html_content, excel_columns, key_scheduler
                 )
-                self.start_button.config(state="normal")
-                return
+                if not mapping_data:
+                    messagebox.showerror(
+                        "Lỗi phân tích", f"Không thể phân tích form: {error_message}"
+                    )
+                    self.start_button.config(state="normal")
+                    return
+                if confident:
+                    mapping_cache.put(cache_key, mapping_data, url)
+                else:
+                    self.log_message(
+                        "Mapping còn trường chưa chắc chắn, không lưu cache "
+                        "để lần sau phân tích lại."
+                    )
 
             FORM_FIELD_IDS = mapping_data["FORM_FIELD_IDS"]
             EXCEL_COLUMN_MAPPING = mapping_data["EXCEL_COLUMN_MAPPING"]
-            self.log_message("Gemini đã phân tích thành công. Mapping được tạo:")
+            self.log_message("Mapping của form:")
             self.log_message(
                 f"  FORM_FIELD_IDS: {json.dumps(FORM_FIELD_IDS, indent=2)}"
             )
@@ -714,30 +5148,24 @@ class AutoFillerApp(tk.Tk):
                 f"  EXCEL_COLUMN_MAPPING: {json.dumps(EXCEL_COLUMN_MAPPING, indent=2)}"
             )
 
-            # Lấy danh sách ngày bán hàng từ web để tạo task
-            self.log_message("Đang lấy danh sách ngày bán hàng từ trang web...")
-            with webdriver.Chrome(
-                service=webdriver.chrome.service.Service(
-                    ChromeDriverManager().install()
-                ),
-                options=get_chrome_options(headless=True),
-            ) as temp_driver:
-                temp_driver.get(url)
-                sales_date_id = FORM_FIELD_IDS.get("sales_date")
-                if not sales_date_id:
-                    self.log_message(
-                        "Lỗi: Không tìm thấy 'sales_date' ID trong mapping của AI."
-                    )
-                    self.start_button.config(state="normal")
-                    return
-                sales_date_element = WebDriverWait(temp_driver, 10).until(
-                    EC.presence_of_element_located((By.ID, sales_date_id))
+            # Danh sách ngày bán hàng lấy từ ảnh chụp trang, không mở lại Chrome
+            sales_date_id = FORM_FIELD_IDS.get("sales_date")
+            if not sales_date_id:
+                self.log_message(
+                    "Lỗi: Không tìm thấy 'sales_date' ID trong mapping của AI."
+                )
+                self.start_button.config(state="normal")
+                return
+            valid_sales_dates = snapshot_sales_dates(snapshot, sales_date_id)
+            captcha_geometry = snapshot_captcha_geometry(
+                snapshot, FORM_FIELD_IDS.get("captcha_image_selector")
+            )
+            if captcha_geometry:
+                self.log_message(
+                    f"Ảnh CAPTCHA {captcha_geometry['selector']}: "
+                    f"{captcha_geometry['width']:.0f}x{captcha_geometry['height']:.0f}"
+                    f" tại ({captcha_geometry['x']:.0f}, {captcha_geometry['y']:.0f})"
                 )
-                valid_sales_dates = [
-                    opt.text
-                    for opt in Select(sales_date_element).options
-                    if "--" not in opt.text and opt.get_attribute("value")
-                ]
 
             if not valid_sales_dates:
                 self.log_message("Lỗi: Không tìm thấy ngày bán hàng hợp lệ trên web.")
@@ -749,57 +5177,238 @@ class AutoFillerApp(tk.Tk):
             )
             self.log_message(f"Đã chọn điền cho phiên: {session_choice}")
 
-            # Chuẩn bị tasks
-            tasks = []
-            for _, row in df.iterrows():
-                base_data = {}
-                for form_key, excel_col in EXCEL_COLUMN_MAPPING.items():
-                    if (
-                        excel_col
-                        and excel_col in row
-                        and form_key not in ["day", "month", "year"]
-                    ):
-                        if form_key == "phone_number":
-                            base_data[form_key] = normalize_phone(row[excel_col])
-                        else:
-                            base_data[form_key] = str(row[excel_col])
-
-                dob_excel_col = EXCEL_COLUMN_MAPPING.get(
-                    "day"
-                ) or EXCEL_COLUMN_MAPPING.get("date_of_birth")
-                if dob_excel_col and dob_excel_col in row:
-                    base_data.update(format_date_parts(row[dob_excel_col]))
-
-                for s_date in valid_sales_dates:
-                    task_data = base_data.copy()
-                    task_data["sales_date"] = s_date
-                    task_data["session"] = session_choice
-                    tasks.append(
-                        {
+            # Lean mode: origin của trang luôn được tải ảnh (CAPTCHA thường cùng origin)
+            allowed_image_origins = [origin_of(url)] + [
+                origin_of(o) if "://" in o else f"https://{o}" for o in lean_allow_list
+            ]
+            blocked_urls = (
+                lean_blocked_url_patterns(allowed_image_origins) if lean_mode else None
+            )
+
+            # Service giải CAPTCHA dùng chung: client Gemini nóng cho mỗi key
+            # Bộ giải cục bộ (nếu có model) thử trước, Gemini làm dự phòng
+            captcha_backends = []
+            if use_ai and captcha_model_path:
+                try:
+                    captcha_backends.append(
+                        LocalCaptchaBackend(LocalCaptchaModel.load(captcha_model_path))
+                    )
+                    self.log_message(
+                        f"Đã nạp model CAPTCHA cục bộ: {captcha_model_path}"
+                    )
+                except (OSError, ValueError, KeyError) as e:
+                    self.log_message(f"Không nạp được model CAPTCHA cục bộ: {e}")
+            if use_ai and key_scheduler and LANGCHAIN_AVAILABLE:
+                gemini_backend_class = (
+                    BatchingGeminiCaptchaBackend
+                    if batch_captchas
+                    else GeminiCaptchaBackend
+                )
+                captcha_backends.append(
+                    gemini_backend_class(key_scheduler, captcha_hedge)
+                )
+            if captcha_backends:
+                captcha_service = CaptchaSolverService(
+                    captcha_backends,
+                    CaptchaDataset() if save_captcha_dataset else None,
+                ).start()
+
+            # Chuẩn bị tasks: sinh dần theo từng khối dòng Excel đã chuẩn hóa và kiểm tra.
+            # Khối đầu được kiểm tra trước khi mở pool, dòng lỗi không bao giờ tới trình duyệt
+            row_count = 0
+            rejected_rows = []
+
+            def reject_row(row_number, problems):
+                rejected_rows.append(row_number)
+                if len(rejected_rows) == 1:
+                    self.log_message("Dòng Excel không hợp lệ (không tạo task):")
+                if len(rejected_rows) <= VALIDATION_LOG_LIMIT:
+                    self.log_message(f"  Bỏ qua dòng {row_number}: {problems}")
+
+            # Dòng trùng CCCD/SĐT/email sẽ bị web từ chối: phát hiện trước khi tạo task
+            duplicate_index = DuplicateRowIndex()
+            duplicate_log = []
+
+            def report_duplicate(row_number, description):
+                duplicate_log.append(row_number)
+                if len(duplicate_log) == 1:
+                    self.log_message(
+                        "Dòng Excel trùng lặp"
+                        f" ({'bỏ qua' if drop_duplicates else 'vẫn chạy'}):"
+                    )
+                if len(duplicate_log) <= VALIDATION_LOG_LIMIT:
+                    self.log_message(f"  Dòng {row_number}: {description}")
+
+            def iter_tasks():
+                nonlocal row_count
+                process_id = 0
+                for row_number, base_data in iter_normalized_rows(
+                    excel_chunks, EXCEL_COLUMN_MAPPING, reject_row
+                ):
+                    duplicate = duplicate_index.check(row_number, base_data)
+                    if duplicate:
+                        report_duplicate(row_number, duplicate)
+                        if drop_duplicates:
+                            continue
+                    row_count += 1
+                    for s_date in valid_sales_dates:
+                        task_data = base_data.copy()
+                        task_data["sales_date"] = s_date
+                        task_data["session"] = session_choice
+                        process_id += 1
+                        yield {
                             "url": url,
-                            "options": get_chrome_options(is_headless),
+                            "options": get_chrome_options(
+                                is_headless, lean_mode, allowed_image_origins
+                            ),
                             "data": task_data,
-                            "process_id": len(tasks) + 1,
+                            "process_id": process_id,
                             "is_headless": is_headless,
                             "use_ai_captcha": use_ai,
                             "api_keys": api_keys_list,
                             "FORM_FIELD_IDS": FORM_FIELD_IDS,
                             "keep_failed_tab": keep_failed_tab,
+                            "driver_path": driver_path,
+                            "fast_fill": fast_fill,
+                            "dropdown_wait_timeout": dropdown_wait_timeout,
+                            "lean_mode": lean_mode,
+                            "blocked_urls": blocked_urls,
+                            "captcha_max_attempts": captcha_max_attempts,
+                            "captcha_service": (
+                                captcha_service.address_info
+                                if captcha_service
+                                else None
+                            ),
                         }
+
+            tasks = iter_tasks()
+            completed = []
+            submission_template = None
+            pool = None
+            try:
+                if scheduled_time:
+                    # Hẹn giờ cần biết số task để mở đủ trình duyệt: đọc hết sheet trước,
+                    # việc đọc nằm trong thời gian chờ tới giờ mở nên không tốn thêm
+                    tasks = list(tasks)
+                    if tasks:
+                        pool, num_workers = self.prepare_scheduled_start(
+                            url,
+                            tasks,
+                            scheduled_time,
+                            min(max_workers, len(tasks)),
+                            max_uses_per_browser,
+                            reload_on_release,
+                            use_http_replay,
+                            tabs_per_browser,
+                        )
+                tasks = iter(tasks)
+
+                first_task = next(tasks, None) if use_http_replay else None
+                if first_task:
+                    # Task đầu chạy bằng trình duyệt để học request mà form gửi đi
+                    self.log_message(
+                        "Engine HTTP: đang học request gửi form từ task đầu..."
                     )
+                    first_success, first_name, submission_template, learn_error = (
+                        learn_submission_template(first_task)
+                    )
+                    completed.append((first_success, first_name))
+                    if submission_template:
+                        self.log_message(
+                            f"Đã học request: {submission_template['method']} "
+                            f"{submission_template['endpoint']} "
+                            f"({len(submission_template['fields'])} trường)"
+                        )
+                    else:
+                        self.log_message(
+                            "Không học được request gửi form"
+                            f"{f' ({learn_error})' if learn_error else ''},"
+                            " tiếp tục bằng trình duyệt."
+                        )
 
-            num_workers = min(max_workers, len(tasks))
-            self.log_message(
-                f"Bắt đầu điền {len(tasks)} form với {num_workers} tiến trình..."
-            )
-            if is_headless and not use_ai:
-                self.log_message("Cảnh báo: Chạy ẩn nhưng không bật AI giải CAPTCHA.")
+                # Job cũng được sinh dần: mỗi job gửi vào pool ngay khi dòng của nó được đọc
+                if submission_template:
+                    jobs = (
+                        (
+                            submit_via_http_process,
+                            dict(task, submission_template=submission_template),
+                            1,
+                        )
+                        for task in tasks
+                    )
+                # Chế độ nhiều tab: chia task thành lô, mỗi lô chạy trong một Chrome
+                elif tabs_per_browser > 1:
+                    batch_size = tabs_per_browser * MULTITAB_BATCH_ROUNDS
+                    batches = iter(lambda: list(islice(tasks, batch_size)), [])
+                    jobs = (
+                        (
+                            fill_and_submit_multitab_process,
+                            {"tasks": batch, "tabs_per_browser": tabs_per_browser},
+                            len(batch),
+                        )
+                        for batch in batches
+                    )
+                else:
+                    jobs = ((fill_and_submit_process, task, 1) for task in tasks)
 
-            with Pool(processes=num_workers) as pool:
-                async_results = [
-                    pool.apply_async(fill_and_submit_process, (task,)) for task in tasks
-                ]
-                self.process_results(async_results, len(tasks))
+                async_results = []
+                # Xem trước tối đa max_workers job để biết cần mở bao nhiêu tiến trình
+                first_jobs = list(islice(jobs, max_workers))
+                if first_jobs:
+                    if pool is None:
+                        num_workers = len(first_jobs)
+                        # Mỗi worker giữ pool trình duyệt riêng, dùng lại giữa các task
+                        pool = Pool(
+                            processes=num_workers,
+                            initializer=init_browser_pool_worker,
+                            initargs=(max_uses_per_browser,),
+                        )
+                    self.log_message(
+                        f"Bắt đầu điền form với {num_workers} tiến trình"
+                        f" x {tabs_per_browser} tab (vừa đọc Excel vừa gửi task)..."
+                    )
+                    if is_headless and not use_ai:
+                        self.log_message(
+                            "Cảnh báo: Chạy ẩn nhưng không bật AI giải CAPTCHA."
+                        )
+                    for func, job, task_count in chain(first_jobs, jobs):
+                        async_results.append(
+                            (pool.apply_async(func, (job,)), task_count)
+                        )
+                total_tasks = len(completed) + sum(c for _, c in async_results)
+                self.log_message(
+                    f"Đã đọc xong Excel: {row_count} dòng hợp lệ, "
+                    f"{len(rejected_rows)} dòng lỗi bị bỏ qua, {total_tasks} form."
+                )
+                if duplicate_log:
+                    self.log_message(
+                        f"Trùng lặp: {len(duplicate_index.duplicate_rows)} dòng lặp lại,"
+                        f" {len(duplicate_index.conflict_rows)} dòng xung đột"
+                        f" (cùng CCCD/SĐT/email nhưng khác thông tin) -"
+                        f" {'đã bỏ qua' if drop_duplicates else 'vẫn được gửi'}."
+                    )
+                if len(duplicate_log) > VALIDATION_LOG_LIMIT:
+                    self.log_message(
+                        f"  (chỉ liệt kê {VALIDATION_LOG_LIMIT} dòng trùng đầu, các dòng trùng"
+                        f" khác: {', '.join(map(str, duplicate_log[VALIDATION_LOG_LIMIT:]))})"
+                    )
+                if len(rejected_rows) > VALIDATION_LOG_LIMIT:
+                    self.log_message(
+                        f"  (chỉ liệt kê {VALIDATION_LOG_LIMIT} dòng lỗi đầu, các dòng lỗi"
+                        f" khác: {', '.join(map(str, rejected_rows[VALIDATION_LOG_LIMIT:]))})"
+                    )
+                all_finished = self.process_results(
+                    async_results, total_tasks, completed
+                )
+                # Đóng êm để worker đóng Chrome đang giữ; có task quá hạn thì dừng cưỡng bức
+                if pool and not shutdown_pool(pool, graceful=all_finished):
+                    self.log_message(
+                        "Có worker không phản hồi, đã dừng cưỡng bức các tiến trình."
+                    )
+            except Exception:
+                if pool:
+                    shutdown_pool(pool, graceful=False)
+                raise
 
         except Exception as e:
             self.log_message(f"Lỗi nghiêm trọng: {e}")
@@ -807,24 +5416,187 @@ class AutoFillerApp(tk.Tk):
 
             self.log_message(traceback.format_exc())
         finally:
+            if captcha_service:
+                captcha_service.stop()
+                self.log_message("Thời gian giải CAPTCHA theo key:")
+                for line in captcha_service.latency_report():
+                    self.log_message(f"  {line}")
+            if key_scheduler:
+                key_scheduler.save()
+                self.log_message("Tình trạng API key:")
+                for line in key_scheduler.report():
+                    self.log_message(f"  {line}")
             self.start_button.config(state="normal")
 
-    def process_results(self, async_results, total_tasks):
+    def build_form_mapping(self, html_content, excel_columns, key_scheduler):
+        """Phân tích form bằng luật trước, chỉ hỏi Gemini cho các trường chưa chắc chắn.
+
+        Trả về (mapping_data, lỗi, đáng tin). `đáng tin` là False khi còn trường
+        chưa chắc chắn mà không hỏi được Gemini: kết quả dùng được cho lần chạy này
+        nhưng không nên lưu cache, để lần sau còn hỏi lại.
+        """
+        mapping_data, confidences = analyze_form_heuristically(
+            html_content, excel_columns
+        )
+        form_keys, excel_keys = low_confidence_keys(confidences)
+        self.log_message(
+            f"Phân tích bằng luật xong. Độ tin cậy: {confidences['FORM_FIELD_IDS']}"
+        )
+        if not form_keys and not excel_keys:
+            self.log_message("Mọi trường đều đủ tin cậy, không cần gọi Gemini.")
+            return mapping_data, None, True
+        if not key_scheduler or not LANGCHAIN_AVAILABLE:
+            self.log_message(
+                f"Trường chưa chắc chắn: {form_keys + excel_keys}. "
+                "Không có AI, dùng kết quả phân tích bằng luật."
+            )
+            return mapping_data, None, False
+
+        # Phân tích Form bằng AI cho các trường còn thiếu / điểm thấp
+        self.log_message(
+            f"Đang hỏi Gemini cho các trường chưa chắc chắn: {form_keys + excel_keys}"
+        )
+        form_html, size_before, size_after = minify_form_html(html_content)
+        self.log_message(
+            f"HTML gửi Gemini đã rút gọn: {size_before} -> {size_after} ký tự "
+            f"(-{100 - size_after * 100 // max(size_before, 1)}%)"
+        )
+
+        def analyze_with_key(api_key):
+            key_number = key_scheduler.api_keys.index(api_key) + 1
+            self.log_message(f"Đang thử phân tích HTML với key #{key_number}...")
+            result, error = analyze_form_with_gemini(api_key, form_html, excel_columns)
+            if result:
+                self.log_message(f"Phân tích HTML thành công với key #{key_number}.")
+            else:
+                self.log_message(f"Key #{key_number} thất bại: {error}")
+            return result, error
+
+        llm_mapping, error_message = key_scheduler.call(analyze_with_key)
+        if not llm_mapping:
+            self.log_message(
+                f"Gemini thất bại ({error_message}), dùng kết quả phân tích bằng luật."
+            )
+            return mapping_data, None, False
+        merged = merge_llm_mapping(mapping_data, llm_mapping, form_keys, excel_keys)
+        return merged, None, True
+
+    def prepare_scheduled_start(
+        self,
+        url,
+        tasks,
+        scheduled_time,
+        num_workers,
+        max_uses_per_browser,
+        reload_on_release,
+        use_http_replay,
+        tabs_per_browser=1,
+    ):
+        """Mở sẵn trình duyệt cho mọi worker rồi chờ tới giờ mở (đã bù lệch giờ server).
+
+        `scheduled_time` mang tzinfo là múi giờ của server. Trả về (pool, num_workers).
+        Task chỉ được gửi vào pool sau khi hàm này trả về.
+        """
+        target = scheduled_timestamp(scheduled_time)
+        offset, clock_error = measure_server_clock_offset(url)
+        if clock_error:
+            self.log_message(f"Không đo được giờ server ({clock_error}), dùng giờ máy.")
+            offset = 0.0
+        else:
+            self.log_message(f"Lệch giờ server so với máy: {offset:+.3f}s")
+        release_at = target - offset
+
+        ready_counter = multiprocessing.Value("i", 0)
+        prewarm_task = {
+            # Worker nhiều tab cần trình duyệt với pageLoadStrategy=none ngay từ đầu
+            "options": (
+                multitab_chrome_options(tasks[0]["options"])
+                if tabs_per_browser > 1
+                else tasks[0]["options"]
+            ),
+            "url": url,
+            "driver_path": tasks[0].get("driver_path"),
+            "blocked_urls": tasks[0].get("blocked_urls"),
+        }
+        self.log_message(f"Đang khởi động trước {num_workers} trình duyệt...")
+        pool = Pool(
+            processes=num_workers,
+            initializer=init_prewarmed_worker,
+            initargs=(
+                max_uses_per_browser,
+                prewarm_task,
+                ready_counter,
+                not reload_on_release,
+            ),
+        )
+        if use_http_replay:
+            # Trình duyệt học request chạy ở tiến trình chính, cũng mở sẵn (có ghi log mạng)
+            get_worker_browser_pool().prewarm(
+                enable_network_capture(tasks[0]["options"]),
+                url,
+                tasks[0].get("driver_path"),
+                tasks[0].get("blocked_urls"),
+                not reload_on_release,
+            )
+
+        deadline = min(release_at, time.time() + PREWARM_TIMEOUT)
+        while ready_counter.value < num_workers and time.time() < deadline:
+            time.sleep(0.2)
+        self.log_message(
+            f"{ready_counter.value}/{num_workers} trình duyệt đã sẵn sàng tại trang form."
+        )
+
+        remaining = release_at - time.time()
+        if remaining > 0:
+            self.log_message(
+                f"Chờ {remaining:.1f}s tới {scheduled_time.strftime('%H:%M:%S')} "
+                f"(giờ server, UTC{scheduled_time.strftime('%z')})..."
+            )
+        else:
+            self.log_message("Đã qua giờ mở, bắt đầu ngay.")
+        sleep_until(release_at)
+        self.log_message("ĐÃ TỚI GIỜ MỞ - bắt đầu gửi form.")
+        return pool, num_workers
+
+    def process_results(self, async_results, total_tasks, completed=()):
+        """Ghi log kết quả từng task. Trả về False nếu có task quá thời gian chờ."""
         success_count = 0
-        for i, res in enumerate(async_results):
+        all_finished = True
+        done = 0
+        # Các task đã chạy xong trước khi mở Pool (ví dụ task học của engine HTTP)
+        for success, name in completed:
+            done += 1
+            if success:
+                success_count += 1
+            self.log_message(
+                f"-> Task [{done}/{total_tasks}] - {'Thành công' if success else 'THẤT BẠI'} - {name}"
+            )
+        for res, task_count in async_results:
             try:
-                success, name = res.get(timeout=300)
-                if success:
-                    success_count += 1
+                # Worker nhiều tab trả về danh sách kết quả cho cả lô
+                outcome = res.get(timeout=300 * task_count)
+                outcomes = outcome if isinstance(outcome, list) else [outcome]
+                for success, name in outcomes:
+                    done += 1
+                    if success:
+                        success_count += 1
+                    self.log_message(
+                        f"-> Task [{done}/{total_tasks}] - {'Thành công' if success else 'THẤT BẠI'} - {name}"
+                    )
+            except multiprocessing.TimeoutError:
+                done += task_count
+                all_finished = False
                 self.log_message(
-                    f"-> Task [{i+1}/{total_tasks}] - {'Thành công' if success else 'THẤT BẠI'} - {name}"
+                    f"-> Task [{done}/{total_tasks}] - Lỗi: quá thời gian chờ kết quả"
                 )
             except Exception as e:
-                self.log_message(f"-> Task [{i+1}/{total_tasks}] - Lỗi: {e}")
+                done += task_count
+                self.log_message(f"-> Task [{done}/{total_tasks}] - Lỗi: {e}")
         self.log_message("\n----- HOÀN TẤT -----")
         self.log_message(
             f"Tổng kết: {success_count}/{total_tasks} form đã được điền thành công."
         )
+        return all_finished
 
     def on_closing(self):
         if messagebox.askokcancel("Thoát", "Bạn có muốn thoát chương trình?"):
@@ -836,6 +5608,12 @@ class AutoFillerApp(tk.Tk):
 if __name__ == "__main__":
     multiprocessing.freeze_support()
 
+    # Công cụ dòng lệnh, không mở giao diện
+    if len(sys.argv) > 1 and sys.argv[1] == "captcha":
+        sys.exit(run_captcha_cli(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "convert":
+        sys.exit(run_convert_cli(sys.argv[2:]))
+
     # URL của backend API, thay đổi nếu cần
     BACKEND_URL = "https://toolchup.onrender.com"  # URL của server Render
     # BACKEND_URL = "http://127.0.0.1:5000"  # URL để test local
@@ -0,0 +1,145 @@
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+import auto_form_filler
+from auto_form_filler import (
+    ApiKeyScheduler,
+    BatchingGeminiCaptchaBackend,
+    GeminiCaptchaBackend,
+)
+
+
+class FakeScheduler:
+    api_keys = ["key"]
+
+    def __init__(self, release=None):
+        self.release = release
+
+    def call(self, func, exclude=None):
+        if self.release is not None:
+            self.release.wait()
+        return func("key")
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    monkeypatch.setattr(auto_form_filler, "create_captcha_llm", lambda key: object())
+    monkeypatch.setattr(
+        auto_form_filler,
+        "solve_captcha_with_gemini",
+        lambda key, image, llm: (image.decode().upper(), None),
+    )
+    monkeypatch.setattr(
+        auto_form_filler,
+        "solve_captcha_batch_with_gemini",
+        lambda key, images, llm: (
+            {i: im.decode().upper() for i, im in enumerate(images)},
+            None,
+        ),
+    )
+
+
+def solve_in_thread(backend, image, **kwargs):
+    results = []
+    thread = threading.Thread(
+        target=lambda: results.append(backend.solve(image, **kwargs))
+    )
+    thread.start()
+    return thread, results
+
+
+def test_concurrent_images_share_a_batch(fake_gemini):
+    backend = BatchingGeminiCaptchaBackend(FakeScheduler())
+    try:
+        threads = [solve_in_thread(backend, im) for im in (b"ab1", b"cd2", b"ef3")]
+        for thread, _ in threads:
+            thread.join(5)
+        assert sorted(r[0] for _, r in threads) == [
+            ("AB1", None),
+            ("CD2", None),
+            ("EF3", None),
+        ]
+    finally:
+        backend.close()
+
+
+def test_solve_times_out_instead_of_hanging(fake_gemini):
+    release = threading.Event()
+    backend = BatchingGeminiCaptchaBackend(FakeScheduler(release))
+    try:
+        started = time.monotonic()
+        text, error = backend.solve(b"ab1", timeout=0.3)
+        assert text is None and "0.3" in error
+        assert time.monotonic() - started < 2
+    finally:
+        release.set()
+        backend.close()
+
+
+def test_close_fails_pending_images(fake_gemini):
+    release = threading.Event()
+    backend = BatchingGeminiCaptchaBackend(FakeScheduler(release))
+    threads = [solve_in_thread(backend, im) for im in (b"ab1", b"cd2")]
+    time.sleep(0.3)  # Lô đã được gửi và đang chờ Gemini
+    backend.close()
+    for thread, results in threads:
+        thread.join(2)
+        assert not thread.is_alive()
+        assert results[0][0] is None and "đóng" in results[0][1]
+    release.set()
+    assert backend.solve(b"gh4") == (None, "Bộ giải CAPTCHA đã đóng")
+
+
+class QueueingExecutor:
+    """Chạy ngay request đầu tiên, các request sau nằm chờ trong hàng đợi."""
+
+    def __init__(self):
+        self.started = False
+        self.queued = []
+
+    def submit(self, func, *args):
+        future = Future()
+        if not self.started:
+            self.started = True
+            future.set_result(func(*args))
+        else:
+            self.queued.append(future)
+        return future
+
+    def shutdown(self, **kwargs):
+        pass
+
+
+def test_cancelled_hedge_returns_its_key(fake_gemini, tmp_path):
+    scheduler = ApiKeyScheduler(["key-a", "key-b"], usage_path=tmp_path / "usage.json")
+    # key-b vừa hết thời gian ngắt mạch: lần acquire tới là request thử duy nhất
+    scheduler._state["key-b"]["open_until"] = time.monotonic() - 1
+    backend = GeminiCaptchaBackend(scheduler, hedge=2)
+    backend._hedge_executor = QueueingExecutor()
+
+    assert backend.solve(b"ab1") == ("AB1", None)
+    queued = backend._hedge_executor.queued
+    assert len(queued) == 1 and queued[0].cancelled()
+    state = scheduler._state["key-b"]
+    assert state["in_flight"] == 0 and not state["probing"] and not state["errors"]
+    assert scheduler.acquire(exclude=["key-a"]) == "key-b"
+
+
+def test_batch_calls_update_key_stats(fake_gemini):
+    backend = BatchingGeminiCaptchaBackend(FakeScheduler())
+    try:
+        threads = [solve_in_thread(backend, im) for im in (b"ab1", b"cd2")]
+        for thread, _ in threads:
+            thread.join(5)
+    finally:
+        backend.close()
+    stats = backend._stats["key"]
+    # Lô nhiều ảnh là một request, lô một ảnh được gửi riêng: mỗi lô một lần ghi
+    assert len(stats["latencies"]) == len(backend._batch_sizes)
+    assert stats["errors"] == 0
+    assert any(
+        "Key #1" in line and "chưa giải" not in line for line in backend.report()
+    )
@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+from auto_form_filler import (
+    AutoFillerApp,
+    _assign_jointly,
+    analyze_form_heuristically,
+)
+
+FORM_HTML = """
+<form id="frmDangKy" action="/DangKy" method="post">
+  <input type="hidden" name="__RequestVerificationToken" value="tok">
+  <div class="form-group">
+    <label for="ddlNgayBan">Ngày bán hàng</label>
+    <select id="ddlNgayBan" name="NgayBan">
+      <option value="">-- Chọn ngày --</option>
+      <option value="1">20/10/2026</option>
+    </select>
+  </div>
+  <div class="form-group">
+    <label for="ddlPhien">Phiên</label>
+    <select id="ddlPhien" name="Phien"><option value="">-- Chọn --</option></select>
+  </div>
+  <div class="form-group">
+    <label for="txtHoTen">Họ và tên</label>
+    <input type="text" id="txtHoTen" name="HoTen">
+  </div>
+  <div class="form-group">
+    <span>Ngày sinh của bạn</span>
+    <select id="ddlNgay" name="Ngay"><option>01</option></select>
+    <select id="ddlThang" name="Thang"><option>01</option></select>
+    <select id="ddlNam" name="Nam"><option>1990</option></select>
+  </div>
+  <div class="form-group">
+    <label for="txtSDT">Số điện thoại</label>
+    <input type="tel" id="txtSDT" name="SoDienThoai">
+  </div>
+  <div class="form-group">
+    <label for="txtCCCD">Số CCCD</label>
+    <input type="text" id="txtCCCD" name="CCCD">
+  </div>
+  <div class="form-group">
+    <label for="txtNgayCap">Ngày cấp</label>
+    <input type="text" id="txtNgayCap" name="NgayCap">
+  </div>
+  <div class="form-group">
+    <label for="txtEmail">Email</label>
+    <input type="email" id="txtEmail" name="Email">
+  </div>
+  <div class="form-group">
+    <label for="txtCaptcha">Mã xác nhận</label>
+    <input type="text" id="txtCaptcha" name="Captcha">
+    <img id="imgCaptcha" src="/Captcha/Image">
+  </div>
+  <input type="checkbox" id="chkDongY"> <label for="chkDongY">Tôi đồng ý điều khoản</label>
+  <button type="submit" id="btnDangKy">Đăng ký</button>
+</form>
+"""
+EXCEL_COLUMNS = ["Họ tên", "Ngày sinh", "Số điện thoại", "Email", "CCCD/Hộ chiếu"]
+
+
+def analyze(html=FORM_HTML):
+    mapping, confidences = analyze_form_heuristically(html, EXCEL_COLUMNS)
+    return mapping["FORM_FIELD_IDS"], confidences["FORM_FIELD_IDS"]
+
+
+def test_sales_date_select_is_not_taken_as_birth_day():
+    form_ids, confidences = analyze()
+    assert form_ids["sales_date"] == "ddlNgayBan"
+    assert form_ids["day"] == "ddlNgay"
+    assert form_ids["month"] == "ddlThang"
+    assert form_ids["year"] == "ddlNam"
+    assert confidences["sales_date"] >= 0.6
+
+
+def test_representative_form_is_fully_mapped():
+    form_ids, _ = analyze()
+    assert form_ids["session"] == "ddlPhien"
+    assert form_ids["full_name"] == "txtHoTen"
+    assert form_ids["phone_number"] == "txtSDT"
+    assert form_ids["id_card"] == "txtCCCD"
+    assert form_ids["email"] == "txtEmail"
+    assert form_ids["captcha"] == "txtCaptcha"
+    assert form_ids["captcha_image_selector"] == "#imgCaptcha"
+    assert form_ids["agree_checkbox"] == "chkDongY"
+    assert form_ids["submit_button"] == "btnDangKy"
+
+
+def test_issue_date_is_not_birth_day():
+    # Bỏ select ngày sinh: "Ngày cấp" không được lấp vào chỗ trống
+    html = FORM_HTML.replace('id="ddlNgay" name="Ngay"', 'id="ddlX" name="X"')
+    form_ids, _ = analyze(html)
+    assert form_ids["day"] != "txtNgayCap"
+
+
+def test_joint_assignment_beats_greedy_order():
+    # Tham lam lấy (0.7, a, e1) trước rồi b không còn gì; ghép chung được 0.6 + 0.65
+    candidates = [(0.7, "a", "e1"), (0.6, "a", "e2"), (0.65, "b", "e1")]
+    assert _assign_jointly(candidates) == {"a": ("e2", 0.6), "b": ("e1", 0.65)}
+
+
+def test_joint_assignment_leaves_keys_without_candidates_empty():
+    candidates = [(0.7, "a", "e1"), (0.5, "b", "e1")]
+    assert _assign_jointly(candidates) == {"a": ("e1", 0.7)}
+    assert _assign_jointly([]) == {}
+
+
+def build_mapping(html, key_scheduler=None):
+    app = SimpleNamespace(log_message=lambda message: None)
+    return AutoFillerApp.build_form_mapping(app, html, EXCEL_COLUMNS, key_scheduler)
+
+
+def test_confident_mapping_is_cacheable():
+    mapping, error, confident = build_mapping(FORM_HTML)
+    assert error is None and confident
+    assert mapping["FORM_FIELD_IDS"]["sales_date"] == "ddlNgayBan"
+
+
+def test_unresolved_mapping_without_llm_is_not_cacheable():
+    html = FORM_HTML.replace("Phiên", "Chọn").replace('"ddlPhien" name="Phien"', '"x1"')
+    mapping, error, confident = build_mapping(html)
+    assert mapping["FORM_FIELD_IDS"]["session"] is None
+    assert error is None and not confident
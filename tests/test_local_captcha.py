@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+import auto_form_filler
+from auto_form_filler import (
+    PIL_MISSING_ERROR,
+    LocalCaptchaBackend,
+    LocalCaptchaModel,
+    decode_captcha_image,
+    render_captcha,
+)
+
+
+def test_local_backend_reports_missing_pillow(monkeypatch):
+    monkeypatch.setattr(auto_form_filler, "PIL_AVAILABLE", False)
+    model = LocalCaptchaModel(np.zeros((384, 2)), np.zeros(2), "AB", 5)
+    assert LocalCaptchaBackend(model).solve(b"png") == (None, PIL_MISSING_ERROR)
+    with pytest.raises(RuntimeError, match="Pillow"):
+        decode_captcha_image(b"png")
+    with pytest.raises(RuntimeError, match="Pillow"):
+        render_captcha("AB12C", np.random.default_rng(0))
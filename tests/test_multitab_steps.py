@@ -0,0 +1,169 @@
+import auto_form_filler
+from auto_form_filler import _multitab_fill_steps
+
+FORM_FIELD_IDS = {
+    "sales_date": "ddlNgayBan",
+    "session": "ddlPhien",
+    "full_name": "txtHoTen",
+}
+DATA = {"sales_date": "20/10/2026", "session": "10:00", "full_name": "Nguyễn Văn A"}
+
+
+def run_fill(monkeypatch, data, refreshed_after):
+    filled, polls = [], []
+    monkeypatch.setattr(
+        auto_form_filler,
+        "fill_form",
+        lambda driver, wait, ids, *args: filled.append(sorted(ids)),
+    )
+    monkeypatch.setattr(
+        auto_form_filler, "mark_select_options", lambda driver, select_id: ["cũ"]
+    )
+
+    def refreshed(driver, select_id, previous):
+        polls.append(previous)
+        return len(polls) > refreshed_after
+
+    monkeypatch.setattr(auto_form_filler, "dropdown_refreshed", refreshed)
+    steps = _multitab_fill_steps(None, None, FORM_FIELD_IDS, data, 1, {})
+    yields = 0
+    for _ in steps:
+        yields += 1
+        assert filled == [["sales_date"]]  # Phần còn lại chờ 'session' nạp lại
+    return filled, yields
+
+
+def test_dropdown_wait_yields_to_other_tabs(monkeypatch):
+    filled, yields = run_fill(monkeypatch, DATA, refreshed_after=3)
+    assert yields == 3
+    assert filled == [["sales_date"], ["full_name", "session"]]
+
+
+def test_rows_without_sales_date_fill_in_one_step(monkeypatch):
+    data = dict(DATA, sales_date="")
+    filled, yields = run_fill(monkeypatch, data, refreshed_after=3)
+    assert yields == 0
+    assert filled == [["full_name", "sales_date", "session"]]
+
+
+class FakeElement:
+    def __init__(self, log):
+        self.log = log
+
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+    def click(self):
+        self.log.append("click")
+
+    def clear(self):
+        self.log.append("clear")
+
+    def send_keys(self, text):
+        self.log.append(f"type {text}")
+
+
+class FakeDriver:
+    def __init__(self):
+        self.log = []
+
+    def execute_script(self, script, *args):
+        return True  # Trang đã tải xong
+
+    def find_element(self, by, element_id):
+        return FakeElement(self.log)
+
+
+class DoneFuture:
+    def __init__(self, result):
+        self._result = result
+
+    def done(self):
+        return True
+
+    def result(self):
+        return self._result
+
+
+class FakeExecutor:
+    def __init__(self, answers):
+        self.answers = list(answers)
+
+    def submit(self, func, *args):
+        return DoneFuture((self.answers.pop(0), None))
+
+
+def run_task(monkeypatch, outcomes, max_attempts=3):
+    reported = []
+
+    def steps_returning(value):
+        return value
+        yield
+
+    outcomes = list(outcomes)
+    monkeypatch.setattr(
+        auto_form_filler,
+        "captcha_capture_steps",
+        lambda *args: steps_returning(b"img1"),
+    )
+    monkeypatch.setattr(
+        auto_form_filler,
+        "refresh_captcha_steps",
+        lambda *args: steps_returning(b"img2"),
+    )
+    monkeypatch.setattr(
+        auto_form_filler,
+        "submit_outcome_steps",
+        lambda *args: steps_returning(outcomes.pop(0)),
+    )
+    monkeypatch.setattr(
+        auto_form_filler, "_multitab_fill_steps", lambda *args: steps_returning(None)
+    )
+    monkeypatch.setattr(auto_form_filler, "read_submit_state", lambda *args: {})
+    monkeypatch.setattr(auto_form_filler, "cleared_fields", lambda *args: {})
+    monkeypatch.setattr(
+        auto_form_filler,
+        "report_captcha_outcome",
+        lambda service, image, success: reported.append((image, success)),
+    )
+    driver = FakeDriver()
+    task_info = {
+        "url": "https://example.vn/",
+        "data": DATA,
+        "process_id": 1,
+        "is_headless": True,
+        "use_ai_captcha": True,
+        "api_keys": ["key"],
+        "FORM_FIELD_IDS": dict(
+            FORM_FIELD_IDS,
+            captcha="txtCaptcha",
+            captcha_image_selector="#imgCaptcha",
+            submit_button="btnDangKy",
+        ),
+        "captcha_max_attempts": max_attempts,
+    }
+    steps = auto_form_filler._multitab_task_steps(
+        driver, task_info, FakeExecutor(["AB12C", "XY34Z"])
+    )
+    try:
+        while True:
+            next(steps)
+    except StopIteration as finished:
+        return finished.value, reported, driver.log
+
+
+def test_multitab_retries_rejected_captcha(monkeypatch):
+    (success, _), reported, log = run_task(monkeypatch, ["rejected", "success"])
+    assert success
+    assert reported == [(b"img1", False), (b"img2", True)]
+    assert log == ["type AB12C", "click", "clear", "type XY34Z", "click"]
+
+
+def test_multitab_unknown_failure_is_not_labelled(monkeypatch):
+    (success, _), reported, log = run_task(monkeypatch, ["failed"])
+    assert not success
+    assert reported == []
+    assert log.count("click") == 1
@@ -0,0 +1,82 @@
+import pandas as pd
+
+from auto_form_filler import (
+    normalize_id_card_column,
+    normalize_phone_column,
+    normalize_row_chunk,
+    parse_date_column,
+)
+
+MAPPING = {
+    "full_name": "Họ tên",
+    "day": "Ngày sinh",
+    "phone_number": "SĐT",
+    "email": "Email",
+    "id_card": "CCCD",
+}
+
+
+def test_phone_restores_leading_zero_and_country_code():
+    phones = pd.Series([912345678, "0912 345 678", "+84912345678", "84-912.345.678"])
+    assert normalize_phone_column(phones).tolist() == ["0912345678"] * 4
+
+
+def test_id_card_pads_lost_leading_zeros():
+    ids = pd.Series([1234567890, 12345678901.0, "001234567890", " 079 123 456 789 "])
+    assert normalize_id_card_column(ids).tolist() == [
+        "001234567890",
+        "012345678901",
+        "001234567890",
+        "079123456789",
+    ]
+
+
+def test_id_card_keeps_old_ids_and_passports():
+    ids = pd.Series(["123456789", "b1234567", None])
+    assert normalize_id_card_column(ids).tolist() == ["123456789", "B1234567", ""]
+
+
+def test_parse_date_column_accepts_known_formats():
+    dates = parse_date_column(
+        pd.Series(["05/03/1990", "1990-03-05 00:00:00", "05-03-1990", "31/02/1990"])
+    )
+    assert dates["day"].tolist() == ["05", "05", "05", ""]
+    assert dates["month"].tolist() == ["03", "03", "03", ""]
+    assert dates["year"].tolist() == ["1990", "1990", "1990", ""]
+
+
+def test_normalize_row_chunk_reports_problems_per_row():
+    df = pd.DataFrame(
+        {
+            "Họ tên": ["Nguyễn Văn A", "Trần Thị B", None, "Lê C"],
+            "Ngày sinh": ["05/03/1990", "abc", None, "01/01/2000"],
+            "SĐT": [912345678, "0912345678", None, "12345"],
+            "Email": ["a@example.vn", "b@example.vn", None, ""],
+            "CCCD": [1234567890, "001234567890", None, "001234567891"],
+        }
+    )
+    data, problems = normalize_row_chunk(df, MAPPING)
+    assert list(data.index) == [0, 1, 3]  # Dòng trống hoàn toàn bị bỏ
+    assert data.loc[0, "id_card"] == "001234567890"
+    assert data.loc[0, "phone_number"] == "0912345678"
+    assert (data.loc[0, "day"], data.loc[0, "month"]) == ("05", "03")
+    assert problems[0] == ""
+    assert "ngày sinh không hợp lệ 'abc'" in problems[1]
+    assert "phone_number sai định dạng '12345'" in problems[3]
+    assert "email" not in problems[3]
+
+
+def test_blank_email_is_optional_but_bad_email_is_not():
+    df = pd.DataFrame(
+        {
+            "Họ tên": ["Nguyễn Văn A", "Trần Thị B"],
+            "Ngày sinh": ["05/03/1990", "06/04/1991"],
+            "SĐT": ["0912345678", "0987654321"],
+            "Email": [None, "khong-phai-email"],
+            "CCCD": ["001234567890", "001234567891"],
+        }
+    )
+    data, problems = normalize_row_chunk(df, MAPPING)
+    assert data.loc[0, "email"] == ""
+    assert problems[0] == ""
+    assert "email sai định dạng 'khong-phai-email'" in problems[1]
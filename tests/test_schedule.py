@@ -0,0 +1,21 @@
+from datetime import datetime, time, timedelta, timezone
+
+from auto_form_filler import parse_utc_offset, scheduled_timestamp
+
+VN = timezone(timedelta(hours=7))
+
+
+def test_parse_utc_offset():
+    assert parse_utc_offset("+07:00") == VN
+    assert parse_utc_offset("UTC+7") == VN
+    assert parse_utc_offset(" -0530 ") == timezone(-timedelta(hours=5, minutes=30))
+    assert parse_utc_offset("07:00") is None
+    assert parse_utc_offset("+15") is None
+    assert parse_utc_offset("+07:75") is None
+
+
+def test_scheduled_time_is_converted_from_server_timezone():
+    # Máy chạy ở UTC, 20:00 ngày 17: bên server (UTC+7) đã là 03:00 ngày 18
+    now = datetime(2026, 10, 17, 20, 0, tzinfo=timezone.utc)
+    target = scheduled_timestamp(time(9, 0, tzinfo=VN), now)
+    assert target == datetime(2026, 10, 18, 2, 0, tzinfo=timezone.utc).timestamp()
@@ -0,0 +1,213 @@
+import json
+
+import pytest
+
+from auto_form_filler import (
+    HttpReplayEngine,
+    capture_submission_template,
+    map_submission_fields,
+    resolve_option_value,
+)
+
+DATE_OPTIONS = [
+    {"text": "-- Chọn ngày --", "value": ""},
+    {"text": "20/10/2026", "value": "1"},
+    {"text": "21/10/2026", "value": "2"},
+]
+SESSION_OPTIONS = [
+    {"text": "08:00 - 10:00", "value": "7"},
+    {"text": "10:00 - 12:00", "value": "3"},
+]
+
+
+def select(element_id, name, value, options):
+    return {
+        "id": element_id,
+        "name": name,
+        "tag": "select",
+        "value": value,
+        "options": options,
+    }
+
+
+def text_input(element_id, name, value):
+    return {"id": element_id, "name": name, "tag": "input", "value": value}
+
+
+@pytest.fixture
+def data():
+    return {
+        "full_name": "Nguyễn Văn A",
+        "phone_number": "0912345678",
+        "id_card": "001234567890",
+        "day": "05",
+        "month": "05",
+        "year": "1990",
+        "sales_date": "20/10/2026",
+        "session": "10:00 - 12:00",
+    }
+
+
+@pytest.fixture
+def form_elements(data):
+    day_options = [{"text": f"{d:02d}", "value": str(d)} for d in range(1, 32)]
+    month_options = [{"text": f"{m:02d}", "value": str(m)} for m in range(1, 13)]
+    return {
+        "full_name": text_input("txtHoTen", "HoTen", data["full_name"]),
+        "phone_number": text_input("txtSDT", "SoDienThoai", data["phone_number"]),
+        "id_card": text_input("txtCCCD", "CCCD", data["id_card"]),
+        "day": select("ddlNgay", "Ngay", "5", day_options),
+        "month": select("ddlThang", "Thang", "5", month_options),
+        "year": text_input("txtNam", "Nam", "1990"),
+        "sales_date": select("ddlNgayBan", "NgayBan", "1", DATE_OPTIONS),
+        "session": select("ddlPhien", "Phien", "3", SESSION_OPTIONS),
+    }
+
+
+@pytest.fixture
+def pairs():
+    return [
+        ("__RequestVerificationToken", "tok"),
+        ("NgayBan", "1"),
+        ("Phien", "3"),
+        ("HoTen", "Nguyễn Văn A"),
+        ("Ngay", "5"),
+        ("Thang", "5"),
+        ("Nam", "1990"),
+        ("SoDienThoai", "0912345678"),
+        ("CCCD", "001234567890"),
+        ("Captcha", "AB12C"),
+        ("Submit", "Đăng ký"),
+    ]
+
+
+def test_fields_mapped_by_element_name(pairs, data, form_elements):
+    fields, error = map_submission_fields(
+        pairs, data, form_elements, {"__RequestVerificationToken": "tok"}, "AB12C"
+    )
+    assert error is None
+    specs = dict(fields)
+    assert specs["__RequestVerificationToken"]["source"] == "token"
+    assert specs["Captcha"] == {"source": "captcha"}
+    assert specs["Submit"] == {"source": "const", "value": "Đăng ký"}
+    # Cùng giá trị "5" nhưng mỗi select vẫn giữ đúng trường của nó
+    assert specs["Ngay"]["key"] == "day"
+    assert specs["Thang"]["key"] == "month"
+    # Select gửi option.value: được gắn với cột dữ liệu, không phải hằng số
+    assert specs["NgayBan"]["source"] == "data"
+    assert specs["NgayBan"]["key"] == "sales_date"
+    assert specs["Phien"]["key"] == "session"
+    assert specs["Phien"]["options_for"] == "20/10/2026"
+
+
+def test_replay_resolves_select_values_per_row(pairs, data, form_elements):
+    fields, _ = map_submission_fields(pairs, data, form_elements, {}, "AB12C")
+    engine = HttpReplayEngine({"fields": fields})
+    row = dict(data, sales_date="20/10/2026", session="08:00", day="17", month="03")
+    payload = dict(engine.build_payload(row, {}, "XYZ99"))
+    assert payload["NgayBan"] == "1"
+    assert payload["Phien"] == "7"
+    assert payload["Ngay"] == "17"
+    assert payload["Thang"] == "3"
+    assert payload["Captcha"] == "XYZ99"
+
+
+def test_replay_needs_page_for_sessions_of_another_date(pairs, data, form_elements):
+    fields, _ = map_submission_fields(pairs, data, form_elements, {}, None)
+    engine = HttpReplayEngine({"fields": fields})
+    row = dict(data, sales_date="21/10/2026")
+    assert engine.needs_browser(row)
+    with pytest.raises(ValueError):
+        engine.build_payload(row, {})
+    payload = dict(engine.build_payload(row, {}, select_values={"session": "42"}))
+    assert payload["NgayBan"] == "2"
+    assert payload["Phien"] == "42"
+
+
+def test_unknown_option_is_an_error_not_a_constant(pairs, data, form_elements):
+    fields, _ = map_submission_fields(pairs, data, form_elements, {}, None)
+    engine = HttpReplayEngine({"fields": fields})
+    with pytest.raises(ValueError):
+        engine.build_payload(dict(data, session="15:00"), {})
+
+
+def test_renamed_params_with_ambiguous_values_are_refused(data, form_elements):
+    # Request dựng bằng JS, tên tham số không khớp name của phần tử
+    renamed = [("d", "5"), ("m", "5"), ("y", "1990"), ("date", "1"), ("s", "3")]
+    fields, error = map_submission_fields(renamed, data, form_elements, {}, None)
+    assert fields is None
+    assert "day" in error and "month" in error
+
+
+def test_missing_row_field_is_refused(pairs, data, form_elements):
+    without_phone = [p for p in pairs if p[0] != "SoDienThoai"]
+    fields, error = map_submission_fields(without_phone, data, form_elements, {}, None)
+    assert fields is None
+    assert "phone_number" in error
+
+
+def test_option_matching_follows_fill_form():
+    assert resolve_option_value(SESSION_OPTIONS, "session", "12:00") == "3"
+    assert resolve_option_value(DATE_OPTIONS, "sales_date", "20/10") is None
+    assert resolve_option_value(DATE_OPTIONS, "sales_date", " 21/10/2026 ") == "2"
+
+
+class FakeDriver:
+    def __init__(self, events):
+        self.events = events
+
+    def get_log(self, _):
+        return [{"message": json.dumps({"message": e})} for e in self.events]
+
+    def execute_cdp_cmd(self, command, params):
+        return {"body": '{"success": true}'}
+
+    def get_cookies(self):
+        return [{"name": "ASP.NET_SessionId", "value": "x"}]
+
+
+def test_capture_picks_form_request(pairs, data, form_elements):
+    body = "&".join(f"{k}={v}" for k, v in pairs)
+    events = [
+        {
+            "method": "Network.requestWillBeSent",
+            "params": {
+                "requestId": "1",
+                "request": {
+                    "url": "https://example.vn/track",
+                    "method": "POST",
+                    "headers": {"Content-Type": "application/x-www-form-urlencoded"},
+                    "postData": "event=click",
+                },
+            },
+        },
+        {
+            "method": "Network.requestWillBeSent",
+            "params": {
+                "requestId": "2",
+                "request": {
+                    "url": "https://example.vn/DangKy",
+                    "method": "POST",
+                    "headers": {"Content-Type": "application/x-www-form-urlencoded"},
+                    "postData": body,
+                },
+            },
+        },
+        {
+            "method": "Network.responseReceived",
+            "params": {"requestId": "2", "response": {"status": 200}},
+        },
+    ]
+    template, error = capture_submission_template(
+        FakeDriver(events),
+        "https://example.vn/",
+        data,
+        {"__RequestVerificationToken": "tok"},
+        "AB12C",
+        form_elements,
+    )
+    assert error is None
+    assert template["endpoint"] == "https://example.vn/DangKy"
+    assert template["expected_status"] == 200
+    assert template["success_signature"] == {"json": {"success": True}}
+    assert dict(template["fields"])["NgayBan"]["key"] == "sales_date"
@@ -0,0 +1,50 @@
+from auto_form_filler import wait_for_submit_outcome
+
+FORM_FIELD_IDS = {"captcha": "txtCaptcha", "captcha_image_selector": "#imgCaptcha"}
+BEFORE = {
+    "markers": 0,
+    "captcha_error": False,
+    "captcha_src": "/Captcha?1",
+    "captcha_value": "AB12C",
+}
+
+
+class FakeDriver:
+    def __init__(self, state, success=False):
+        self.state = state
+        self.success = success
+
+    def find_elements(self, by, xpath):
+        return [object()] if self.success else []
+
+    def execute_script(self, script, *args):
+        return self.state
+
+
+def outcome(state, before=BEFORE, **kwargs):
+    driver = FakeDriver(dict(BEFORE, **state), **kwargs)
+    return wait_for_submit_outcome(driver, FORM_FIELD_IDS, before, timeout=0.2)
+
+
+def test_success_page():
+    assert outcome({}, success=True) == "success"
+
+
+def test_captcha_message_is_rejected():
+    assert outcome({"markers": 1, "captcha_value": ""}) == "rejected"
+
+
+def test_captcha_field_error_is_rejected():
+    assert outcome({"captcha_error": True}) == "rejected"
+
+
+def test_new_image_and_cleared_input_alone_is_failed():
+    # Ví dụ CCCD đã đăng ký: server dựng lại form, ảnh mới, ô mã trống
+    assert outcome({"captcha_src": "/Captcha?2", "captcha_value": ""}) == "failed"
+
+
+def test_stale_field_error_needs_a_new_image():
+    before = dict(BEFORE, captcha_error=True)
+    assert outcome({"captcha_error": True}, before=before) == "failed"
+    state = {"captcha_error": True, "captcha_src": "/Captcha?2"}
+    assert outcome(state, before=before) == "rejected"